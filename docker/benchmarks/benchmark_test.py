@@ -0,0 +1,194 @@
+"""
+Microbenchmarks for the pure-Python hot paths, run with pytest-benchmark:
+
+    cd docker/benchmarks
+    python -m pytest benchmark_test.py
+
+They live next to the other benchmark scripts, so the relay's unit test run
+does not collect them, and the module is skipped when pytest-benchmark is
+not installed.
+
+Each benchmark also asserts a mean-time budget, so a change that makes one of
+these paths several times slower fails the run. The budgets are generous to
+tolerate slow machines; scale them with BENCHMARK_BUDGET_SCALE. For finer
+regressions, save a baseline and compare against it on the same machine:
+
+    python -m pytest benchmark_test.py --benchmark-autosave
+    python -m pytest benchmark_test.py --benchmark-compare --benchmark-compare-fail=mean:15%
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import orjson  # noqa: E402
+import secp256k1  # noqa: E402
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "nostpy_relay"))
+from event_classes import Event, Subscription  # noqa: E402
+from nostr_events import signed_event  # noqa: E402
+from websocket_classes import ExtractedResponse, SubscriptionMatcher  # noqa: E402
+
+BUDGET_SCALE = float(os.getenv("BENCHMARK_BUDGET_SCALE", 1))
+
+# Mean time budgets in microseconds, about 10x what a development machine measures
+BUDGETS_US = {
+    "parse_filters": 1500,
+    "base_query_builder": 50,
+    "query_result_parser": 60000,
+    "match_event": 25000,
+    "send_event_loop": 10000,
+    "verify_signature": 1000,
+}
+
+logger = logging.getLogger("benchmark")
+logger.setLevel(logging.WARNING)
+random.seed(1)
+
+
+def check_budget(benchmark, name):
+    # Stats are missing when run with --benchmark-disable
+    if benchmark.stats is None:
+        return
+    mean_us = benchmark.stats.stats.mean * 1_000_000
+    budget_us = BUDGETS_US[name] * BUDGET_SCALE
+    assert mean_us < budget_us, f"{name} took {mean_us:.1f}us, budget {budget_us}us"
+
+
+@pytest.fixture(scope="module")
+def events():
+    """Signed kind 1 notes with e, p and t tags and a few hundred bytes of content."""
+    keys = [secp256k1.PrivateKey() for _ in range(50)]
+    generated = []
+    for index in range(500):
+        tags = [["t", random.choice(["nostr", "bitcoin", "python", "relay"])]]
+        if generated:
+            tags += [["e", generated[-1]["id"]], ["p", generated[-1]["pubkey"]]]
+        generated.append(
+            signed_event(
+                keys[index % len(keys)],
+                content="benchmark content " * 15,
+                tags=tags,
+                created_at=1700000000 + index,
+            )
+        )
+    return generated
+
+
+@pytest.fixture(scope="module")
+def filters(events):
+    """A REQ with the filter shapes clients commonly send."""
+    pubkeys = sorted({event["pubkey"] for event in events})
+    return [
+        {
+            "kinds": [1, 6, 7],
+            "authors": pubkeys[:40],
+            "since": 1700000000,
+            "limit": 100,
+        },
+        {"#e": [event["id"] for event in events[:3]], "kinds": [1, 7]},
+        {"ids": [event["id"] for event in events[:20]]},
+        {"#t": ["nostr", "python"], "limit": 50},
+    ]
+
+
+@pytest.fixture(scope="module")
+def rows(events):
+    """Query result rows as the read pool returns them."""
+    return [
+        (
+            event["id"],
+            event["pubkey"],
+            event["kind"],
+            event["created_at"],
+            event["tags"],
+            event["content"],
+            event["sig"],
+        )
+        for event in events
+    ]
+
+
+class NullWriter:
+    async def send(self, frame):
+        pass
+
+
+def test_parse_filters(benchmark, filters):
+    subscription = Subscription({"event_dict": filters, "subscription_id": "bench"})
+    loop = asyncio.new_event_loop()
+
+    async def parse_all():
+        return [await subscription.parse_filters(f, logger) for f in filters]
+
+    benchmark(lambda: loop.run_until_complete(parse_all()))
+    loop.close()
+    check_budget(benchmark, "parse_filters")
+
+
+def test_base_query_builder(benchmark, filters):
+    subscription = Subscription({"event_dict": filters, "subscription_id": "bench"})
+    parsed = asyncio.run(subscription.parse_filters(filters[0], logger))
+
+    def build():
+        subscription.where_clause = ""
+        return subscription.base_query_builder(*parsed, logger)
+
+    assert benchmark(build).startswith("SELECT")
+    check_budget(benchmark, "base_query_builder")
+
+
+def test_query_result_parser(benchmark, rows):
+    subscription = Subscription({"event_dict": [], "subscription_id": "bench"})
+    loop = asyncio.new_event_loop()
+    parsed = benchmark(
+        lambda: loop.run_until_complete(subscription.query_result_parser(rows))
+    )
+    loop.close()
+    assert len(parsed) == len(rows)
+    check_budget(benchmark, "query_result_parser")
+
+
+def test_match_event(benchmark, events, filters):
+    # One event checked against 200 live subscriptions
+    matchers = [
+        SubscriptionMatcher(f"sub{i}", [filters[i % len(filters)]], logger)
+        for i in range(200)
+    ]
+    event = events[0]
+
+    def match_all():
+        return sum(1 for matcher in matchers if matcher.match_event(event))
+
+    benchmark(match_all)
+    check_budget(benchmark, "match_event")
+
+
+def test_send_event_loop(benchmark, events):
+    response = ExtractedResponse(
+        {"event": "EVENT", "subscription_id": "bench", "results_json": events},
+        logger,
+    )
+    writer = NullWriter()
+    loop = asyncio.new_event_loop()
+    benchmark(
+        lambda: loop.run_until_complete(
+            response.send_event_loop(events, writer, logger)
+        )
+    )
+    loop.close()
+    check_budget(benchmark, "send_event_loop")
+
+
+def test_verify_signature(benchmark, events):
+    event = Event.from_raw(orjson.dumps(events[0]))
+    assert benchmark(event.verify_signature, logger)
+    check_budget(benchmark, "verify_signature")
@@ -0,0 +1,76 @@
+"""
+Posts pre-signed events straight to the event handler's /new_event endpoint
+and prints the throughput and latency as JSON.
+
+Run it once per EVENT_HANDLER_WORKERS setting to see how ingest scales with
+worker processes, for example:
+
+    python ingest_benchmark.py --url http://localhost:8009 --events 20000 --concurrency 64 --workers 4
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import orjson
+
+from nostr_events import signed_events
+from results import latency_summary, save_results
+
+
+async def post_events(session, url, payloads, latencies, statuses):
+    for payload in payloads:
+        start = time.perf_counter()
+        async with session.post(
+            f"{url}/new_event",
+            data=payload,
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            await response.read()
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run(url, events, concurrency, workers):
+    payloads = [orjson.dumps(event) for event in signed_events(events)]
+    latencies, statuses = [], {}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                post_events(session, url, payloads[i::concurrency], latencies, statuses)
+                for i in range(concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+    return {
+        "benchmark": "ingest",
+        "url": url,
+        "events": events,
+        "concurrency": concurrency,
+        "workers": workers,
+        "elapsed_s": round(elapsed, 3),
+        "events_per_s": round(events / elapsed, 1),
+        "latency_ms": latency_summary(latencies),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="http://localhost:8009")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="EVENT_HANDLER_WORKERS of the relay under test, recorded in the result",
+    )
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    args = parser.parse_args()
+    result = asyncio.run(run(args.url, args.events, args.concurrency, args.workers))
+    save_results(result, args.output)
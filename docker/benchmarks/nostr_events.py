@@ -0,0 +1,76 @@
+import hashlib
+import time
+from typing import Any, Dict, List, Optional
+
+import orjson
+import secp256k1
+
+
+def event_id(
+    pubkey: str, created_at: int, kind: int, tags: List[List[str]], content: str
+) -> str:
+    """
+    Computes the NIP-01 event ID: the sha256 of the serialized event array.
+    """
+    serialized = orjson.dumps([0, pubkey, created_at, kind, tags, content])
+    return hashlib.sha256(serialized).hexdigest()
+
+
+def signed_event(
+    private_key: secp256k1.PrivateKey,
+    kind: int = 1,
+    content: str = "",
+    tags: Optional[List[List[str]]] = None,
+    created_at: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Builds and signs an event that passes the relay's ID and signature checks.
+
+    Args:
+        private_key: secp256k1 key the event is signed with.
+        kind: Event kind.
+        content: Event content.
+        tags: Event tags, empty by default.
+        created_at: Unix timestamp, now by default.
+
+    Returns:
+        The event as a dict ready to be sent in an EVENT message.
+    """
+    tags = tags or []
+    created_at = created_at if created_at is not None else int(time.time())
+    pubkey = private_key.pubkey.serialize()[1:].hex()
+    evt_id = event_id(pubkey, created_at, kind, tags, content)
+    sig = private_key.schnorr_sign(bytes.fromhex(evt_id), None, raw=True).hex()
+    return {
+        "id": evt_id,
+        "pubkey": pubkey,
+        "created_at": created_at,
+        "kind": kind,
+        "tags": tags,
+        "content": content,
+        "sig": sig,
+    }
+
+
+def signed_events(
+    count: int,
+    keys: int = 16,
+    kind: int = 1,
+    tags: Optional[List[List[str]]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Pre-signs ``count`` unique events spread over ``keys`` authors so signing
+    cost stays out of the measured run.
+    """
+    private_keys = [secp256k1.PrivateKey() for _ in range(keys)]
+    now = int(time.time())
+    return [
+        signed_event(
+            private_keys[i % keys],
+            kind=kind,
+            content=f"benchmark event {i}",
+            tags=tags,
+            created_at=now - i,
+        )
+        for i in range(count)
+    ]
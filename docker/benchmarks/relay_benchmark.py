@@ -0,0 +1,391 @@
+"""
+Drives a relay with websocket clients and records throughput, latency and
+peak memory as JSON, so runs can be compared across commits.
+
+By default the relay is started here in embedded mode, against the Postgres
+and Redis named by the usual PG*_WRITE, PG*_READ and REDIS_* variables. Pass
+--url to measure a relay that is already running instead, e.g. the compose
+stack.
+
+    python relay_benchmark.py run --clients 50 --publish-rate 200 --req-rate 50 --duration 30 --output results/main.json
+    python relay_benchmark.py compare results/main.json results/branch.json
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import orjson
+import websockets
+
+from nostr_events import signed_events
+from results import latency_summary, save_results
+
+RELAY_DIR = Path(__file__).resolve().parent.parent / "nostpy_relay"
+LIVE_SUBSCRIPTION = "bench-live"
+REQ_SHAPES = ("kinds", "authors", "tag", "ids", "window")
+
+
+class Recorder:
+    """Collects latency samples in milliseconds and counters for one run."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {"ok": [], "eose": [], "live": []}
+        self.counts: Dict[str, int] = {}
+
+    def latency(self, name: str, started: float) -> None:
+        self.latencies[name].append((time.perf_counter() - started) * 1000)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+
+class BenchClient:
+    """
+    One websocket connection. A reader task matches OK, EOSE and live EVENT
+    messages to the time their request or event was sent.
+    """
+
+    def __init__(self, url: str, recorder: Recorder, sent_at: Dict[str, float]):
+        self.url = url
+        self.recorder = recorder
+        self.sent_at = sent_at
+        self.pending_ok: Dict[str, float] = {}
+        self.pending_eose: Dict[str, float] = {}
+        self.websocket = None
+        self.reader: Optional[asyncio.Task] = None
+
+    async def open(self, live_filter: Dict[str, Any]) -> None:
+        self.websocket = await websockets.connect(self.url, max_size=None)
+        self.reader = asyncio.create_task(self._read())
+        await self.websocket.send(
+            orjson.dumps(["REQ", LIVE_SUBSCRIPTION, live_filter]).decode()
+        )
+
+    async def publish(self, event_id: str, frame: str) -> None:
+        self.pending_ok[event_id] = self.sent_at[event_id] = time.perf_counter()
+        await self.websocket.send(frame)
+        self.recorder.count("published")
+
+    async def req(self, subscription_id: str, req_filter: Dict[str, Any]) -> None:
+        self.pending_eose[subscription_id] = time.perf_counter()
+        await self.websocket.send(
+            orjson.dumps(["REQ", subscription_id, req_filter]).decode()
+        )
+        self.recorder.count("reqs")
+
+    async def close(self) -> None:
+        self.recorder.count("ok_timeouts", len(self.pending_ok))
+        self.recorder.count("eose_timeouts", len(self.pending_eose))
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            self.reader.cancel()
+
+    async def _read(self) -> None:
+        try:
+            async for message in self.websocket:
+                self._handle(orjson.loads(message))
+        except websockets.exceptions.ConnectionClosed:
+            self.recorder.count("disconnects")
+
+    def _handle(self, message: List[Any]) -> None:
+        message_type = message[0]
+        if message_type == "EVENT":
+            if message[1] == LIVE_SUBSCRIPTION:
+                started = self.sent_at.get(message[2].get("id"))
+                if started is not None:
+                    self.recorder.latency("live", started)
+                    self.recorder.count("live_received")
+            else:
+                self.recorder.count("req_events")
+        elif message_type == "OK":
+            started = self.pending_ok.pop(message[1], None)
+            if started is not None:
+                self.recorder.latency("ok", started)
+                accepted = message[2] in (True, "true")
+                self.recorder.count("ok_accepted" if accepted else "ok_rejected")
+        elif message_type == "EOSE":
+            started = self.pending_eose.pop(message[1], None)
+            if started is not None:
+                self.recorder.latency("eose", started)
+                asyncio.create_task(
+                    self.websocket.send(orjson.dumps(["CLOSE", message[1]]).decode())
+                )
+        elif message_type in ("NOTICE", "CLOSED"):
+            self.recorder.count(message_type.lower())
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        shape, _, weight = part.partition("=")
+        if shape not in REQ_SHAPES:
+            raise argparse.ArgumentTypeError(f"unknown REQ shape: {shape}")
+        weights[shape] = int(weight or 1)
+    return weights
+
+
+def req_filter(
+    shape: str, tag: str, events: List[Dict[str, Any]], published: int
+) -> Dict[str, Any]:
+    """Builds a REQ filter of the given shape over the events of this run."""
+    sent = events[: max(published, 1)]
+    if shape == "authors":
+        return {"authors": [random.choice(sent)["pubkey"]], "limit": 50}
+    if shape == "tag":
+        return {"#t": [tag], "limit": 50}
+    if shape == "ids":
+        return {
+            "ids": [event["id"] for event in random.sample(sent, min(5, len(sent)))]
+        }
+    if shape == "window":
+        now = int(time.time())
+        return {"kinds": [1], "since": now - 300, "until": now + 1, "limit": 100}
+    return {"kinds": [1], "limit": 50}
+
+
+async def paced(rate: float, duration: float, action: Callable[[int], Any]) -> None:
+    """
+    Calls ``action`` ``rate`` times a second for ``duration`` seconds on a
+    fixed schedule, so a slow relay does not lower the offered load.
+    """
+    if rate <= 0:
+        return
+    interval = 1 / rate
+    start = time.perf_counter()
+    tick = 0
+    in_flight = set()
+    while tick * interval < duration:
+        delay = start + tick * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(action(tick))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        tick += 1
+    await asyncio.gather(*in_flight)
+
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+    except OSError:
+        return pids
+    for child in children:
+        pids.extend(process_tree(int(child)))
+    return pids
+
+
+def tree_rss_kb(pid: int) -> int:
+    total = 0
+    for member in process_tree(pid):
+        try:
+            status = Path(f"/proc/{member}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1])
+    return total
+
+
+async def sample_peak_rss(pid: int, peak: Dict[str, int]) -> None:
+    while True:
+        peak["kb"] = max(peak["kb"], tree_rss_kb(pid))
+        await asyncio.sleep(0.5)
+
+
+def start_relay(port: int, workers: int, log_path: Optional[str]) -> subprocess.Popen:
+    env = dict(os.environ, RELAY_MODE="embedded", WS_PORT=str(port))
+    env["WS_WORKERS"] = str(workers)
+    log = open(log_path, "ab") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(
+        [sys.executable, "websocket_handler.py"],
+        cwd=RELAY_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def wait_for_port(relay: subprocess.Popen, port: int, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if relay.poll() is not None:
+            raise RuntimeError(
+                f"relay exited with code {relay.returncode}, rerun with --relay-log to see why"
+            )
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"relay did not listen on port {port} within {timeout}s")
+
+
+async def run(args) -> Dict[str, Any]:
+    tag = f"bench-{os.getpid()}-{int(time.time())}"
+    total_events = int(args.publish_rate * args.duration) + 1
+    events = signed_events(total_events, tags=[["t", tag]])
+    frames = [orjson.dumps(["EVENT", event]).decode() for event in events]
+    mix = args.req_mix
+    shapes, weights = list(mix), list(mix.values())
+
+    recorder = Recorder()
+    sent_at: Dict[str, float] = {}
+    clients = [BenchClient(args.url, recorder, sent_at) for _ in range(args.clients)]
+    live_filter = {"kinds": [1], "#t": [tag]}
+    await asyncio.gather(*(client.open(live_filter) for client in clients))
+    publishers = clients[: max(1, min(args.publishers, len(clients)))]
+
+    async def publish(tick: int) -> None:
+        if tick < len(events):
+            client = publishers[tick % len(publishers)]
+            await client.publish(events[tick]["id"], frames[tick])
+
+    async def request(tick: int) -> None:
+        shape = random.choices(shapes, weights)[0]
+        published = recorder.counts.get("published", 0)
+        await clients[tick % len(clients)].req(
+            f"bench-req-{tick}", req_filter(shape, tag, events, published)
+        )
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        paced(args.publish_rate, args.duration, publish),
+        paced(args.req_rate, args.duration, request),
+    )
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*(client.close() for client in clients))
+
+    counts = recorder.counts
+    return {
+        "benchmark": "relay",
+        "config": {
+            "url": args.url,
+            "clients": args.clients,
+            "publishers": len(publishers),
+            "publish_rate": args.publish_rate,
+            "req_rate": args.req_rate,
+            "req_mix": mix,
+            "duration_s": args.duration,
+            "ws_workers": args.ws_workers,
+        },
+        "throughput_per_s": {
+            "published": round(counts.get("published", 0) / elapsed, 1),
+            "accepted": round(counts.get("ok_accepted", 0) / elapsed, 1),
+            "reqs": round(counts.get("reqs", 0) / elapsed, 1),
+            "live_deliveries": round(counts.get("live_received", 0) / elapsed, 1),
+        },
+        "latency_ms": {
+            name: latency_summary(samples)
+            for name, samples in recorder.latencies.items()
+        },
+        "counts": dict(sorted(counts.items())),
+    }
+
+
+def run_command(args) -> None:
+    relay = None
+    if not args.url:
+        args.url = f"ws://127.0.0.1:{args.port}"
+        relay = start_relay(args.port, args.ws_workers, args.relay_log)
+        try:
+            wait_for_port(relay, args.port)
+        except RuntimeError:
+            relay.kill()
+            raise
+
+    async def measured():
+        peak = {"kb": 0}
+        sampler = None
+        if relay is not None:
+            sampler = asyncio.create_task(sample_peak_rss(relay.pid, peak))
+        try:
+            result = await run(args)
+        finally:
+            if sampler is not None:
+                sampler.cancel()
+        result["peak_rss_kb"] = peak["kb"] if relay is not None else None
+        return result
+
+    try:
+        result = asyncio.run(measured())
+    finally:
+        if relay is not None:
+            relay.send_signal(signal.SIGTERM)
+            relay.wait(timeout=30)
+    save_results(result, args.output)
+
+
+def flatten(result: Dict[str, Any]) -> Dict[str, float]:
+    flat = {
+        f"throughput_per_s.{name}": value
+        for name, value in result.get("throughput_per_s", {}).items()
+    }
+    for name, summary in result.get("latency_ms", {}).items():
+        for stat in ("p50", "p99"):
+            flat[f"latency_ms.{name}.{stat}"] = summary.get(stat)
+    flat["peak_rss_kb"] = result.get("peak_rss_kb")
+    return flat
+
+
+def compare_command(args) -> None:
+    base = orjson.loads(Path(args.base).read_bytes())
+    new = orjson.loads(Path(args.new).read_bytes())
+    print(
+        f"{'metric':<32}{base.get('revision') or 'base':>14}{new.get('revision') or 'new':>14}{'change':>10}"
+    )
+    base_flat, new_flat = flatten(base), flatten(new)
+    for metric, before in base_flat.items():
+        after = new_flat.get(metric)
+        change = ""
+        if before and after is not None:
+            change = f"{(after - before) / before * 100:+.1f}%"
+        print(f"{metric:<32}{str(before):>14}{str(after):>14}{change:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run a workload against a relay")
+    run_parser.add_argument("--url", help="Relay to measure, instead of starting one")
+    run_parser.add_argument("--port", type=int, default=8765)
+    run_parser.add_argument("--ws-workers", type=int, default=1)
+    run_parser.add_argument("--relay-log", help="File for the started relay's output")
+    run_parser.add_argument("--clients", type=int, default=20)
+    run_parser.add_argument("--publishers", type=int, default=4)
+    run_parser.add_argument("--publish-rate", type=float, default=50)
+    run_parser.add_argument("--req-rate", type=float, default=20)
+    run_parser.add_argument(
+        "--req-mix",
+        type=parse_mix,
+        default="kinds=2,authors=1,tag=1,ids=1,window=1",
+        help="Weighted REQ shapes out of " + ", ".join(REQ_SHAPES),
+    )
+    run_parser.add_argument("--duration", type=float, default=30)
+    run_parser.add_argument(
+        "--drain", type=float, default=3, help="Seconds to wait for late replies"
+    )
+    run_parser.add_argument("--output", help="Also write the JSON result to this file")
+    run_parser.set_defaults(handler=run_command)
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.set_defaults(handler=compare_command)
+
+    args = parser.parse_args()
+    args.handler(args)
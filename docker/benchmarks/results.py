@@ -0,0 +1,57 @@
+import datetime
+import statistics
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Any]:
+    """Summarises latency samples in milliseconds; empty lists give nulls."""
+    if not samples:
+        return {"count": 0, "mean": None, "p50": None, "p99": None, "max": None}
+    return {
+        "count": len(samples),
+        "mean": round(statistics.fmean(samples), 2),
+        "p50": round(percentile(samples, 0.50), 2),
+        "p99": round(percentile(samples, 0.99), 2),
+        "max": round(max(samples), 2),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(result: Dict[str, Any], output: Optional[str]) -> str:
+    """
+    Adds the git revision and a timestamp to ``result``, prints it and writes
+    it to ``output`` (created with its parent directories) when given.
+    """
+    result.setdefault("revision", git_revision())
+    result.setdefault(
+        "finished_at",
+        datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    )
+    text = orjson.dumps(result, option=orjson.OPT_INDENT_2).decode()
+    if output:
+        path = Path(output)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text + "\n")
+    print(text)
+    return text
@@ -0,0 +1,136 @@
+"""
+Loads signed events into a storage backend directly, without the HTTP or
+websocket layers, and prints insert throughput and per-shape query latency
+as JSON.
+
+Run it once per backend on the same machine to compare them, for example:
+
+    python storage_benchmark.py --backend sqlite --sqlite-path /tmp/bench.sqlite3 --events 20000
+    python storage_benchmark.py --backend postgres --events 20000
+
+The postgres backend reads the PG*_WRITE and PG*_READ environment variables
+and writes into that database, so point it at a scratch one.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import orjson
+
+from nostr_events import signed_events
+from results import latency_summary, save_results
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "nostpy_relay"))
+from event_classes import Event  # noqa: E402
+from event_storage import create_storage  # noqa: E402
+
+logger = logging.getLogger("storage_benchmark")
+logging.basicConfig(level=logging.WARNING)
+
+
+def conn_str(suffix):
+    return (
+        f"dbname={os.getenv(f'PGDATABASE_{suffix}')} "
+        f"user={os.getenv(f'PGUSER_{suffix}')} "
+        f"password={os.getenv(f'PGPASSWORD_{suffix}')} "
+        f"host={os.getenv(f'PGHOST_{suffix}')} "
+        f"port={os.getenv(f'PGPORT_{suffix}')} "
+    )
+
+
+def query_shapes(events):
+    """The REQ filter shapes relay_benchmark sends, built from the loaded events."""
+    pubkeys = sorted({event["pubkey"] for event in events})
+    tagged = [event for event in events if event["tags"]]
+    newest = max(event["created_at"] for event in events)
+    return {
+        "kinds": lambda: {"kinds": [1], "limit": 50},
+        "authors": lambda: {"authors": random.sample(pubkeys, 3), "limit": 50},
+        "tag": lambda: {"#t": [random.choice(tagged)["tags"][0][1]], "limit": 50},
+        "ids": lambda: {"ids": [e["id"] for e in random.sample(events, 10)]},
+        "window": lambda: {"since": newest - 600, "until": newest, "limit": 100},
+    }
+
+
+async def run(backend, events, queries, concurrency, sqlite_path):
+    storage = create_storage(
+        backend,
+        logger,
+        write_conninfo=conn_str("WRITE"),
+        read_conninfo=conn_str("READ"),
+        sqlite_path=sqlite_path,
+    )
+    await storage.open()
+    try:
+        generated = signed_events(events, tags=[["t", "storagebench"]])
+        records = [Event.from_raw(orjson.dumps(event)) for event in generated]
+
+        insert_latencies = []
+
+        async def insert(batch):
+            for record in batch:
+                start = time.perf_counter()
+                await storage.add_event(record)
+                insert_latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(insert(records[i::concurrency]) for i in range(concurrency))
+        )
+        insert_elapsed = time.perf_counter() - start
+
+        query_results = {}
+        for shape, make_filter in query_shapes(generated).items():
+            latencies, rows = [], 0
+
+            async def query(count):
+                nonlocal rows
+                for _ in range(count):
+                    start = time.perf_counter()
+                    result = await storage.query(make_filter())
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    rows += len(result.events)
+
+            await asyncio.gather(
+                *(query(queries // concurrency) for _ in range(concurrency))
+            )
+            query_results[shape] = {
+                "latency_ms": latency_summary(latencies),
+                "mean_rows": round(rows / max(len(latencies), 1), 1),
+            }
+        stats = storage.stats()
+    finally:
+        await storage.close()
+
+    return {
+        "benchmark": "storage",
+        "backend": backend,
+        "events": events,
+        "concurrency": concurrency,
+        "insert_elapsed_s": round(insert_elapsed, 3),
+        "inserts_per_s": round(events / insert_elapsed, 1),
+        "insert_latency_ms": latency_summary(insert_latencies),
+        "queries": query_results,
+        "storage": stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", choices=["postgres", "sqlite"], default="sqlite")
+    parser.add_argument("--sqlite-path", default="storage-benchmark.sqlite3")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=500, help="Queries per shape")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--output", help="Also write the JSON result to this file")
+    args = parser.parse_args()
+    result = asyncio.run(
+        run(args.backend, args.events, args.queries, args.concurrency, args.sqlite_path)
+    )
+    save_results(result, args.output)
@@ -15,6 +15,11 @@ if [ -z "$SVC_PORT" ]; then
     exit 1
 fi
 
+# Defaults for the NIP-11 limitation fields, matching the websocket handler's
+export QUERY_MAX_LIMIT="${QUERY_MAX_LIMIT:-5000}"
+export WS_MAX_SUBSCRIPTIONS="${WS_MAX_SUBSCRIPTIONS:-20}"
+export WS_MAX_FILTERS="${WS_MAX_FILTERS:-10}"
+
 mkdir -p /etc/nginx/sites-available
 mkdir -p /etc/nginx/sites-enabled
 
@@ -33,7 +38,7 @@ else
 fi
 
 # Replace placeholders in the Nginx configuration template with the actual environment variables
-envsubst '${DOMAIN} ${DOCKER_SVC} ${SVC_PORT} ${ADMIN_PUBKEY} ${CONTACT} ${VERSION} ${ICON} ${WS_HANDLER_SVC}' < /etc/nginx/nginx.conf.template > /etc/nginx/sites-available/$DOMAIN.conf
+envsubst '${DOMAIN} ${DOCKER_SVC} ${SVC_PORT} ${ADMIN_PUBKEY} ${CONTACT} ${VERSION} ${ICON} ${WS_HANDLER_SVC} ${QUERY_MAX_LIMIT} ${WS_MAX_SUBSCRIPTIONS} ${WS_MAX_FILTERS}' < /etc/nginx/nginx.conf.template > /etc/nginx/sites-available/$DOMAIN.conf
 
 # Create a symbolic link to the sites-enabled directory if it doesn't already exist
 if [ ! -f /etc/nginx/sites-enabled/$DOMAIN.conf ]; then
@@ -1,10 +1,32 @@
 import asyncio
 import json
 import orjson
-from typing import List, Tuple, Dict
+import re
+from typing import Any, List, Optional, Set, Tuple, Dict
 from fastapi.responses import ORJSONResponse
+from psycopg.types.json import Jsonb
 import secp256k1
 
+from utils import kind_class
+
+# Filters without a limit get this many events
+QUERY_DEFAULT_LIMIT = 100
+HEX_ID = re.compile(r"[0-9a-f]{64}")
+# Filter keys matched against a column, after authors, kinds and ids are mapped
+FILTER_COLUMNS = ("pubkey", "kind", "id")
+# Condition on a write that only lets it through for web of trust members
+TRUSTED_AUTHOR = "EXISTS (SELECT 1 FROM trust_network WHERE pubkey = %s)"
+
+
+def count_sketch_key(kind: int, tag: str, value: str) -> str:
+    """Redis key of the HyperLogLog sketch counting kind ``kind`` events tagged ``tag`` = ``value``."""
+    return f"hll:{kind}:{tag}:{value}"
+
+
+def replaceable_cache_key(kind: int, pubkey: str) -> str:
+    """Redis key caching the current kind ``kind`` event of ``pubkey``."""
+    return f"rep:{kind}:{pubkey}"
+
 
 class Event:
     """
@@ -18,13 +40,32 @@ class Event:
         tags (List): A list of tags associated with the event.
         content (str): The content of the event.
         sig (str): The signature of the event.
+        raw (Optional[bytes]): The event JSON as received from the client, reused for storage and publishing.
+
+    The database methods only send their statements; the caller commits, so
+    that several of them can share one transaction and one round trip in
+    pipeline mode.
 
     Methods:
-        delete_check: Checks and deletes the event from the database.
+        from_raw: Builds an event from its JSON bytes, parsing them at most once.
+        delete_check: Deletes the author's previous event of the same kind.
         add_event: Adds the event to the database.
+        count_sketch_entries: Lists the COUNT sketches the event is added to.
+        evt_result: Builds the response body and HTTP status for the event.
         evt_response: Builds and returns the JSON response for the event.
     """
 
+    __slots__ = (
+        "event_id",
+        "pubkey",
+        "kind",
+        "created_at",
+        "tags",
+        "content",
+        "sig",
+        "raw",
+    )
+
     def __init__(
         self,
         event_id: str,
@@ -34,6 +75,7 @@ class Event:
         tags: List,
         content: str,
         sig: str,
+        raw: Optional[bytes] = None,
     ) -> None:
         self.event_id = event_id
         self.pubkey = pubkey
@@ -42,6 +84,44 @@ class Event:
         self.tags = tags
         self.content = content
         self.sig = sig
+        self.raw = raw
+
+    @classmethod
+    def from_raw(
+        cls, raw: bytes, event_dict: Optional[Dict[str, Any]] = None
+    ) -> "Event":
+        """
+        Builds an event from the JSON bytes sent by the client.
+
+        Args:
+            raw (bytes): The event JSON.
+            event_dict (Optional[Dict[str, Any]]): The already decoded event, if the caller has it.
+
+        Returns:
+            Event: The event, keeping ``raw`` for storage and publishing.
+        """
+        if event_dict is None:
+            event_dict = orjson.loads(raw)
+        return cls(
+            event_id=event_dict["id"],
+            pubkey=event_dict["pubkey"],
+            kind=event_dict["kind"],
+            created_at=event_dict["created_at"],
+            tags=event_dict["tags"],
+            content=event_dict["content"],
+            sig=event_dict["sig"],
+            raw=raw,
+        )
+
+    def tags_param(self):
+        """
+        Returns the tags as a query parameter. When the original JSON is
+        available it is sent as is and Postgres extracts the tags from it,
+        so the tags are never re-encoded.
+        """
+        if self.raw is not None:
+            return Jsonb(self.raw, dumps=bytes)
+        return orjson.dumps(self.tags).decode("utf-8")
 
     def __str__(self) -> str:
         return f"{self.event_id}, {self.pubkey}, {self.kind}, {self.created_at}, {self.tags}, {self.content}, {self.sig} "
@@ -63,13 +143,16 @@ class Event:
             logger.error(f"Error verifying signature for event {self.event_id}: {e}")
             return False
 
-    async def delete_check(self, conn, cur) -> None:
+    async def delete_check(self, conn, cur, trusted_only: bool = False) -> None:
         delete_query = """
         DELETE FROM events
-        WHERE pubkey = %s AND kind = %s;
+        WHERE pubkey = %s AND kind = %s
         """
-        await cur.execute(delete_query, (self.pubkey, self.kind))
-        await conn.commit()
+        params: Tuple = (self.pubkey, self.kind)
+        if trusted_only:
+            delete_query += f" AND {TRUSTED_AUTHOR}"
+            params += (self.pubkey,)
+        await cur.execute(delete_query, params)
 
     def parse_kind5(self) -> List:
         event_values = [array[1] for array in self.tags]
@@ -82,7 +165,6 @@ class Event:
         """
         event_ids = [event_id for event_id in delete_events]
         await cur.execute(delete_statement, (event_ids, self.pubkey))
-        await conn.commit()
 
     async def admin_delete(self, conn, cur, delete_pub):
         delete_statement = """
@@ -90,24 +172,34 @@ class Event:
         WHERE pubkey = %s;
         """
         await cur.execute(delete_statement, (delete_pub,))
-        await conn.commit()
 
-    async def add_event(self, conn, cur) -> None:
+    async def add_event(self, conn, cur, trusted_only: bool = False) -> None:
+        """
+        Inserts the event. With ``trusted_only`` nothing is inserted, and the
+        cursor's rowcount is 0, unless the author is in the trust network.
+        """
+        tags_column = "%s -> 'tags'" if self.raw is not None else "%s::jsonb"
+        values = f"%s, %s, %s, %s, {tags_column}, %s, %s"
+        params: Tuple = (
+            self.event_id,
+            self.pubkey,
+            self.kind,
+            self.created_at,
+            self.tags_param(),
+            self.content,
+            self.sig,
+        )
+        if trusted_only:
+            source = f"SELECT {values} WHERE {TRUSTED_AUTHOR}"
+            params += (self.pubkey,)
+        else:
+            source = f"VALUES ({values})"
         await cur.execute(
-            """
-            INSERT INTO events (id,pubkey,kind,created_at,tags,content,sig) VALUES (%s, %s, %s, %s, %s, %s, %s)
+            f"""
+            INSERT INTO events (id,pubkey,kind,created_at,tags,content,sig) {source}
             """,
-            (
-                self.event_id,
-                self.pubkey,
-                self.kind,
-                self.created_at,
-                json.dumps(self.tags),
-                self.content,
-                self.sig,
-            ),
+            params,
         )
-        await conn.commit()
 
     async def add_mgmt_event(self, conn, cur) -> None:
         await cur.execute(
@@ -124,7 +216,6 @@ class Event:
                 self.sig,
             ),
         )
-        await conn.commit()
 
     async def parse_mgmt_event(self, conn, cur):
         for list in self.tags:
@@ -160,8 +251,6 @@ class Event:
             (self.event_id, conflict_value, bool),
         )
 
-        await conn.commit()
-
     async def check_wot(self, cur):
         await cur.execute(
             f"""
@@ -170,14 +259,41 @@ class Event:
         )
         return await cur.fetchone()
 
-    def evt_response(self, results_status, http_status_code, message=""):
+    def count_sketch_entries(
+        self, sketch_kinds: Set[int], sketch_tags: Set[str]
+    ) -> List[Tuple[str, str]]:
+        """
+        Lists the HyperLogLog sketches this event is added to, as (key,
+        element) pairs: one per distinct value of each sketched tag, when the
+        kind is sketched. A replaceable event is added as its author, so a
+        contact list counts once however often it is replaced.
+        """
+        if self.kind not in sketch_kinds:
+            return []
+        element = (
+            self.pubkey if kind_class(self.kind) == "replaceable" else self.event_id
+        )
+        keys = {
+            count_sketch_key(self.kind, tag[0], tag[1])
+            for tag in self.tags
+            if len(tag) > 1 and tag[0] in sketch_tags and isinstance(tag[1], str)
+        }
+        return [(key, element) for key in keys]
+
+    def evt_result(self, results_status, http_status_code, message=""):
         response = {
             "event": "OK",
             "subscription_id": self.event_id,
             "results_json": results_status,
             "message": message,
         }
-        return ORJSONResponse(content=response, status_code=http_status_code)
+        return response, http_status_code
+
+    def evt_response(self, results_status, http_status_code, message=""):
+        response, status_code = self.evt_result(
+            results_status, http_status_code, message
+        )
+        return ORJSONResponse(content=response, status_code=status_code)
 
 
 class Subscription:
@@ -187,8 +303,11 @@ class Subscription:
     Attributes:
         filters (dict): Dictionary containing filters for the subscription.
         subscription_id (str): The ID of the subscription.
-        where_clause (str): The WHERE clause of the base SQL query.
+        where_clause (str): The WHERE clause of the base SQL query, with %s placeholders.
+        where_params (List): The values bound to the placeholders of ``where_clause``.
         base_query (str): The base SQL query for fetching events.
+        count_query (str): The SQL query counting the events of a COUNT filter.
+        params (List): The values bound to the last query built.
         column_names (List): List of column names for event attributes.
 
     Methods:
@@ -200,6 +319,9 @@ class Subscription:
         query_result_parser: Parses the query result and adds columns accordingly.
         fetch_data_from_cache: Fetches data from cache based on the provided Redis key.
         parse_filters: Parses and sanitizes filters to generate tag values and query parts.
+        count_query_builder: Builds the SQL query for a NIP-45 COUNT filter.
+        count_sketch_keys: Finds the HyperLogLog sketches that answer a COUNT filter.
+        sub_result: Builds the response body and HTTP status for the subscription.
         sub_response_builder: Builds and returns the JSON response for the subscription.
     """
 
@@ -207,6 +329,8 @@ class Subscription:
         self.filters = request_payload.get("event_dict", {})
         self.subscription_id = request_payload.get("subscription_id")
         self.where_clause = ""
+        self.where_params: List[Any] = []
+        self.params: List[Any] = []
         self.column_names = [
             "id",
             "pubkey",
@@ -217,24 +341,27 @@ class Subscription:
             "sig",
         ]
 
-    def _generate_tag_clause(self, tags) -> str:
+    def _generate_tag_clause(self, tags) -> Tuple[str, List]:
         tag_clause = (
             " EXISTS ( SELECT 1 FROM jsonb_array_elements(tags) as elem WHERE {})"
         )
-        conditions = [f"elem @> '{tag_pair}'" for tag_pair in tags]
+        conditions = ["elem @> %s::jsonb" for _ in tags]
 
         complete_cluase = tag_clause.format(" OR ".join(conditions))
-        return complete_cluase
+        return complete_cluase, list(tags)
 
-    def _search_clause(self, search_item):
-        search_clause = f" EXISTS ( SELECT 1 FROM jsonb_array_elements(tags) as elem WHERE elem::text LIKE '%{search_item}%' OR content LIKE '%{search_item}%')"
-        return search_clause
+    def _search_clause(self, search_item) -> Tuple[str, List]:
+        search_clause = " EXISTS ( SELECT 1 FROM jsonb_array_elements(tags) as elem WHERE elem::text LIKE %s OR content LIKE %s)"
+        pattern = f"%{search_item}%"
+        return search_clause, [pattern, pattern]
 
     async def _sanitize_event_keys(self, filters, logger) -> Dict:
         updated_keys = {}
         limit = ""
         global_search = {}
         try:
+            # Work on a copy, the caller may still hold the filters
+            filters = dict(filters)
             logger.debug(f"filters in san is {filters}")
             try:
                 limit = filters.get("limit", 100)
@@ -273,6 +400,12 @@ class Subscription:
             return updated_keys, limit, global_search
 
     async def _parse_sanitized_keys(self, updated_keys, logger) -> Tuple[List, List]:
+        """
+        Splits sanitized filter keys into tag pairs and (condition, values)
+        query parts. Values are bound as parameters, never pasted into the
+        SQL; a key that is not a column is ignored, and a column filter that
+        is not a list matches nothing.
+        """
         query_parts = []
         tag_values = []
 
@@ -292,21 +425,24 @@ class Subscription:
 
                 elif item in ["since", "until"]:
                     if item == "since":
-                        since = f'created_at > {updated_keys["since"]}'
-                        query_parts.append(since)
+                        since = int(updated_keys["since"])
+                        query_parts.append(("created_at >= %s", [since]))
                         outer_break = True
                         continue
                     elif item == "until":
-                        until = f'created_at < {updated_keys["until"]}'
-                        query_parts.append(until)
+                        until = int(updated_keys["until"])
+                        query_parts.append(("created_at <= %s", [until]))
                         outer_break = True
                         continue
 
-                if outer_break:
+                if outer_break or item not in FILTER_COLUMNS:
                     continue
 
-                array_search = f"{item} = ANY(ARRAY {updated_keys[item]})"
-                query_parts.append(array_search)
+                values = updated_keys[item]
+                if not isinstance(values, list):
+                    query_parts.append(("FALSE", []))
+                    continue
+                query_parts.append((f"{item} = ANY(%s)", [values]))
 
             return tag_values, query_parts
         except Exception as exc:
@@ -379,45 +515,157 @@ class Subscription:
             )
             return tag_values, query_parts, limit, global_search
         else:
-            return {}, {}, None, {}
+            return {}, {}, limit, {}
 
-    def base_query_builder(self, tag_values, query_parts, limit, global_search, logger):
-        try:
-            if query_parts:
-                self.where_clause = " AND ".join(query_parts)
+    def _where_clause_builder(self, tag_values, query_parts, global_search) -> str:
+        """Builds ``where_clause`` and the ``where_params`` bound to it."""
+        self.where_clause = ""
+        self.where_params = []
+        if query_parts:
+            self.where_clause = " AND ".join(part for part, _ in query_parts)
+            for _, values in query_parts:
+                self.where_params.extend(values)
+
+        if tag_values:
+            tag_clause, tag_params = self._generate_tag_clause(tag_values)
+            if self.where_clause:
+                self.where_clause += f" AND {tag_clause}"
+            else:
+                self.where_clause += f"{tag_clause}"
+            self.where_params.extend(tag_params)
 
-            if tag_values:
-                tag_clause = self._generate_tag_clause(tag_values)
-                if self.where_clause:
-                    self.where_clause += f" AND {tag_clause}"
-                else:
-                    self.where_clause += f"{tag_clause}"
+        if global_search:
+            search_clause, search_params = self._search_clause(global_search)
+            if self.where_clause:
+                self.where_clause += f" AND {search_clause}"
+            else:
+                self.where_clause += f"{search_clause}"
+            self.where_params.extend(search_params)
+        return self.where_clause
+
+    def _cursor_clause(self, cursor) -> Tuple[str, List]:
+        created_at, event_id = int(cursor[0]), str(cursor[1])
+        if not HEX_ID.fullmatch(event_id):
+            raise ValueError(f"invalid cursor event ID: {event_id}")
+        return "(created_at, id) < (%s, %s)", [created_at, event_id]
 
-            if global_search:
-                search_clause = self._search_clause(global_search)
+    def base_query_builder(
+        self,
+        tag_values,
+        query_parts,
+        limit,
+        global_search,
+        logger,
+        max_limit: int = QUERY_DEFAULT_LIMIT,
+        cursor: Optional[Tuple[int, str]] = None,
+    ):
+        """
+        Builds the SELECT for one filter, newest first with the event ID as a
+        tie-breaker so the order is stable. ``cursor`` is the (created_at, id)
+        of the last event already sent; the query then continues strictly
+        after it, which lets large limits be read in keyset pages. The
+        values to bind are left in ``params``.
+        """
+        try:
+            self._where_clause_builder(tag_values, query_parts, global_search)
+            if cursor:
+                cursor_clause, cursor_params = self._cursor_clause(cursor)
                 if self.where_clause:
-                    self.where_clause += f" AND {search_clause}"
+                    self.where_clause += f" AND {cursor_clause}"
                 else:
-                    self.where_clause += f"{search_clause}"
+                    self.where_clause = cursor_clause
+                self.where_params.extend(cursor_params)
 
-            if not limit or limit > 100:
-                limit = 100
+            if not isinstance(limit, int) or limit <= 0:
+                limit = QUERY_DEFAULT_LIMIT
+            limit = min(limit, max_limit)
 
-            self.base_query = f"SELECT * FROM events WHERE {self.where_clause} ORDER BY created_at DESC LIMIT {limit} ;"
+            where = f"WHERE {self.where_clause} " if self.where_clause else ""
+            self.base_query = f"SELECT * FROM events {where}ORDER BY created_at DESC, id DESC LIMIT {limit} ;"
+            self.params = list(self.where_params)
             logger.debug(f"SQL query constructed: {self.base_query}")
             return self.base_query
         except Exception as exc:
             logger.error(f"Error building query: {exc}", exc_info=True)
             return None
 
+    def count_query_builder(
+        self, tag_values, query_parts, limit, global_search, logger
+    ) -> str:
+        """
+        Builds the NIP-45 COUNT query for one filter. It selects no columns,
+        so filters on indexed columns are answered by an index-only scan, and
+        ``limit`` does not apply. The values to bind are left in ``params``.
+        """
+        self._where_clause_builder(tag_values, query_parts, global_search)
+        self.count_query = "SELECT COUNT(*) FROM events"
+        if self.where_clause:
+            self.count_query += f" WHERE {self.where_clause}"
+        self.params = list(self.where_params)
+        logger.debug(f"SQL count query constructed: {self.count_query}")
+        return self.count_query
+
+    def count_sketch_keys(
+        self, filters: Dict[str, Any], sketch_kinds: Set[int], sketch_tags: Set[str]
+    ) -> Optional[List[str]]:
+        """
+        Returns the sketch keys that answer a COUNT filter, or None when
+        ingest keeps no sketch for its shape. Sketches cover one sketched
+        kind with one sketched tag, e.g. ``{"kinds": [3], "#p": [pubkey]}``
+        for followers or ``{"kinds": [7], "#e": [event_id]}`` for reactions.
+        """
+        kinds = filters.get("kinds")
+        if not isinstance(kinds, list) or len(kinds) != 1:
+            return None
+        if kinds[0] not in sketch_kinds:
+            return None
+        others = [key for key in filters if key not in ("kinds", "limit")]
+        if len(others) != 1 or not others[0].startswith("#"):
+            return None
+        tag, values = others[0][1:], filters[others[0]]
+        if tag not in sketch_tags or not isinstance(values, list) or not values:
+            return None
+        if not all(isinstance(value, str) for value in values):
+            return None
+        return [count_sketch_key(kinds[0], tag, value) for value in values]
+
+    def replaceable_pairs(
+        self, filters: Dict[str, Any], cached_kinds: Set[int]
+    ) -> Optional[List[Tuple[int, str]]]:
+        """
+        Returns the (kind, pubkey) pairs a profile or contact list lookup asks
+        for, or None when the filter is not one. A lookup has authors, only
+        cached kinds, and at most since, until and limit besides.
+        """
+        kinds = filters.get("kinds")
+        authors = filters.get("authors")
+        if not isinstance(kinds, list) or not isinstance(authors, list):
+            return None
+        if not kinds or not authors or not set(kinds) <= cached_kinds:
+            return None
+        lookup_keys = ("kinds", "authors", "since", "until", "limit")
+        if any(key not in lookup_keys for key in filters):
+            return None
+        if not all(isinstance(pubkey, str) for pubkey in authors):
+            return None
+        return [
+            (kind, pubkey)
+            for kind in dict.fromkeys(kinds)
+            for pubkey in dict.fromkeys(authors)
+        ]
+
+    def sub_result(self, event_type, subscription_id, results_json, http_status_code):
+        response = {
+            "event": event_type,
+            "subscription_id": subscription_id,
+            "results_json": results_json,
+        }
+        return response, http_status_code
+
     def sub_response_builder(
         self, event_type, subscription_id, results_json, http_status_code
     ):
-        return ORJSONResponse(
-            content={
-                "event": event_type,
-                "subscription_id": subscription_id,
-                "results_json": results_json,
-            },
-            status_code=http_status_code,
+        response, status_code = self.sub_result(
+            event_type, subscription_id, results_json, http_status_code
         )
+        return ORJSONResponse(content=response, status_code=status_code)
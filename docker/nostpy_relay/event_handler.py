@@ -1,30 +1,53 @@
 import asyncio
 import logging
 import os
+import socket
+import time
 from contextlib import asynccontextmanager
-from typing import Any, Callable, Dict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import psycopg
 import redis.asyncio as redis
 import uvicorn
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from opentelemetry import trace
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, Response
+from opentelemetry import metrics, trace
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.redis import RedisInstrumentor
 from opentelemetry.metrics import Observation
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.semconv.trace import SpanAttributes
 import orjson
-from psycopg_pool import AsyncConnectionPool
 
-from event_classes import Event, Subscription
+from event_classes import (
+    Event,
+    Subscription,
+    count_sketch_key,
+    replaceable_cache_key,
+)
+from event_storage import (
+    DuplicateEvent,
+    StorageBusy,
+    UntrustedAuthor,
+    create_storage,
+)
 from init_db import initialize_db
-from otel_metric_base.otel_metrics import OtelMetricBase
-from utils import LimitedDict
+from negentropy import pack_items
+from profiling import CaptureBusy, process_sizes, profile_for, tracemalloc_diff
+from query_log import SlowQueryLog
+from query_scheduler import LaneBusy, QueryScheduler
+from utils import (
+    STAGE_BUCKETS_MS,
+    LimitedDict,
+    StageTimer,
+    admin_authorized,
+    kind_class,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -36,28 +59,125 @@ logger.addHandler(handler)
 
 WOT_ENABLED = os.getenv("WOT_ENABLED")
 REDIS_CHANNEL = "new_events_channel"
+# Set by a websocket handler that already verified the event's signature.
+# Only websocket handlers can reach the event handler, so it is trusted.
+SIGNATURE_VERIFIED_HEADER = "X-Signature-Verified"
+# Published after an event could not be, telling websocket handlers that
+# their hot timelines may be missing events
+FANOUT_GAP = b"gap"
+EVENT_HANDLER_WORKERS = int(os.getenv("EVENT_HANDLER_WORKERS", 1))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 250))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", 0.1))
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", 100))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "nostpy.sqlite3")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", 4))
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", 500))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_RECENT_SECONDS = float(os.getenv("REPLICA_RECENT_SECONDS", 600))
+REPLICA_PROBE_INTERVAL = float(os.getenv("REPLICA_PROBE_INTERVAL", 2))
+PG_WRITE_POOL_MIN = int(os.getenv("PG_WRITE_POOL_MIN", 4))
+PG_WRITE_POOL_MAX = int(os.getenv("PG_WRITE_POOL_MAX", 10))
+PG_READ_POOL_MIN = int(os.getenv("PG_READ_POOL_MIN", 4))
+PG_READ_POOL_MAX = int(os.getenv("PG_READ_POOL_MAX", 20))
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", 3))
+PG_POOL_MAX_WAITING = int(os.getenv("PG_POOL_MAX_WAITING", 0))
+QUERY_LANE_CHEAP = int(os.getenv("QUERY_LANE_CHEAP", 12))
+QUERY_LANE_NORMAL = int(os.getenv("QUERY_LANE_NORMAL", 6))
+QUERY_LANE_EXPENSIVE = int(os.getenv("QUERY_LANE_EXPENSIVE", 2))
+QUERY_CHEAP_COST = float(os.getenv("QUERY_CHEAP_COST", 1000))
+QUERY_EXPENSIVE_COST = float(os.getenv("QUERY_EXPENSIVE_COST", 10000))
+QUERY_MAX_COST = float(os.getenv("QUERY_MAX_COST", 250000))
+QUERY_QUEUE_TIMEOUT = float(os.getenv("QUERY_QUEUE_TIMEOUT", 5))
+NEG_MAX_RECORDS = int(os.getenv("NEG_MAX_RECORDS", 200000))
+COUNT_SKETCH_SEED_MAX = int(os.getenv("COUNT_SKETCH_SEED_MAX", 200000))
+COUNT_SKETCH_SECONDS = int(os.getenv("COUNT_SKETCH_SECONDS", 30 * 86400))
+# A seed that has not finished by then is taken over by the next COUNT
+COUNT_SKETCH_SEED_LOCK_SECONDS = 300
+COUNT_CACHE_SECONDS = int(os.getenv("COUNT_CACHE_SECONDS", 60))
+COUNT_SKETCH_KINDS = {
+    int(kind)
+    for kind in os.getenv("COUNT_SKETCH_KINDS", "3,6,7,9735").split(",")
+    if kind
+}
+COUNT_SKETCH_TAGS = {
+    tag for tag in os.getenv("COUNT_SKETCH_TAGS", "p,e").split(",") if tag
+}
+REPLACEABLE_CACHE_SECONDS = int(os.getenv("REPLACEABLE_CACHE_SECONDS", 3600))
+# How long a deletion keeps an author's replaceable entries off the cache;
+# longer than REPLICA_MAX_LAG, so later fills see the deletion
+REPLACEABLE_TOMBSTONE_SECONDS = int(os.getenv("REPLACEABLE_TOMBSTONE_SECONDS", 60))
+REPLACEABLE_TOMBSTONE = "deleted"
+# Kinds the storage backends replace in place, cached per author
+REPLACEABLE_CACHE_KINDS = {0, 3}
+# OK message for events rejected because every database connection is busy
+BUSY_MESSAGE = "rate-limited: relay is busy, try again later"
+# Each worker process reports its own series under this ID
+SERVICE_INSTANCE_ID = f"{socket.gethostname()}-eh{os.getpid()}"
 
 app = FastAPI()
 
-trace.set_tracer_provider(
-    TracerProvider(resource=Resource.create({"service.name": "event_handler_otel"}))
-)
+# Both resolve to the providers ``setup_telemetry`` installs, including
+# the instruments created on the meter before then
 tracer = trace.get_tracer(__name__)
+meter = metrics.get_meter("event-handler", version="1.0")
 
-otlp_exporter = OTLPSpanExporter(endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"))
-span_processor = BatchSpanProcessor(otlp_exporter)
-trace.get_tracer_provider().add_span_processor(span_processor)
 
-redis_tracer_provider = TracerProvider(
-    resource=Resource.create({"service.name": "redis"})
-)
-redis_otlp_exporter = OTLPSpanExporter()
-redis_span_processor = BatchSpanProcessor(redis_otlp_exporter)
-redis_tracer_provider.add_span_processor(redis_span_processor)
-RedisInstrumentor().instrument(tracer_provider=redis_tracer_provider)
+def setup_telemetry() -> None:
+    """
+    Installs the trace and meter providers and their OTLP exporters.
+
+    Called from ``lifespan``, so it runs once in every process that serves
+    requests: not in the parent of several workers, and not again when a
+    worker imports this module a second time. Counters are kept per worker
+    process. The instance ID tells the series of different workers apart so
+    the collector can sum them instead of having workers overwrite each
+    other's points. Providers already installed in the process, such as the
+    websocket handler's in embedded mode, are kept.
+    """
+    if not isinstance(trace.get_tracer_provider(), TracerProvider):
+        tracer_provider = TracerProvider(
+            resource=Resource.create(
+                {
+                    "service.name": "event_handler_otel",
+                    "service.instance.id": SERVICE_INSTANCE_ID,
+                }
+            )
+        )
+        tracer_provider.add_span_processor(
+            BatchSpanProcessor(
+                OTLPSpanExporter(endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"))
+            )
+        )
+        trace.set_tracer_provider(tracer_provider)
+
+        redis_tracer_provider = TracerProvider(
+            resource=Resource.create({"service.name": "redis"})
+        )
+        redis_tracer_provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        RedisInstrumentor().instrument(tracer_provider=redis_tracer_provider)
+
+    if not isinstance(metrics.get_meter_provider(), MeterProvider):
+        metrics.set_meter_provider(
+            MeterProvider(
+                resource=Resource.create(
+                    {
+                        "service.name": "event-handler",
+                        "service.instance.id": SERVICE_INSTANCE_ID,
+                    }
+                ),
+                metric_readers=[
+                    PeriodicExportingMetricReader(
+                        OTLPMetricExporter(
+                            endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+                        )
+                    )
+                ],
+            )
+        )
 
 
-otel_metrics = OtelMetricBase(otlp_endpoint=os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT"))
 metric_counters = {
     "wot_event_reject": LimitedDict(max_size=500),
     "event_added": LimitedDict(max_size=500),
@@ -81,7 +201,7 @@ def create_observable_callback(counter_dict: Dict[str, Dict[str, Any]]) -> Calla
 
 
 def register_metric(name: str, description: str):
-    otel_metrics.meter.create_observable_counter(
+    meter.create_observable_counter(
         name=name,
         description=description,
         callbacks=[create_observable_callback(metric_counters[name])],
@@ -93,6 +213,144 @@ register_metric("event_added", "Event added")
 register_metric("event_query", "Event query")
 
 
+def replica_callback(field: str) -> Callable:
+    """Observes one field of every read replica's stats, by replica name."""
+
+    def callback(_):
+        storage = getattr(app, "storage", None)
+        replicas = storage.stats().get("replicas", []) if storage else []
+        return [
+            Observation(replica[field], {"replica": replica["name"]})
+            for replica in replicas
+        ]
+
+    return callback
+
+
+meter.create_observable_gauge(
+    name="replica_lag",
+    description="Replay lag of each read replica at its last probe",
+    unit="s",
+    callbacks=[replica_callback("lag_seconds")],
+)
+meter.create_observable_gauge(
+    name="replica_query_latency",
+    description="Moving average of read time on each read replica and the primary",
+    unit="ms",
+    callbacks=[replica_callback("query_ms")],
+)
+meter.create_observable_gauge(
+    name="replica_probe_latency",
+    description="Round trip of the last health probe of each read replica",
+    unit="ms",
+    callbacks=[replica_callback("probe_ms")],
+)
+
+
+def pool_callback(field: str) -> Callable:
+    """Observes one field of every connection pool, by pool role and server."""
+
+    def callback(_):
+        storage = getattr(app, "storage", None)
+        pools = storage.pool_stats() if storage else []
+        return [
+            Observation(pool[field], {"pool": pool["role"], "server": pool["server"]})
+            for pool in pools
+        ]
+
+    return callback
+
+
+meter.create_observable_gauge(
+    name="db_pool_size",
+    description="Open connections in each database connection pool",
+    callbacks=[pool_callback("size")],
+)
+meter.create_observable_gauge(
+    name="db_pool_in_use",
+    description="Connections of each database pool that are checked out or still connecting",
+    callbacks=[pool_callback("in_use")],
+)
+meter.create_observable_gauge(
+    name="db_pool_waiting",
+    description="Requests queued for a connection of each database connection pool",
+    callbacks=[pool_callback("waiting")],
+)
+pool_wait_histogram = meter.create_histogram(
+    name="db_pool_wait",
+    description="Time spent waiting to check a connection out of a pool",
+    unit="ms",
+    explicit_bucket_boundaries_advisory=STAGE_BUCKETS_MS,
+)
+
+
+def observe_pool_wait(role: str, server: str, wait_ms: float) -> None:
+    pool_wait_histogram.record(wait_ms, {"pool": role, "server": server})
+
+
+def lane_callback(field: str) -> Callable:
+    """Observes one field of every query lane, by lane name."""
+
+    def callback(_):
+        lanes = query_scheduler.stats()["lanes"]
+        return [
+            Observation(lane[field], {"lane": name}) for name, lane in lanes.items()
+        ]
+
+    return callback
+
+
+meter.create_observable_gauge(
+    name="query_lane_running",
+    description="Storage queries running in each query lane",
+    callbacks=[lane_callback("running")],
+)
+meter.create_observable_gauge(
+    name="query_lane_waiting",
+    description="Storage queries queued for a slot of each query lane",
+    callbacks=[lane_callback("waiting")],
+)
+lane_wait_histogram = meter.create_histogram(
+    name="query_lane_wait",
+    description="Time a storage query waited for a slot of its query lane",
+    unit="ms",
+    explicit_bucket_boundaries_advisory=STAGE_BUCKETS_MS,
+)
+
+
+def observe_lane_wait(lane: str, wait_ms: float) -> None:
+    lane_wait_histogram.record(wait_ms, {"lane": lane})
+
+
+query_scheduler = QueryScheduler(
+    {
+        "cheap": QUERY_LANE_CHEAP,
+        "normal": QUERY_LANE_NORMAL,
+        "expensive": QUERY_LANE_EXPENSIVE,
+    },
+    cheap_cost=QUERY_CHEAP_COST,
+    expensive_cost=QUERY_EXPENSIVE_COST,
+    max_cost=QUERY_MAX_COST,
+    queue_timeout=QUERY_QUEUE_TIMEOUT,
+    page_size=QUERY_PAGE_SIZE,
+    wait_observer=observe_lane_wait,
+)
+
+slow_query_log = SlowQueryLog(
+    logger,
+    threshold_ms=SLOW_QUERY_MS,
+    explain_sample_rate=SLOW_QUERY_EXPLAIN_RATE,
+    max_entries=SLOW_QUERY_LOG_SIZE,
+)
+
+stage_histogram = meter.create_histogram(
+    name="relay_stage_duration",
+    description="Time spent in each hot-path stage, by stage, kind class and result",
+    unit="ms",
+    explicit_bucket_boundaries_advisory=STAGE_BUCKETS_MS,
+)
+
+
 def get_conn_str(db_suffix: str) -> str:
     return (
         f"dbname={os.getenv(f'PGDATABASE_{db_suffix}')} "
@@ -103,25 +361,85 @@ def get_conn_str(db_suffix: str) -> str:
     )
 
 
+def get_read_conn_strs() -> List[str]:
+    """
+    One connection string per read replica. PGHOST_READ may list several
+    replicas, comma-separated, as host or host:port; the other PG*_READ
+    settings are shared.
+    """
+    hosts = os.getenv("PGHOST_READ")
+    if not hosts or ("," not in hosts and ":" not in hosts):
+        return [get_conn_str("READ")]
+    conn_strs = []
+    for entry in hosts.split(","):
+        host, _, port = entry.strip().partition(":")
+        conn_strs.append(
+            f"dbname={os.getenv('PGDATABASE_READ')} "
+            f"user={os.getenv('PGUSER_READ')} "
+            f"password={os.getenv('PGPASSWORD_READ')} "
+            f"host={host} "
+            f"port={port or os.getenv('PGPORT_READ')} "
+        )
+    return conn_strs
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_telemetry()
     conn_str_write = get_conn_str("WRITE")
-    conn_str_read = get_conn_str("READ")
-    logger.info(f"Write conn string is: {conn_str_write}")
-    logger.info(f"Read conn string is: {conn_str_read}")
-
-    # Define limits for the connection pools
-    app.write_pool = AsyncConnectionPool(
-        conninfo=conn_str_write,
-        timeout=30,  # Timeout in seconds for acquiring a connection
+    conn_strs_read = get_read_conn_strs()
+    if STORAGE_BACKEND == "postgres":
+        logger.info(f"Write conn string is: {conn_str_write}")
+        logger.info(f"Read conn strings are: {conn_strs_read}")
+
+    app.storage = create_storage(
+        STORAGE_BACKEND,
+        logger,
+        write_conninfo=conn_str_write,
+        read_conninfo=conn_strs_read,
+        sqlite_path=SQLITE_PATH,
+        sqlite_readers=SQLITE_READERS,
+        page_size=QUERY_PAGE_SIZE,
+        replica_max_lag=REPLICA_MAX_LAG,
+        replica_recent_seconds=REPLICA_RECENT_SECONDS,
+        replica_probe_interval=REPLICA_PROBE_INTERVAL,
+        write_pool_size=(PG_WRITE_POOL_MIN, PG_WRITE_POOL_MAX),
+        read_pool_size=(PG_READ_POOL_MIN, PG_READ_POOL_MAX),
+        pool_acquire_timeout=PG_POOL_TIMEOUT,
+        pool_max_waiting=PG_POOL_MAX_WAITING,
+        pool_wait_observer=observe_pool_wait,
     )
-    app.read_pool = AsyncConnectionPool(conninfo=conn_str_read, timeout=30)
+    await app.storage.open()
+    app.redis_client = create_redis_client()
 
     try:
         yield
     finally:
-        await app.write_pool.close()
-        await app.read_pool.close()
+        if fanout_gap_task is not None:
+            fanout_gap_task.cancel()
+        await app.redis_client.close()
+        await app.storage.close()
+
+
+def prepare_storage() -> None:
+    """
+    Creates the schema of the configured storage backend. Called once by the
+    parent process so that workers do not race to do it.
+    """
+    if STORAGE_BACKEND == "postgres":
+        logger.info(f"Write conn string is: {get_conn_str('WRITE')}")
+        logger.info(f"Read conn strings are: {get_read_conn_strs()}")
+        initialize_db(logger=logger, write_str=init_conn_str)
+        return
+
+    async def open_and_close():
+        storage = create_storage(
+            STORAGE_BACKEND, logger, sqlite_path=SQLITE_PATH, sqlite_readers=1
+        )
+        await storage.open()
+        await storage.close()
+
+    asyncio.run(open_and_close())
 
 
 app = FastAPI(lifespan=lifespan)
@@ -129,47 +447,163 @@ FastAPIInstrumentor.instrument_app(app)
 init_conn_str = get_conn_str("WRITE")
 
 
-async def set_span_attributes(
-    span, db_system: str, db_statement: str, service_name: str, operation_name: str
-):
-    span.set_attribute(SpanAttributes.DB_SYSTEM, db_system)
-    span.set_attribute(SpanAttributes.DB_STATEMENT, db_statement)
-    span.set_attribute("service.name", service_name)
-    span.set_attribute("operation.name", operation_name)
+def query_cache_key(filters: Dict[str, Any], prefix: str = "req") -> str:
+    """Cache key of one REQ or COUNT filter; key order does not matter."""
+    return f"{prefix}:" + orjson.dumps(filters, option=orjson.OPT_SORT_KEYS).decode()
 
 
-async def execute_sql_with_tracing(app, sql_query: str, span_name: str):
-    with tracer.start_as_current_span(span_name) as span:
-        current_span = trace.get_current_span()
-        await set_span_attributes(
-            current_span, "postgresql", sql_query, "postgres", "postgres.query"
-        )
-        async with app.read_pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(query=sql_query)
-                return await cur.fetchall()
+def redis_event_payload(event_json: bytes) -> bytes:
+    """
+    Builds the pub/sub payload for an event: the publish time in milliseconds,
+    a space, then the event JSON. The websocket handler uses the timestamp to
+    measure delivery latency and forwards the JSON part untouched.
+    """
+    return b"%d " % (time.time_ns() // 1_000_000) + event_json
+
+
+async def publish_event(
+    redis_client: redis.Redis, event_obj: Event, evt_class: str
+) -> None:
+    """
+    Publishes a stored event to the websocket handlers. The event is stored
+    by now, so a failure is logged and does not fail the ingest; the
+    handlers are then told to reload their hot timelines, which miss it.
+    """
+    try:
+        with StageTimer(stage_histogram, "redis_publish", evt_class):
+            await redis_client.publish(
+                REDIS_CHANNEL, redis_event_payload(event_obj.raw)
+            )
+        logger.info(f"Published event {event_obj.event_id} to Redis")
+    except Exception as exc:
+        logger.error(f"Could not publish event {event_obj.event_id}: {exc}")
+        report_fanout_gap(redis_client)
+
+
+fanout_gap_task: Optional[asyncio.Task] = None
+
 
+def report_fanout_gap(redis_client: redis.Redis) -> None:
+    """Starts announcing a fan-out gap, unless an announcement is pending."""
+    global fanout_gap_task
+    if fanout_gap_task is None or fanout_gap_task.done():
+        fanout_gap_task = asyncio.create_task(announce_fanout_gap(redis_client))
 
-async def get_redis_client() -> redis.Redis:
-    """Lazily initialize and return an async Redis client."""
-    return await redis.from_url(
+
+async def announce_fanout_gap(redis_client: redis.Redis) -> None:
+    """Publishes FANOUT_GAP, retrying with a backoff until Redis takes it."""
+    delay = 1.0
+    while True:
+        try:
+            await redis_client.publish(REDIS_CHANNEL, FANOUT_GAP)
+            logger.info("Announced fan-out gap to the websocket handlers")
+            return
+        except Exception as exc:
+            logger.warning(f"Could not announce fan-out gap: {exc}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+def create_redis_client() -> redis.Redis:
+    return redis.from_url(
         f"redis://{os.getenv('REDIS_HOST')}:{os.getenv('REDIS_PORT')}",
         decode_responses=True,
     )
 
 
-@app.post("/new_event")
-async def handle_new_event(request: Request) -> JSONResponse:
-    event_dict = orjson.loads(await request.body())
-    event_obj = Event(
-        event_id=event_dict["id"],
-        pubkey=event_dict["pubkey"],
-        kind=event_dict["kind"],
-        created_at=event_dict["created_at"],
-        tags=event_dict["tags"],
-        content=event_dict["content"],
-        sig=event_dict["sig"],
-    )
+async def get_redis_client(app: FastAPI) -> redis.Redis:
+    """
+    Returns the worker's Redis client. It is opened once in ``lifespan`` and
+    shared by every request, so callers must not close it.
+    """
+    return app.redis_client
+
+
+# Adds each element in ARGV to the sketch at the same position in KEYS, but
+# only to sketches that exist. COUNT creates a sketch when it seeds it from
+# storage; one that ingest created would look seeded while missing the
+# events stored before it.
+COUNT_SKETCH_ADD_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('PFADD', key, ARGV[i])
+    end
+end
+return 0
+"""
+
+
+async def update_count_sketches(redis_client: redis.Redis, event_obj: Event) -> None:
+    """
+    Adds a stored event to the HyperLogLog sketches behind approximate COUNT
+    replies, if they were seeded already. A failure is logged and does not
+    fail the ingest.
+    """
+    entries = event_obj.count_sketch_entries(COUNT_SKETCH_KINDS, COUNT_SKETCH_TAGS)
+    if not entries:
+        return
+    try:
+        add = redis_client.register_script(COUNT_SKETCH_ADD_SCRIPT)
+        await add(
+            keys=[key for key, _ in entries],
+            args=[element for _, element in entries],
+        )
+    except Exception as exc:
+        logger.error(f"Could not update count sketches for {event_obj.event_id}: {exc}")
+
+
+async def update_replaceable_cache(redis_client: redis.Redis, event_obj: Event) -> None:
+    """
+    Keeps the replaceable cache in step with storage after an event is
+    stored: a profile or contact list replaces the cached one, and a
+    deletion replaces the author's entries with tombstones, since it may
+    have targeted them. Until a tombstone expires, lookups read that entry
+    from the primary and do not cache it, so a lagging replica cannot put
+    a deleted event back. A failure is logged and does not fail the ingest.
+    """
+    try:
+        if event_obj.kind in REPLACEABLE_CACHE_KINDS:
+            await redis_client.set(
+                replaceable_cache_key(event_obj.kind, event_obj.pubkey),
+                event_obj.raw,
+                ex=REPLACEABLE_CACHE_SECONDS,
+            )
+        elif event_obj.kind == 5:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for kind in REPLACEABLE_CACHE_KINDS:
+                    pipe.set(
+                        replaceable_cache_key(kind, event_obj.pubkey),
+                        REPLACEABLE_TOMBSTONE,
+                        ex=REPLACEABLE_TOMBSTONE_SECONDS,
+                    )
+                await pipe.execute()
+    except Exception as exc:
+        logger.error(
+            f"Could not update replaceable cache for {event_obj.event_id}: {exc}"
+        )
+
+
+async def process_new_event(
+    app: FastAPI,
+    raw_event: bytes,
+    event_dict: Optional[Dict[str, Any]] = None,
+    verified: bool = False,
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Verifies, stores and publishes an event.
+
+    This is the ingest logic behind ``/new_event``. The embedded relay mode
+    calls it directly from the websocket handler, without the HTTP hop, and
+    passes the event it already decoded. The original JSON bytes are kept on
+    the event and reused for the insert and the Redis publish. An event
+    the websocket handler already ``verified`` is not verified again.
+
+    Returns:
+        Tuple[Dict[str, Any], int]: The OK response body and its HTTP status code.
+    """
+    with StageTimer(stage_histogram, "json_parse") as timer:
+        event_obj = Event.from_raw(raw_event, event_dict)
+        timer.kind_class = evt_class = kind_class(event_obj.kind)
     logger.debug(
         f"New event loop iter, event id is {event_obj.event_id} and kind is {event_obj.kind}"
     )
@@ -177,147 +611,387 @@ async def handle_new_event(request: Request) -> JSONResponse:
     try:
         with tracer.start_as_current_span("add_event") as span:
             current_span = trace.get_current_span()
-            current_span.set_attribute(SpanAttributes.DB_SYSTEM, "postgresql")
+            current_span.set_attribute(SpanAttributes.DB_SYSTEM, app.storage.name)
 
-            # Verify signature for all events before proceeding
-            if not event_obj.verify_signature(logger):
-                return event_obj.evt_response(
+            # Verify signature for all events before proceeding, unless the
+            # websocket handler did already
+            if not verified:
+                with StageTimer(
+                    stage_histogram, "signature_verify", evt_class
+                ) as timer:
+                    verified = event_obj.verify_signature(logger)
+                    timer.result = "ok" if verified else "invalid"
+            if not verified:
+                return event_obj.evt_result(
                     results_status="false",
                     http_status_code=400,
                     message="invalid: signature verification failed",
                 )
 
-            async with request.app.write_pool.connection() as conn:
-                async with conn.cursor() as cur:
-                    otel_tags = {
-                        "kind": event_obj.kind,
-                        "pubkey": event_obj.pubkey,
-                        "event_id": event_obj.event_id,
-                    }
-                    if WOT_ENABLED in ["True", "true"]:
-                        wot_check = await event_obj.check_wot(cur)
-                        if not wot_check:
-                            logger.debug(f"allow check failed: {wot_check}")
-                            increment_counter(
-                                otel_tags, metric_counters["wot_event_reject"]
-                            )
-                            return event_obj.evt_response(
-                                results_status="false",
-                                http_status_code=403,
-                                message="rejected: user is not in relay's web of trust",
-                            )
-
-                    redis_client = await get_redis_client()
-
-                    if event_obj.kind in [0, 3]:
-                        await event_obj.delete_check(conn, cur)
-                        await event_obj.add_event(conn, cur)
-                        await redis_client.publish(
-                            REDIS_CHANNEL, orjson.dumps(event_dict)
-                        )
-                        return event_obj.evt_response(
-                            results_status="true", http_status_code=200
-                        )
+            otel_tags = {"kind_class": evt_class}
+            # Inserts check the web of trust in the same statement; deletions
+            # check it first
+            trusted_only = WOT_ENABLED in ["True", "true"]
+            if trusted_only and event_obj.kind == 5:
+                with StageTimer(stage_histogram, "wot_check", evt_class) as timer:
+                    wot_check = await app.storage.check_wot(event_obj)
+                    timer.result = "ok" if wot_check else "rejected"
+                if not wot_check:
+                    raise UntrustedAuthor(event_obj.pubkey)
 
-                    if event_obj.kind == 5:
-                        events_to_delete = event_obj.parse_kind5()
-                        await event_obj.delete_event(conn, cur, events_to_delete)
-                        return event_obj.evt_response(
-                            results_status="true", http_status_code=200
-                        )
+            redis_client = await get_redis_client(app)
 
-                    else:
+            if event_obj.kind in [0, 3]:
+                with StageTimer(stage_histogram, "db_write", evt_class) as timer:
+                    try:
+                        await app.storage.replace_event(event_obj, trusted_only)
+                    except UntrustedAuthor:
+                        timer.result = "rejected"
+                        raise
+                await update_replaceable_cache(redis_client, event_obj)
+                await update_count_sketches(redis_client, event_obj)
+                await publish_event(redis_client, event_obj, evt_class)
+                return event_obj.evt_result(results_status="true", http_status_code=200)
+
+            if event_obj.kind == 5:
+                events_to_delete = event_obj.parse_kind5()
+                with StageTimer(stage_histogram, "db_write", evt_class):
+                    await app.storage.delete_events(event_obj, events_to_delete)
+                await update_replaceable_cache(redis_client, event_obj)
+                # Websocket handlers drop the targets from their hot timelines
+                await publish_event(redis_client, event_obj, evt_class)
+                return event_obj.evt_result(results_status="true", http_status_code=200)
+
+            else:
+                try:
+                    with StageTimer(stage_histogram, "db_write", evt_class) as timer:
                         try:
-                            await event_obj.add_event(conn, cur)
-                            increment_counter(otel_tags, metric_counters["event_added"])
-                            await redis_client.publish(
-                                REDIS_CHANNEL, orjson.dumps(event_dict)
-                            )
-                            logger.info(
-                                f"Published event {event_obj.event_id} to Redis"
-                            )
-                            return event_obj.evt_response(
-                                results_status="true", http_status_code=200
-                            )
-                        except psycopg.IntegrityError:
-                            await conn.rollback()
-                            logger.info(
-                                f"Event with ID {event_obj.event_id} already exists"
-                            )
-                            return event_obj.evt_response(
-                                results_status="false",
-                                http_status_code=409,
-                                message="duplicate: already have this event",
-                            )
-                        except Exception as exc:
-                            logger.error(f"Exception adding event {exc}")
-                            return event_obj.evt_response(
-                                results_status="false",
-                                http_status_code=400,
-                                message="error: failed to add event",
-                            )
+                            await app.storage.add_event(event_obj, trusted_only)
+                        except DuplicateEvent:
+                            timer.result = "duplicate"
+                            raise
+                        except UntrustedAuthor:
+                            timer.result = "rejected"
+                            raise
+                except DuplicateEvent:
+                    logger.info(f"Event with ID {event_obj.event_id} already exists")
+                    return event_obj.evt_result(
+                        results_status="false",
+                        http_status_code=409,
+                        message="duplicate: already have this event",
+                    )
+                except (StorageBusy, UntrustedAuthor):
+                    raise
+                except Exception as exc:
+                    logger.error(f"Exception adding event {exc}")
+                    return event_obj.evt_result(
+                        results_status="false",
+                        http_status_code=400,
+                        message="error: failed to add event",
+                    )
+                # Stored: from here on failures are logged and the event is OK
+                increment_counter(otel_tags, metric_counters["event_added"])
+                await update_count_sketches(redis_client, event_obj)
+                await publish_event(redis_client, event_obj, evt_class)
+                return event_obj.evt_result(results_status="true", http_status_code=200)
 
+    except UntrustedAuthor:
+        logger.debug(f"Author {event_obj.pubkey} is not in the web of trust")
+        increment_counter(
+            {"kind_class": evt_class}, metric_counters["wot_event_reject"]
+        )
+        return event_obj.evt_result(
+            results_status="false",
+            http_status_code=403,
+            message="rejected: user is not in relay's web of trust",
+        )
+    except StorageBusy as exc:
+        logger.warning(f"Database busy, rejected event {event_obj.event_id}: {exc}")
+        return event_obj.evt_result(
+            results_status="false",
+            http_status_code=503,
+            message=BUSY_MESSAGE,
+        )
     except Exception as exc:
         logger.debug(f"Exception while adding event to database: {exc}")
-        await conn.rollback()
-        return event_obj.evt_response(
+        return event_obj.evt_result(
             results_status="false",
             http_status_code=500,
             message="error: could not connect to the database",
         )
 
 
-@app.post("/subscription")
-async def handle_subscription(request: Request) -> JSONResponse:
+def sketch_marker(key: str, state: str) -> str:
+    """Redis key marking a count sketch as "seeding" or "seeded"."""
+    return f"{key}:{state}"
+
+
+async def seed_count_sketches(
+    app: FastAPI,
+    redis_client: redis.Redis,
+    kind: int,
+    tag: str,
+    values: List[str],
+    client: str = "",
+) -> bool:
+    """
+    Seeds the count sketches of ``values`` that are not seeded yet with the
+    matching events already in storage, so a count also covers the events
+    stored before its sketch. Each sketch is created before storage is read,
+    so ingest adds the events stored meanwhile, and only marked seeded once
+    the read is in. One COUNT seeds a sketch at a time, holding its
+    "seeding" marker; storage is read in the expensive query lane. If the
+    read fails, the marker is released and the next COUNT seeds again into
+    the same sketch, losing nothing ingest added.
+
+    Sketches expire COUNT_SKETCH_SECONDS after they were last counted.
+
+    Returns:
+        bool: Whether all the sketches are seeded, False while another COUNT is seeding one of them.
+    """
+    keys = [count_sketch_key(kind, tag, value) for value in values]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            seeded = sketch_marker(key, "seeded")
+            pipe.exists(key, seeded)
+            pipe.expire(key, COUNT_SKETCH_SECONDS)
+            pipe.expire(seeded, COUNT_SKETCH_SECONDS)
+        found = (await pipe.execute())[::3]
+
+    by_author = kind_class(kind) == "replaceable"
+    for key, value, exists in zip(keys, values, found):
+        if exists == 2:
+            continue
+        seeding = sketch_marker(key, "seeding")
+        if not await redis_client.set(
+            seeding, 1, nx=True, ex=COUNT_SKETCH_SEED_LOCK_SECONDS
+        ):
+            return False
+        try:
+            await redis_client.pfadd(key)
+            await redis_client.expire(key, COUNT_SKETCH_SECONDS)
+            async with query_scheduler.slot("expensive", client):
+                with StageTimer(stage_histogram, "count_seed"):
+                    elements = await app.storage.sketch_elements(
+                        {"kinds": [kind], f"#{tag}": [value]},
+                        by_author,
+                        COUNT_SKETCH_SEED_MAX,
+                    )
+            if len(elements) >= COUNT_SKETCH_SEED_MAX:
+                logger.warning(
+                    f"Count sketch {key} seeded with only the first {COUNT_SKETCH_SEED_MAX} events"
+                )
+            for start in range(0, len(elements), 10000):
+                await redis_client.pfadd(key, *elements[start : start + 10000])
+            await redis_client.set(
+                sketch_marker(key, "seeded"), 1, ex=COUNT_SKETCH_SECONDS
+            )
+        finally:
+            await redis_client.delete(seeding)
+    return True
+
+
+@app.post("/new_event")
+async def handle_new_event(request: Request) -> JSONResponse:
+    response, status_code = await process_new_event(
+        request.app,
+        await request.body(),
+        verified=request.headers.get(SIGNATURE_VERIFIED_HEADER) == "true",
+    )
+    return ORJSONResponse(content=response, status_code=status_code)
+
+
+async def query_replaceable(
+    app: FastAPI,
+    redis_client: redis.Redis,
+    filters: Dict[str, Any],
+    pairs: List[Tuple[int, str]],
+    client: str = "",
+) -> List[Dict[str, Any]]:
+    """
+    Answers a profile or contact list lookup from the replaceable cache.
+
+    Every (kind, pubkey) pair is read with one MGET, and the pairs not
+    cached with one storage query, whose results fill the cache. Authors
+    without such an event are cached too, as empty entries. Cache fills
+    never overwrite an entry, so they cannot undo a newer event that ingest
+    wrote meanwhile. Pairs under a deletion tombstone are read from the
+    primary and not cached. The filter's since, until and limit then apply.
+    The storage queries run in the cheap query lane.
+    """
+    keys = [replaceable_cache_key(kind, pubkey) for kind, pubkey in pairs]
+    with StageTimer(stage_histogram, "cache_lookup") as timer:
+        cached = await redis_client.mget(keys)
+        missing = [pair for pair, value in zip(pairs, cached) if value is None]
+        deleted = [
+            pair for pair, value in zip(pairs, cached) if value == REPLACEABLE_TOMBSTONE
+        ]
+        timer.result = "miss" if missing or deleted else "hit"
+    events = [
+        orjson.loads(value)
+        for value in cached
+        if value and value != REPLACEABLE_TOMBSTONE
+    ]
+
+    async def read_stored(
+        wanted: List[Tuple[int, str]], primary: bool
+    ) -> Dict[Tuple[int, str], Dict[str, Any]]:
+        async with query_scheduler.slot("cheap", client):
+            with StageTimer(stage_histogram, "sql_query") as timer:
+                result = await app.storage.replaceable_events(
+                    sorted({kind for kind, _ in wanted}),
+                    sorted({pubkey for _, pubkey in wanted}),
+                    primary=primary,
+                )
+        slow_query_log.observe(
+            lambda: app.storage.explain(result),
+            filters,
+            result.sql,
+            len(result.events),
+            timer.elapsed_ms,
+        )
+        stored = {}
+        for event in result.events:
+            stored.setdefault((event["kind"], event["pubkey"]), event)
+        return stored
+
+    if missing:
+        stored = await read_stored(missing, primary=False)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for pair in missing:
+                event = stored.get(pair)
+                pipe.set(
+                    replaceable_cache_key(*pair),
+                    orjson.dumps(event) if event else "",
+                    ex=REPLACEABLE_CACHE_SECONDS,
+                    nx=True,
+                )
+                if event:
+                    events.append(event)
+            await pipe.execute()
+
+    if deleted:
+        stored = await read_stored(deleted, primary=True)
+        events.extend(stored[pair] for pair in deleted if pair in stored)
+
+    since, until = filters.get("since"), filters.get("until")
+    events = [
+        event
+        for event in events
+        if (since is None or event["created_at"] >= since)
+        and (until is None or event["created_at"] <= until)
+    ]
+    events.sort(key=lambda event: (event["created_at"], event["id"]), reverse=True)
+    limit = filters.get("limit")
+    if isinstance(limit, int) and limit > 0:
+        events = events[:limit]
+    return events
+
+
+async def process_subscription(
+    app: FastAPI, request_payload: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Runs the filters of a REQ against the cache and the storage backend.
+
+    This is the query logic behind ``/subscription``. The embedded relay mode
+    calls it directly from the websocket handler, without the HTTP hop.
+
+    A payload with a ``cursor`` of ``[created_at, id]`` asks for the page of
+    events after that one. Such pages skip the cache, as does a payload with
+    ``"cache": false``. Profile and contact list lookups by author go to the
+    replaceable cache instead of the query cache.
+
+    Storage queries wait for a slot of the query lane their estimated cost
+    puts them in, queued fairly with the other queries of the payload's
+    ``client``, usually the websocket connection. A REQ with any filter
+    costing more than QUERY_MAX_COST is answered 413 without running it.
+
+    Returns:
+        Tuple[Dict[str, Any], int]: The response body with the matching events and its HTTP status code.
+    """
     try:
-        request_payload = orjson.loads(await request.body())
         logger.debug(f"Request payload is {request_payload}")
 
         subscription_obj = Subscription(request_payload)
         increment_counter({"stage": "pre-cache"}, metric_counters["event_added"])
 
         if not subscription_obj.filters:
-            return subscription_obj.sub_response_builder(
+            return subscription_obj.sub_result(
                 "EOSE", subscription_obj.subscription_id, "", 204
             )
 
-        # Parse filters into query components in parallel
-        multi_filter = await asyncio.gather(
-            *(
-                subscription_obj.parse_filters(f, logger)
-                for f in subscription_obj.filters
+        costs = [query_scheduler.cost(filters) for filters in subscription_obj.filters]
+        if any(query_scheduler.too_expensive(cost) for cost in costs):
+            logger.info(
+                f"Rejected subscription costing {max(costs):.0f}, over {QUERY_MAX_COST:.0f}"
+            )
+            return subscription_obj.sub_result(
+                "EOSE", subscription_obj.subscription_id, "", 413
             )
-        )
 
-        redis_client = await get_redis_client()
+        cursor = request_payload.get("cursor")
+        client = str(request_payload.get("client", ""))
+        use_cache = not cursor and request_payload.get("cache", True)
+        redis_client = await get_redis_client(app)
+
+        # Profile and contact list lookups have a cache of their own
+        lookups, generic = [], []
+        for filters in subscription_obj.filters:
+            pairs = (
+                subscription_obj.replaceable_pairs(filters, REPLACEABLE_CACHE_KINDS)
+                if use_cache and isinstance(filters, dict)
+                else None
+            )
+            if pairs:
+                lookups.append((filters, pairs))
+            else:
+                generic.append(filters)
 
         # Check cache in parallel
-        async def check_cache(filter_set):
-            cache_key = str(filter_set)
-            return cache_key, await redis_client.get(cache_key)
+        async def check_cache(filters):
+            if not use_cache:
+                return None, None
+            cache_key = query_cache_key(filters)
+            with StageTimer(stage_histogram, "cache_lookup") as timer:
+                cached = await redis_client.get(cache_key)
+                timer.result = "hit" if cached else "miss"
+            return cache_key, cached
 
-        cache_results = await asyncio.gather(*(check_cache(f) for f in multi_filter))
+        cache_results = await asyncio.gather(*(check_cache(f) for f in generic))
+        lookup_results = await asyncio.gather(
+            *(
+                query_replaceable(app, redis_client, *lookup, client=client)
+                for lookup in lookups
+            )
+        )
 
         # Separate cache hits and misses
         cache_hits = [orjson.loads(res) for _, res in cache_results if res]
+        cache_hits.extend(lookup_results)
         cache_misses = [
-            (key, f)
-            for key, res, f in zip(*zip(*cache_results), multi_filter)
-            if not res
+            (key, f) for (key, res), f in zip(cache_results, generic) if not res
         ]
 
-        # Query cache misses in the database
-        async def query_database(cache_key, filter_set):
-            sql_query = subscription_obj.base_query_builder(*filter_set, logger)
-            query_results = await execute_sql_with_tracing(
-                app, sql_query, "SELECT * FROM EVENTS"
+        # Query cache misses in the storage backend
+        async def query_database(cache_key, filters):
+            lane = query_scheduler.lane(query_scheduler.cost(filters))
+            async with query_scheduler.slot(lane, client):
+                with StageTimer(stage_histogram, "sql_query") as timer:
+                    result = await app.storage.query(filters, cursor)
+            slow_query_log.observe(
+                lambda: app.storage.explain(result),
+                filters,
+                result.sql,
+                len(result.events),
+                timer.elapsed_ms,
             )
-            parsed_results = await subscription_obj.query_result_parser(query_results)
-            await redis_client.setex(cache_key, 240, orjson.dumps(parsed_results))
-            return parsed_results
+            if cache_key:
+                await redis_client.setex(cache_key, 240, orjson.dumps(result.events))
+            return result.events
 
         db_results = (
-            await asyncio.gather(*(query_database(key, f) for key, f in cache_misses))
+            await asyncio.gather(*(query_database(*miss) for miss in cache_misses))
             if cache_misses
             else []
         )
@@ -327,20 +1001,278 @@ async def handle_subscription(request: Request) -> JSONResponse:
             result for res_list in cache_hits + db_results for result in res_list
         ]
 
-        await redis_client.close()
-
-        return subscription_obj.sub_response_builder(
+        return subscription_obj.sub_result(
             "EVENT", subscription_obj.subscription_id, combined_results, 200
         )
-    except (psycopg.Error, Exception) as exc:
+    except (StorageBusy, LaneBusy) as exc:
+        logger.warning(f"Database busy, rejected subscription: {exc}")
+        return subscription_obj.sub_result(
+            "EOSE", subscription_obj.subscription_id, "", 503
+        )
+    except Exception as exc:
         logger.error(f"An error occurred: {exc}", exc_info=True)
-        return subscription_obj.sub_response_builder(
+        return subscription_obj.sub_result(
             "EOSE", subscription_obj.subscription_id, "", 500
         )
 
 
+@app.post("/subscription")
+async def handle_subscription(request: Request) -> JSONResponse:
+    response, status_code = await process_subscription(
+        request.app, orjson.loads(await request.body())
+    )
+    with StageTimer(stage_histogram, "serialization"):
+        return ORJSONResponse(content=response, status_code=status_code)
+
+
+async def process_count(
+    app: FastAPI, request_payload: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """
+    Counts the events matching the filters of a NIP-45 COUNT.
+
+    Filters of a sketched shape, such as followers or reactions, are answered
+    from the HyperLogLog sketches ingest keeps and flagged approximate. A
+    sketch is seeded from storage the first time it is counted; while
+    another COUNT is seeding it, the filter is counted exactly instead.
+    Sketches never shrink: deletions, unfollows and replaced contact lists
+    are not taken out. Other filters run an exact COUNT(*), cached for
+    COUNT_CACHE_SECONDS. Counts of several filters are added up, so they are
+    approximate too: one event can match more than one filter.
+
+    Exact counts wait for the query lane their cost puts them in, like REQ
+    queries, with a COUNT costed as a full page since it reads every match.
+    A COUNT with an exact filter costing more than QUERY_MAX_COST is
+    answered 413 without running it.
+
+    Returns:
+        Tuple[Dict[str, Any], int]: The count, whether it is approximate, and the HTTP status code.
+    """
+    subscription_obj = Subscription(request_payload)
+    response = {
+        "subscription_id": subscription_obj.subscription_id,
+        "count": 0,
+        "approximate": len(subscription_obj.filters) > 1,
+    }
+
+    def too_expensive(filters_list: List[Dict[str, Any]]) -> bool:
+        costs = [query_scheduler.count_cost(filters) for filters in filters_list]
+        if any(query_scheduler.too_expensive(cost) for cost in costs):
+            logger.info(
+                f"Rejected count costing {max(costs):.0f}, over {QUERY_MAX_COST:.0f}"
+            )
+            return True
+        return False
+
+    try:
+        sketched = [
+            subscription_obj.count_sketch_keys(
+                filters, COUNT_SKETCH_KINDS, COUNT_SKETCH_TAGS
+            )
+            for filters in subscription_obj.filters
+        ]
+        if too_expensive(
+            [
+                filters
+                for filters, sketch_keys in zip(subscription_obj.filters, sketched)
+                if not sketch_keys
+            ]
+        ):
+            return response, 413
+
+        client = str(request_payload.get("client", ""))
+        redis_client = await get_redis_client(app)
+
+        async def sketch_ready(filters, sketch_keys) -> bool:
+            if not sketch_keys:
+                return False
+            tag = next(key for key in filters if key.startswith("#"))
+            return await seed_count_sketches(
+                app,
+                redis_client,
+                filters["kinds"][0],
+                tag[1:],
+                filters[tag],
+                client,
+            )
+
+        ready = await asyncio.gather(
+            *(sketch_ready(*entry) for entry in zip(subscription_obj.filters, sketched))
+        )
+        # Sketched filters whose sketch another COUNT is still seeding
+        if too_expensive(
+            [
+                filters
+                for filters, sketch_keys, is_ready in zip(
+                    subscription_obj.filters, sketched, ready
+                )
+                if sketch_keys and not is_ready
+            ]
+        ):
+            return response, 413
+
+        async def count_filter(filters, sketch_keys, is_ready) -> Tuple[int, bool]:
+            if is_ready:
+                with StageTimer(stage_histogram, "count_sketch"):
+                    return await redis_client.pfcount(*sketch_keys), True
+
+            cache_key = query_cache_key(filters, prefix="count")
+            with StageTimer(stage_histogram, "cache_lookup") as timer:
+                cached = await redis_client.get(cache_key)
+                timer.result = "hit" if cached else "miss"
+            if cached:
+                return int(cached), False
+            lane = query_scheduler.lane(query_scheduler.count_cost(filters))
+            async with query_scheduler.slot(lane, client):
+                with StageTimer(stage_histogram, "count_query"):
+                    count = await app.storage.count(filters)
+            await redis_client.setex(cache_key, COUNT_CACHE_SECONDS, count)
+            return count, False
+
+        for count, approximate in await asyncio.gather(
+            *(
+                count_filter(*entry)
+                for entry in zip(subscription_obj.filters, sketched, ready)
+            )
+        ):
+            response["count"] += count
+            response["approximate"] = response["approximate"] or approximate
+
+        return response, 200
+    except (StorageBusy, LaneBusy) as exc:
+        logger.warning(f"Database busy, rejected count: {exc}")
+        return response, 503
+    except Exception as exc:
+        logger.error(f"Error counting events: {exc}", exc_info=True)
+        return response, 500
+
+
+@app.post("/count")
+async def handle_count(request: Request) -> JSONResponse:
+    response, status_code = await process_count(
+        request.app, orjson.loads(await request.body())
+    )
+    return ORJSONResponse(content=response, status_code=status_code)
+
+
+async def process_negentropy_items(
+    app: FastAPI, filters: Dict[str, Any]
+) -> Tuple[bytes, int]:
+    """
+    Reads the (created_at, id) of every event matching a NIP-77 sync filter,
+    packed in sync order for the websocket handler to build its negentropy
+    index from. Full events are never loaded.
+
+    Returns:
+        Tuple[bytes, int]: The packed items and 200; or no items and 413 when
+        more than NEG_MAX_RECORDS events match, 400 for an invalid filter, 503
+        when no database connection was free and 500 when the query failed.
+    """
+    if not isinstance(filters, dict):
+        return b"", 400
+    try:
+        with StageTimer(stage_histogram, "sync_query") as timer:
+            items = await app.storage.sync_items(filters, NEG_MAX_RECORDS + 1)
+            timer.result = "too_many" if len(items) > NEG_MAX_RECORDS else "ok"
+    except ValueError as exc:
+        logger.debug(f"Invalid sync filter {filters}: {exc}")
+        return b"", 400
+    except StorageBusy as exc:
+        logger.warning(f"Database busy, rejected sync: {exc}")
+        return b"", 503
+    except Exception as exc:
+        logger.error(f"Error reading sync items: {exc}", exc_info=True)
+        return b"", 500
+    if len(items) > NEG_MAX_RECORDS:
+        return b"", 413
+    return pack_items(items), 200
+
+
+@app.post("/negentropy_items")
+async def handle_negentropy_items(request: Request) -> Response:
+    items, status_code = await process_negentropy_items(
+        request.app, orjson.loads(await request.body())
+    )
+    return Response(
+        content=items, status_code=status_code, media_type="application/octet-stream"
+    )
+
+
+async def require_admin(request: Request) -> None:
+    """Rejects admin requests without the ADMIN_TOKEN bearer token."""
+    if not admin_authorized(request.headers.get("authorization"), ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="unauthorized")
+
+
+@app.get("/admin/slow_queries", dependencies=[Depends(require_admin)])
+async def handle_slow_queries() -> JSONResponse:
+    return ORJSONResponse(content=slow_query_log.snapshot())
+
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def handle_profile(
+    seconds: float = 5, top: int = 30, sort: str = "cumulative"
+) -> PlainTextResponse:
+    try:
+        return PlainTextResponse(await profile_for(seconds, top, sort))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except CaptureBusy as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+
+
+@app.get("/admin/tracemalloc", dependencies=[Depends(require_admin)])
+async def handle_tracemalloc(
+    seconds: float = 10, top: int = 25, frames: int = 1
+) -> JSONResponse:
+    try:
+        return ORJSONResponse(content=await tracemalloc_diff(seconds, top, frames))
+    except CaptureBusy as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+
+
+async def internal_sizes(app: FastAPI) -> Dict[str, Any]:
+    """
+    Collects the sizes of this worker's pools, caches and metric state for
+    the admin size dump.
+    """
+    sizes = {
+        "process": process_sizes(),
+        "storage": app.storage.stats(),
+        "query_scheduler": query_scheduler.stats(),
+        "slow_query_log": len(slow_query_log.entries),
+        "metric_counters": {
+            name: len(counter) for name, counter in metric_counters.items()
+        },
+    }
+    try:
+        redis_client = await get_redis_client(app)
+        sizes["redis_keys"] = await redis_client.dbsize()
+    except Exception as exc:
+        sizes["redis_keys"] = f"unavailable: {exc}"
+    return sizes
+
+
+@app.get("/admin/sizes", dependencies=[Depends(require_admin)])
+async def handle_sizes(request: Request) -> JSONResponse:
+    return ORJSONResponse(content=await internal_sizes(request.app))
+
+
 if __name__ == "__main__":
-    logger.info(f"Write conn string is: {get_conn_str('WRITE')}")
-    logger.info(f"Read conn string is: {get_conn_str('READ')}")
-    initialize_db(logger=logger, write_str=init_conn_str)
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("EVENT_HANDLER_PORT")))
+    # Runs once in the parent process, before any worker starts
+    prepare_storage()
+
+    # With several workers uvicorn needs an import string; each worker imports
+    # this module and opens its own storage backend in ``lifespan``.
+    target = "event_handler:app" if EVENT_HANDLER_WORKERS > 1 else app
+    if os.getenv("EVENT_HANDLER_UDS"):
+        uvicorn.run(
+            target, uds=os.getenv("EVENT_HANDLER_UDS"), workers=EVENT_HANDLER_WORKERS
+        )
+    else:
+        uvicorn.run(
+            target,
+            host="0.0.0.0",
+            port=int(os.getenv("EVENT_HANDLER_PORT")),
+            workers=EVENT_HANDLER_WORKERS,
+        )
@@ -0,0 +1,1026 @@
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import orjson
+import psycopg
+from opentelemetry import trace
+from opentelemetry.semconv.trace import SpanAttributes
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+
+from event_classes import QUERY_DEFAULT_LIMIT, Event, Subscription
+
+# Largest number of events one query returns by default; larger REQ limits
+# are read in keyset pages of at most this size
+QUERY_PAGE_SIZE = 500
+
+# Seconds a read replica is behind the primary. An idle primary sends no
+# new transactions, so a replica that has replayed all it received is
+# caught up however old its last replayed transaction is.
+REPLICA_LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+tracer = trace.get_tracer(__name__)
+
+
+class DuplicateEvent(Exception):
+    """Raised when an event with the same ID is already stored."""
+
+
+class UntrustedAuthor(Exception):
+    """Raised when a write limited to the web of trust comes from outside it."""
+
+
+class StorageBusy(Exception):
+    """Raised when no database connection frees up within the acquire timeout."""
+
+
+class QueryResult(NamedTuple):
+    """
+    Events matching one filter, newest first, plus the statement that found
+    them so slow queries can be logged and explained.
+    """
+
+    events: List[Dict[str, Any]]
+    sql: str
+    params: Tuple = ()
+
+
+class StorageBackend:
+    """
+    Interface the event handler uses to store and query events.
+
+    Queries return events ordered by (created_at, id), newest first, and at
+    most ``page_size`` of them. Given the (created_at, id) ``cursor`` of the
+    last event of a page, ``query`` returns the next page.
+
+    Every method is a coroutine and safe to call concurrently. Backends raise
+    ``DuplicateEvent`` from ``add_event`` for an ID they already hold,
+    ``UntrustedAuthor`` from ``add_event`` and ``replace_event`` called with
+    ``trusted_only`` for an author outside the web of trust, and
+    ``StorageBusy`` from any method when every connection stayed in use for
+    the acquire timeout; any other exception means the operation failed.
+
+    Methods:
+        open(): Connects and prepares the schema.
+        close(): Releases connections and threads.
+        add_event(event, trusted_only): Stores a regular event.
+        replace_event(event, trusted_only): Stores a replaceable event in place of the author's previous one.
+        delete_events(event, event_ids): Deletes the listed events of the author of a kind 5 event.
+        query(filters, cursor): Returns a page of the events matching one REQ filter.
+        replaceable_events(kinds, pubkeys): Returns the current replaceable events of authors.
+        count(filters): Counts the events matching one REQ filter.
+        sync_items(filters, max_items): Returns (created_at, id) of the events matching a sync filter.
+        check_wot(event): Tells whether the author is in the web of trust.
+        explain(result): Returns the query plan of a finished query.
+        stats(): Returns sizes and pool state for the admin endpoint.
+        pool_stats(): Returns the size, use and waiters of every connection pool.
+    """
+
+    name = "base"
+
+    async def open(self) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        raise NotImplementedError
+
+    async def add_event(self, event: Event, trusted_only: bool = False) -> None:
+        raise NotImplementedError
+
+    async def replace_event(self, event: Event, trusted_only: bool = False) -> None:
+        raise NotImplementedError
+
+    async def delete_events(self, event: Event, event_ids: List[str]) -> None:
+        raise NotImplementedError
+
+    async def query(
+        self, filters: Dict[str, Any], cursor: Optional[Tuple[int, str]] = None
+    ) -> QueryResult:
+        raise NotImplementedError
+
+    async def replaceable_events(
+        self, kinds: List[int], pubkeys: List[str], primary: bool = False
+    ) -> QueryResult:
+        raise NotImplementedError
+
+    async def count(self, filters: Dict[str, Any]) -> int:
+        raise NotImplementedError
+
+    async def sync_items(
+        self, filters: Dict[str, Any], max_items: int
+    ) -> List[Tuple[int, str]]:
+        raise NotImplementedError
+
+    async def sketch_elements(
+        self, filters: Dict[str, Any], by_author: bool, max_items: int
+    ) -> List[str]:
+        raise NotImplementedError
+
+    async def check_wot(self, event: Event) -> bool:
+        raise NotImplementedError
+
+    async def explain(self, result: QueryResult) -> List[str]:
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        return []
+
+
+class ReadReplica:
+    """
+    A Postgres server reads can go to, with its pool and what the last
+    health probe found.
+
+    Attributes:
+        name (str): host:port of the server, or "primary".
+        conninfo (str): Connection string.
+        pool (Optional[AsyncConnectionPool]): Its connection pool once opened.
+        healthy (bool): Whether the last probe succeeded.
+        lag_seconds (float): Replay lag the last probe measured.
+        probe_ms (float): Round trip of the last probe.
+        query_ms (float): Moving average of read time on this server.
+        in_flight (int): Reads running on it now.
+    """
+
+    __slots__ = (
+        "name",
+        "conninfo",
+        "pool",
+        "healthy",
+        "lag_seconds",
+        "probe_ms",
+        "query_ms",
+        "in_flight",
+    )
+
+    def __init__(self, name: str, conninfo: str):
+        self.name = name
+        self.conninfo = conninfo
+        self.pool: Optional[AsyncConnectionPool] = None
+        self.healthy = True
+        self.lag_seconds = 0.0
+        self.probe_ms = 0.0
+        self.query_ms = 0.0
+        self.in_flight = 0
+
+    def utilization(self) -> float:
+        return self.in_flight / max(self.pool.max_size, 1)
+
+    def observe_query(self, elapsed_ms: float) -> None:
+        self.query_ms += (elapsed_ms - self.query_ms) * 0.1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "lag_seconds": round(self.lag_seconds, 3),
+            "probe_ms": round(self.probe_ms, 2),
+            "query_ms": round(self.query_ms, 2),
+            "in_flight": self.in_flight,
+            "pool": self.pool.get_stats() if self.pool else {},
+        }
+
+
+def replica_name(conninfo: str) -> str:
+    """host:port of a key=value connection string."""
+    params = dict(part.split("=", 1) for part in conninfo.split() if "=" in part)
+    return f"{params.get('host', '')}:{params.get('port', '')}"
+
+
+class PostgresStorage(StorageBackend):
+    """
+    Stores events in Postgres, writing to the primary and spreading reads
+    over one or more read replicas.
+
+    A background task probes every replica for health and replay lag. Each
+    read goes to the healthy replica with the fewest reads in flight for its
+    pool size. Queries whose ``since`` is within ``recent_seconds`` skip
+    replicas more than ``max_lag_seconds`` behind, so a client that reads
+    right after publishing sees its event. Reads fall back to the primary
+    when no replica qualifies or the chosen one fails.
+
+    Pools open ``min_size`` connections at startup and grow to ``max_size``
+    under load. A caller that waits longer than ``acquire_timeout`` for a
+    connection, or finds ``max_waiting`` callers already queued, gets
+    ``StorageBusy`` instead of queueing behind a saturated pool.
+
+    Attributes:
+        write_conninfo (str): Connection string of the primary.
+        replicas (List[ReadReplica]): The read replicas.
+        primary (ReadReplica): The primary, as a read fallback.
+        explain_timeout_ms (int): statement_timeout applied to EXPLAIN runs.
+        page_size (int): Most events one query returns.
+        max_lag_seconds (float): Most lag a replica may have for recent queries.
+        recent_seconds (float): A query with a since this close to now is recent.
+        probe_interval (float): Seconds between replica probes.
+        write_pool_size (Tuple[int, int]): Min and max connections to the primary.
+        read_pool_size (Tuple[int, int]): Min and max connections to each replica.
+        acquire_timeout (float): Seconds to wait for a free connection.
+        max_waiting (int): Most callers queued on one pool, 0 for unlimited.
+        warmup_timeout (float): Seconds open() waits for the pools to fill.
+        pool_wait_observer (Optional[Callable[[str, str, float], None]]): Called
+            with the pool role, the server name and the acquire wait in milliseconds.
+    """
+
+    name = "postgres"
+
+    def __init__(
+        self,
+        write_conninfo: str,
+        read_conninfo: Union[str, Sequence[str]],
+        logger,
+        explain_timeout_ms: int = 10000,
+        page_size: int = QUERY_PAGE_SIZE,
+        max_lag_seconds: float = 5,
+        recent_seconds: float = 600,
+        probe_interval: float = 2,
+        write_pool_size: Tuple[int, int] = (4, 10),
+        read_pool_size: Tuple[int, int] = (4, 20),
+        acquire_timeout: float = 3,
+        max_waiting: int = 0,
+        warmup_timeout: float = 10,
+        pool_wait_observer: Optional[Callable[[str, str, float], None]] = None,
+    ):
+        if isinstance(read_conninfo, str):
+            read_conninfo = [read_conninfo]
+        self.write_conninfo = write_conninfo
+        self.replicas = [
+            ReadReplica(replica_name(conninfo), conninfo) for conninfo in read_conninfo
+        ]
+        self.primary = ReadReplica("primary", write_conninfo)
+        self.logger = logger
+        self.explain_timeout_ms = explain_timeout_ms
+        self.page_size = page_size
+        self.max_lag_seconds = max_lag_seconds
+        self.recent_seconds = recent_seconds
+        self.probe_interval = probe_interval
+        self.write_pool_size = write_pool_size
+        self.read_pool_size = read_pool_size
+        self.acquire_timeout = acquire_timeout
+        self.max_waiting = max_waiting
+        self.warmup_timeout = warmup_timeout
+        self.pool_wait_observer = pool_wait_observer
+        self.write_pool: Optional[AsyncConnectionPool] = None
+        self._prober: Optional[asyncio.Task] = None
+
+    def _pool(
+        self, conninfo: str, size: Tuple[int, int], name: str
+    ) -> AsyncConnectionPool:
+        min_size, max_size = size
+        return AsyncConnectionPool(
+            conninfo=conninfo,
+            min_size=min_size,
+            max_size=max(max_size, min_size),
+            timeout=self.acquire_timeout,
+            max_waiting=self.max_waiting,
+            name=name,
+            open=False,
+        )
+
+    async def _warm_up(self, pool: AsyncConnectionPool) -> None:
+        # Opening without waiting lets the pool keep connecting in the
+        # background; a failed wait would close it for good
+        await pool.open()
+        deadline = time.monotonic() + self.warmup_timeout
+        # Nothing has checked a connection out yet, so every open one is idle
+        while pool.get_stats()["pool_available"] < pool.min_size:
+            if time.monotonic() >= deadline:
+                ready = pool.get_stats()["pool_available"]
+                self.logger.warning(
+                    f"Pool {pool.name} opened {ready} of {pool.min_size} connections"
+                    f" within {self.warmup_timeout}s, the rest connect in the background"
+                )
+                return
+            await asyncio.sleep(0.05)
+
+    async def open(self) -> None:
+        self.write_pool = self._pool(self.write_conninfo, self.write_pool_size, "write")
+        self.primary.pool = self.write_pool
+        for replica in self.replicas:
+            replica.pool = self._pool(
+                replica.conninfo, self.read_pool_size, f"read {replica.name}"
+            )
+        await asyncio.gather(
+            self._warm_up(self.write_pool),
+            *(self._warm_up(replica.pool) for replica in self.replicas),
+        )
+        await self.probe_replicas()
+        self._prober = asyncio.create_task(self._probe_loop())
+
+    async def close(self) -> None:
+        if self._prober is not None:
+            self._prober.cancel()
+        await self.write_pool.close()
+        for replica in self.replicas:
+            await replica.pool.close()
+
+    async def probe_replicas(self) -> None:
+        """Measures the health, lag and round trip of every replica."""
+        await asyncio.gather(*(self._probe(replica) for replica in self.replicas))
+
+    async def _probe(self, replica: ReadReplica) -> None:
+        start = time.perf_counter()
+        try:
+            async with replica.pool.connection(timeout=self.probe_interval) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(REPLICA_LAG_QUERY)
+                    (lag,) = await cur.fetchone()
+        except Exception as exc:
+            if replica.healthy:
+                self.logger.warning(f"Read replica {replica.name} is unhealthy: {exc}")
+            replica.healthy = False
+            return
+        replica.probe_ms = (time.perf_counter() - start) * 1000
+        replica.lag_seconds = float(lag)
+        if not replica.healthy:
+            self.logger.info(f"Read replica {replica.name} is healthy again")
+        replica.healthy = True
+
+    async def _probe_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            await self.probe_replicas()
+
+    def _is_recent(self, filters: Dict[str, Any]) -> bool:
+        since = filters.get("since")
+        return (
+            isinstance(since, (int, float))
+            and since >= time.time() - self.recent_seconds
+        )
+
+    def _choose(self, recent: bool = False) -> ReadReplica:
+        candidates = [
+            replica
+            for replica in self.replicas
+            if replica.healthy
+            and (not recent or replica.lag_seconds <= self.max_lag_seconds)
+        ]
+        if not candidates:
+            return self.primary
+        # The random part spreads ties, e.g. while every pool is idle
+        return min(candidates, key=lambda r: (r.utilization(), random.random()))
+
+    @asynccontextmanager
+    async def _acquire(self, pool: AsyncConnectionPool, role: str, server: str):
+        """
+        Checks a connection out of ``pool``, reporting how long that took
+        and turning an acquire timeout or a full wait queue into
+        ``StorageBusy``.
+        """
+        start = time.perf_counter()
+        acquired = False
+        try:
+            async with pool.connection() as conn:
+                acquired = True
+                self._observe_wait(role, server, start)
+                yield conn
+        except (PoolTimeout, TooManyRequests) as exc:
+            if acquired:
+                raise
+            self._observe_wait(role, server, start)
+            raise StorageBusy(f"no free {role} connection to {server}: {exc}") from exc
+
+    def _observe_wait(self, role: str, server: str, start: float) -> None:
+        if self.pool_wait_observer is not None:
+            self.pool_wait_observer(role, server, (time.perf_counter() - start) * 1000)
+
+    @asynccontextmanager
+    async def _read_connection(self, replica: ReadReplica):
+        replica.in_flight += 1
+        start = time.perf_counter()
+        role = "write" if replica is self.primary else "read"
+        try:
+            async with self._acquire(replica.pool, role, replica.name) as conn:
+                yield conn
+        finally:
+            replica.in_flight -= 1
+            replica.observe_query((time.perf_counter() - start) * 1000)
+
+    def _write_connection(self):
+        return self._acquire(self.write_pool, "write", self.primary.name)
+
+    async def add_event(self, event: Event, trusted_only: bool = False) -> None:
+        await self._store(event, False, trusted_only)
+
+    async def replace_event(self, event: Event, trusted_only: bool = False) -> None:
+        await self._store(event, True, trusted_only)
+
+    async def _store(self, event: Event, replace: bool, trusted_only: bool) -> None:
+        # In pipeline mode the statements and the COMMIT go out together, so
+        # storing an event is one round trip and one commit however many
+        # statements it takes. The web of trust check is part of the insert.
+        async with self._write_connection() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    async with conn.pipeline():
+                        if replace:
+                            await event.delete_check(conn, cur, trusted_only)
+                        await event.add_event(conn, cur, trusted_only)
+                        await conn.commit()
+                except psycopg.IntegrityError as exc:
+                    await conn.rollback()
+                    raise DuplicateEvent(event.event_id) from exc
+                if cur.rowcount == 0:
+                    raise UntrustedAuthor(event.pubkey)
+
+    async def delete_events(self, event: Event, event_ids: List[str]) -> None:
+        async with self._write_connection() as conn:
+            async with conn.cursor() as cur:
+                async with conn.pipeline():
+                    await event.delete_event(conn, cur, event_ids)
+                    await conn.commit()
+
+    async def _select(
+        self,
+        sql_query: str,
+        span_name: str,
+        recent: bool = False,
+        params: Sequence[Any] = (),
+        primary: bool = False,
+    ) -> List[Tuple]:
+        with tracer.start_as_current_span(span_name) as span:
+            span.set_attribute(SpanAttributes.DB_SYSTEM, "postgresql")
+            span.set_attribute(SpanAttributes.DB_STATEMENT, sql_query)
+            span.set_attribute("service.name", "postgres")
+            span.set_attribute("operation.name", "postgres.query")
+            replica = self.primary if primary else self._choose(recent)
+            span.set_attribute("db.replica", replica.name)
+            try:
+                return await self._fetch(replica, sql_query, params)
+            except psycopg.OperationalError as exc:
+                if replica is self.primary:
+                    raise
+                self.logger.warning(
+                    f"Read replica {replica.name} failed, reading from the primary: {exc}"
+                )
+                replica.healthy = False
+                return await self._fetch(self.primary, sql_query, params)
+
+    async def _fetch(
+        self, replica: ReadReplica, sql_query: str, params: Sequence[Any] = ()
+    ) -> List[Tuple]:
+        async with self._read_connection(replica) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql_query, params or None)
+                return await cur.fetchall()
+
+    async def _build(
+        self, filters: Dict[str, Any], cursor: Optional[Tuple[int, str]] = None
+    ) -> Subscription:
+        subscription = Subscription({"event_dict": [filters]})
+        filter_set = await subscription.parse_filters(filters, self.logger)
+        subscription.base_query_builder(
+            *filter_set, self.logger, max_limit=self.page_size, cursor=cursor
+        )
+        return subscription
+
+    async def query(
+        self, filters: Dict[str, Any], cursor: Optional[Tuple[int, str]] = None
+    ) -> QueryResult:
+        subscription = await self._build(filters, cursor)
+        rows = await self._select(
+            subscription.base_query,
+            "SELECT * FROM EVENTS",
+            self._is_recent(filters),
+            subscription.params,
+        )
+        events = await subscription.query_result_parser(rows)
+        return QueryResult(events, subscription.base_query, tuple(subscription.params))
+
+    async def replaceable_events(
+        self, kinds: List[int], pubkeys: List[str], primary: bool = False
+    ) -> QueryResult:
+        # Storage keeps one event per author and replaceable kind, so the
+        # result is bounded without a limit. The result is cached, so it is
+        # read from a replica at most max_lag_seconds behind, or the primary.
+        subscription = await self._build({"kinds": kinds, "authors": pubkeys})
+        sql_query = (
+            f"SELECT * FROM events WHERE {subscription.where_clause}"
+            " ORDER BY created_at DESC, id DESC"
+        )
+        params = tuple(subscription.where_params)
+        rows = await self._select(
+            sql_query, "SELECT * FROM EVENTS", True, params, primary
+        )
+        events = await subscription.query_result_parser(rows)
+        return QueryResult(events, sql_query, params)
+
+    async def count(self, filters: Dict[str, Any]) -> int:
+        subscription = Subscription({"event_dict": [filters]})
+        filter_set = await subscription.parse_filters(filters, self.logger)
+        sql_query = subscription.count_query_builder(*filter_set, self.logger)
+        rows = await self._select(
+            sql_query, "SELECT COUNT(*) FROM EVENTS", params=subscription.params
+        )
+        return rows[0][0]
+
+    async def sync_items(
+        self, filters: Dict[str, Any], max_items: int
+    ) -> List[Tuple[int, str]]:
+        # Only reads the two columns of the (created_at, id) index; the limit
+        # of the filter does not apply to a sync
+        subscription = await self._build(filters)
+        sql_query = "SELECT created_at, id FROM events"
+        if subscription.where_clause:
+            sql_query += f" WHERE {subscription.where_clause}"
+        sql_query += f" ORDER BY created_at, id LIMIT {int(max_items)}"
+        return await self._select(
+            sql_query,
+            "SELECT created_at, id FROM EVENTS",
+            params=subscription.where_params,
+        )
+
+    async def sketch_elements(
+        self, filters: Dict[str, Any], by_author: bool, max_items: int
+    ) -> List[str]:
+        # What ingest adds to a count sketch: the author of a replaceable
+        # event, the ID of any other
+        subscription = await self._build(filters)
+        column = "DISTINCT pubkey" if by_author else "id"
+        sql_query = f"SELECT {column} FROM events"
+        if subscription.where_clause:
+            sql_query += f" WHERE {subscription.where_clause}"
+        sql_query += f" LIMIT {int(max_items)}"
+        rows = await self._select(
+            sql_query, f"SELECT {column} FROM EVENTS", params=subscription.where_params
+        )
+        return [row[0] for row in rows]
+
+    async def check_wot(self, event: Event) -> bool:
+        async with self._read_connection(self._choose()) as conn:
+            async with conn.cursor() as cur:
+                return bool(await event.check_wot(cur))
+
+    async def explain(self, result: QueryResult) -> List[str]:
+        async with self._read_connection(self._choose()) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"SET LOCAL statement_timeout = {int(self.explain_timeout_ms)}"
+                )
+                await cur.execute(
+                    f"EXPLAIN (ANALYZE, BUFFERS) {result.sql}", result.params or None
+                )
+                return [row[0] for row in await cur.fetchall()]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "write_pool": self.write_pool.get_stats(),
+            "replicas": [replica.stats() for replica in self.replicas]
+            + [{**self.primary.stats(), "pool": {}}],
+        }
+
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        pools = [("write", self.primary)]
+        pools += [("read", replica) for replica in self.replicas]
+        result = []
+        for role, server in pools:
+            if server.pool is None:
+                continue
+            pool = server.pool.get_stats()
+            result.append(
+                {
+                    "role": role,
+                    "server": server.name,
+                    "size": pool["pool_size"],
+                    "in_use": pool["pool_size"] - pool["pool_available"],
+                    "waiting": pool["requests_waiting"],
+                    "max_size": pool["pool_max"],
+                }
+            )
+        return result
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    pubkey TEXT NOT NULL,
+    kind INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    tags TEXT NOT NULL,
+    content TEXT NOT NULL,
+    sig TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_created_at_id ON events (created_at, id);
+CREATE INDEX IF NOT EXISTS idx_events_pubkey ON events (pubkey, created_at);
+CREATE INDEX IF NOT EXISTS idx_events_kind ON events (kind, created_at);
+CREATE TABLE IF NOT EXISTS tags (
+    event_seq INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tags ON tags (name, value, event_seq);
+CREATE INDEX IF NOT EXISTS idx_tags_event ON tags (event_seq);
+CREATE TRIGGER IF NOT EXISTS events_delete_tags AFTER DELETE ON events
+BEGIN
+    DELETE FROM tags WHERE event_seq = old.seq;
+END;
+CREATE TABLE IF NOT EXISTS trust_network (pubkey TEXT PRIMARY KEY);
+"""
+
+SQLITE_COLUMNS = "e.id, e.pubkey, e.kind, e.created_at, e.tags, e.content, e.sig"
+
+
+def _row_event(row: Tuple) -> Dict[str, Any]:
+    return {
+        "id": row[0],
+        "pubkey": row[1],
+        "kind": row[2],
+        "created_at": row[3],
+        "tags": orjson.loads(row[4]),
+        "content": row[5],
+        "sig": row[6],
+    }
+
+
+def _placeholders(values: List[Any]) -> str:
+    return ", ".join("?" * len(values))
+
+
+def sqlite_filter_clause(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """
+    Translates one REQ filter into a parameterised WHERE clause over
+    ``events e``. Conditions are ANDed; tag conditions use the ``tags``
+    index table, which holds the single-letter tags of every event.
+
+    Raises:
+        ValueError: If a list-valued filter key is not a list.
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+    for key, value in filters.items():
+        if key in ("ids", "authors", "kinds") or key.startswith("#"):
+            if not isinstance(value, list):
+                raise ValueError(f"filter {key} must be a list")
+            if not value:
+                clauses.append("0")
+                continue
+        if key == "ids":
+            clauses.append(f"e.id IN ({_placeholders(value)})")
+            params.extend(value)
+        elif key == "authors":
+            clauses.append(f"e.pubkey IN ({_placeholders(value)})")
+            params.extend(value)
+        elif key == "kinds":
+            clauses.append(f"e.kind IN ({_placeholders(value)})")
+            params.extend(value)
+        elif key == "since":
+            clauses.append("e.created_at >= ?")
+            params.append(int(value))
+        elif key == "until":
+            clauses.append("e.created_at <= ?")
+            params.append(int(value))
+        elif key.startswith("#") and len(key) == 2:
+            clauses.append(
+                "EXISTS (SELECT 1 FROM tags t WHERE t.event_seq = e.seq"
+                f" AND t.name = ? AND t.value IN ({_placeholders(value)}))"
+            )
+            params.append(key[1])
+            params.extend(str(v) for v in value)
+        elif key == "search":
+            clauses.append("(e.content LIKE ? OR e.tags LIKE ?)")
+            params.extend([f"%{value}%"] * 2)
+    return " AND ".join(clauses) or "1", params
+
+
+def _query_limit(filters: Dict[str, Any], page_size: int) -> int:
+    limit = filters.get("limit")
+    if not isinstance(limit, int) or limit <= 0:
+        limit = QUERY_DEFAULT_LIMIT
+    return min(limit, page_size)
+
+
+class SqliteStorage(StorageBackend):
+    """
+    Stores events in a local SQLite database in WAL mode, for single-node
+    relays that would rather not run Postgres.
+
+    Writes go through a single thread holding the only write connection.
+    Reads run on a small thread pool, each thread with its own read-only
+    connection, so queries do not block the event loop or each other. Several
+    relay processes may share the file; SQLite serialises their writes.
+
+    Attributes:
+        path (str): Database file.
+        readers (int): Number of read threads.
+        page_size (int): Most events one query returns.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+        self, path: str, logger, readers: int = 4, page_size: int = QUERY_PAGE_SIZE
+    ):
+        self.path = path
+        self.logger = logger
+        self.readers = readers
+        self.page_size = page_size
+        self._local = threading.local()
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._reader: Optional[ThreadPoolExecutor] = None
+        self._read_conns: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self, read_only: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(read_only=True)
+            with self._lock:
+                self._read_conns.append(conn)
+        return conn
+
+    async def _write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._writer, func, *args
+        )
+
+    async def _read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._reader, func, *args
+        )
+
+    async def open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="sqlite-write")
+        self._reader = ThreadPoolExecutor(
+            self.readers, thread_name_prefix="sqlite-read"
+        )
+
+        def setup():
+            self._write_conn = self._connect(read_only=False)
+            self._write_conn.execute("PRAGMA journal_mode = WAL")
+            self._write_conn.executescript(SQLITE_SCHEMA)
+
+        await self._write(setup)
+        self.logger.info(f"SQLite storage ready at {self.path}")
+
+    async def close(self) -> None:
+        def close_writer():
+            self._write_conn.close()
+
+        await self._write(close_writer)
+        self._writer.shutdown()
+        self._reader.shutdown()
+        for conn in self._read_conns:
+            conn.close()
+
+    def _insert(self, event: Event) -> None:
+        cur = self._write_conn.cursor()
+        cur.execute(
+            "INSERT INTO events (id, pubkey, kind, created_at, tags, content, sig)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                event.event_id,
+                event.pubkey,
+                event.kind,
+                event.created_at,
+                orjson.dumps(event.tags).decode("utf-8"),
+                event.content,
+                event.sig,
+            ),
+        )
+        seq = cur.lastrowid
+        cur.executemany(
+            "INSERT INTO tags (event_seq, name, value) VALUES (?, ?, ?)",
+            [
+                (seq, tag[0], str(tag[1]))
+                for tag in event.tags
+                if len(tag) > 1 and isinstance(tag[0], str) and len(tag[0]) == 1
+            ],
+        )
+
+    def _add_sync(self, event: Event, replace: bool, trusted_only: bool) -> None:
+        conn = self._write_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if trusted_only:
+                trusted = conn.execute(
+                    "SELECT 1 FROM trust_network WHERE pubkey = ?", (event.pubkey,)
+                ).fetchone()
+                if not trusted:
+                    raise UntrustedAuthor(event.pubkey)
+            if replace:
+                conn.execute(
+                    "DELETE FROM events WHERE pubkey = ? AND kind = ?",
+                    (event.pubkey, event.kind),
+                )
+            self._insert(event)
+            conn.execute("COMMIT")
+        except sqlite3.IntegrityError as exc:
+            conn.execute("ROLLBACK")
+            raise DuplicateEvent(event.event_id) from exc
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def add_event(self, event: Event, trusted_only: bool = False) -> None:
+        await self._write(self._add_sync, event, False, trusted_only)
+
+    async def replace_event(self, event: Event, trusted_only: bool = False) -> None:
+        await self._write(self._add_sync, event, True, trusted_only)
+
+    async def delete_events(self, event: Event, event_ids: List[str]) -> None:
+        if not event_ids:
+            return
+
+        def delete():
+            self._write_conn.execute(
+                f"DELETE FROM events WHERE pubkey = ? AND id IN ({_placeholders(event_ids)})",
+                [event.pubkey, *event_ids],
+            )
+
+        await self._write(delete)
+
+    async def query(
+        self, filters: Dict[str, Any], cursor: Optional[Tuple[int, str]] = None
+    ) -> QueryResult:
+        where, params = sqlite_filter_clause(filters)
+        if cursor:
+            where += " AND (e.created_at, e.id) < (?, ?)"
+            params.extend([int(cursor[0]), str(cursor[1])])
+        sql_query = (
+            f"SELECT {SQLITE_COLUMNS} FROM events e WHERE {where}"
+            " ORDER BY e.created_at DESC, e.id DESC LIMIT ?"
+        )
+        params.append(_query_limit(filters, self.page_size))
+
+        def select():
+            return self._read_conn().execute(sql_query, params).fetchall()
+
+        events = [_row_event(row) for row in await self._read(select)]
+        return QueryResult(events, sql_query, tuple(params))
+
+    async def replaceable_events(
+        self, kinds: List[int], pubkeys: List[str], primary: bool = False
+    ) -> QueryResult:
+        where, params = sqlite_filter_clause({"kinds": kinds, "authors": pubkeys})
+        sql_query = (
+            f"SELECT {SQLITE_COLUMNS} FROM events e WHERE {where}"
+            " ORDER BY e.created_at DESC, e.id DESC"
+        )
+
+        def select():
+            return self._read_conn().execute(sql_query, params).fetchall()
+
+        events = [_row_event(row) for row in await self._read(select)]
+        return QueryResult(events, sql_query, tuple(params))
+
+    async def count(self, filters: Dict[str, Any]) -> int:
+        where, params = sqlite_filter_clause(filters)
+        sql_query = f"SELECT COUNT(*) FROM events e WHERE {where}"
+
+        def select():
+            return self._read_conn().execute(sql_query, params).fetchone()[0]
+
+        return await self._read(select)
+
+    async def sync_items(
+        self, filters: Dict[str, Any], max_items: int
+    ) -> List[Tuple[int, str]]:
+        where, params = sqlite_filter_clause(filters)
+        sql_query = (
+            f"SELECT e.created_at, e.id FROM events e WHERE {where}"
+            " ORDER BY e.created_at, e.id LIMIT ?"
+        )
+        params.append(int(max_items))
+
+        def select():
+            return self._read_conn().execute(sql_query, params).fetchall()
+
+        return await self._read(select)
+
+    async def sketch_elements(
+        self, filters: Dict[str, Any], by_author: bool, max_items: int
+    ) -> List[str]:
+        where, params = sqlite_filter_clause(filters)
+        column = "DISTINCT e.pubkey" if by_author else "e.id"
+        sql_query = f"SELECT {column} FROM events e WHERE {where} LIMIT ?"
+        params.append(int(max_items))
+
+        def select():
+            return [row[0] for row in self._read_conn().execute(sql_query, params)]
+
+        return await self._read(select)
+
+    async def check_wot(self, event: Event) -> bool:
+        def select():
+            return (
+                self._read_conn()
+                .execute(
+                    "SELECT 1 FROM trust_network WHERE pubkey = ?", (event.pubkey,)
+                )
+                .fetchone()
+            )
+
+        return bool(await self._read(select))
+
+    async def explain(self, result: QueryResult) -> List[str]:
+        def select():
+            return (
+                self._read_conn()
+                .execute(f"EXPLAIN QUERY PLAN {result.sql}", result.params)
+                .fetchall()
+            )
+
+        return [row[-1] for row in await self._read(select)]
+
+    def stats(self) -> Dict[str, Any]:
+        try:
+            size = os.path.getsize(self.path)
+            wal_size = os.path.getsize(f"{self.path}-wal")
+        except OSError:
+            size = wal_size = None
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "size_bytes": size,
+            "wal_bytes": wal_size,
+            "read_connections": len(self._read_conns),
+        }
+
+
+def create_storage(
+    backend: str,
+    logger,
+    write_conninfo: str = "",
+    read_conninfo: Union[str, Sequence[str]] = "",
+    **options,
+) -> StorageBackend:
+    """
+    Builds the storage backend named by STORAGE_BACKEND.
+
+    Args:
+        backend (str): "postgres" or "sqlite".
+        write_conninfo (str): Postgres primary connection string.
+        read_conninfo (Union[str, Sequence[str]]): Postgres replica connection strings.
+        options: ``page_size`` for every backend, ``replica_max_lag``,
+            ``replica_recent_seconds``, ``replica_probe_interval``,
+            ``write_pool_size``, ``read_pool_size``, ``pool_acquire_timeout``,
+            ``pool_max_waiting`` and ``pool_wait_observer`` for Postgres,
+            ``sqlite_path`` and ``sqlite_readers`` for SQLite.
+
+    Raises:
+        ValueError: For an unknown backend name.
+    """
+    page_size = options.get("page_size", QUERY_PAGE_SIZE)
+    if backend == "postgres":
+        return PostgresStorage(
+            write_conninfo,
+            read_conninfo,
+            logger,
+            page_size=page_size,
+            max_lag_seconds=options.get("replica_max_lag", 5),
+            recent_seconds=options.get("replica_recent_seconds", 600),
+            probe_interval=options.get("replica_probe_interval", 2),
+            write_pool_size=options.get("write_pool_size", (4, 10)),
+            read_pool_size=options.get("read_pool_size", (4, 20)),
+            acquire_timeout=options.get("pool_acquire_timeout", 3),
+            max_waiting=options.get("pool_max_waiting", 0),
+            pool_wait_observer=options.get("pool_wait_observer"),
+        )
+    if backend == "sqlite":
+        return SqliteStorage(
+            options.get("sqlite_path", "nostpy.sqlite3"),
+            logger,
+            readers=options.get("sqlite_readers", 4),
+            page_size=page_size,
+        )
+    raise ValueError(f"unknown storage backend: {backend}")
@@ -35,6 +35,22 @@ def initialize_db(logger, write_str) -> None:
                     """
                 )
 
+            # Lets COUNT filters on authors and kinds use an index-only scan
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_pubkey_kind_created_at
+                ON events (pubkey, kind, created_at);
+                """
+            )
+
+            # Negentropy sync reads events in (created_at, id) order
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_created_at_id
+                ON events (created_at, id);
+                """
+            )
+
             cur.execute(
                 """
                 CREATE TABLE IF NOT EXISTS event_mgmt (
@@ -0,0 +1,360 @@
+import hashlib
+import struct
+import sys
+from bisect import bisect_left
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+PROTOCOL_VERSION = 0x61
+ID_SIZE = 32
+FINGERPRINT_SIZE = 16
+MAX_TIMESTAMP = 2**64 - 1
+MIN_FRAME_SIZE_LIMIT = 4096
+# Ranges are split into this many fingerprinted buckets, or sent as an ID
+# list when they hold fewer than twice as many items
+BUCKETS = 16
+
+MODE_SKIP = 0
+MODE_FINGERPRINT = 1
+MODE_ID_LIST = 2
+
+# An item is its created_at as a big-endian u64 followed by the raw event ID,
+# so comparing the bytes compares (created_at, id)
+_ITEM = struct.Struct(">Q32s")
+ITEM_SIZE = _ITEM.size
+_SUM_MASK = 2**256 - 1
+_ITEM_OVERHEAD = sys.getsizeof(bytes(ITEM_SIZE)) + sys.getsizeof(_SUM_MASK) + 16
+
+
+class NegentropyError(Exception):
+    """Raised for a malformed or unsupported negentropy message."""
+
+
+def encode_varint(value: int) -> bytes:
+    """Encodes a non-negative integer as base-128 digits, most significant first."""
+    digits = [value & 0x7F]
+    value >>= 7
+    while value:
+        digits.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(digits))
+
+
+def _bound(timestamp: int, prefix: bytes = b"") -> bytes:
+    return timestamp.to_bytes(8, "big") + prefix
+
+
+MIN_BOUND = _bound(0)
+MAX_BOUND = _bound(MAX_TIMESTAMP)
+
+
+def _minimal_bound(prev_key: bytes, key: bytes) -> bytes:
+    """The shortest bound that sorts after ``prev_key`` and not after ``key``."""
+    if prev_key[:8] != key[:8]:
+        return key[:8]
+    shared = 8
+    while prev_key[shared] == key[shared]:
+        shared += 1
+    return key[: shared + 1]
+
+
+class _Reader:
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def at_end(self) -> bool:
+        return self.pos >= len(self.data)
+
+    def take(self, size: int) -> bytes:
+        if self.pos + size > len(self.data):
+            raise NegentropyError("message ended early")
+        chunk = self.data[self.pos : self.pos + size]
+        self.pos += size
+        return chunk
+
+    def varint(self) -> int:
+        value = 0
+        while True:
+            byte = self.take(1)[0]
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+
+class _BoundCodec:
+    """Encodes the bounds of one message; their timestamps are delta-encoded."""
+
+    __slots__ = ("last_in", "last_out")
+
+    def __init__(self):
+        self.last_in = 0
+        self.last_out = 0
+
+    def encode(self, bound: bytes) -> bytes:
+        timestamp = int.from_bytes(bound[:8], "big")
+        if timestamp == MAX_TIMESTAMP:
+            self.last_out = MAX_TIMESTAMP
+            delta = 0
+        else:
+            delta = timestamp - self.last_out + 1
+            self.last_out = timestamp
+        prefix = bound[8:]
+        return encode_varint(delta) + encode_varint(len(prefix)) + prefix
+
+    def decode(self, reader: _Reader) -> bytes:
+        delta = reader.varint()
+        if delta == 0 or self.last_in == MAX_TIMESTAMP:
+            timestamp = MAX_TIMESTAMP
+        else:
+            timestamp = self.last_in + delta - 1
+            if timestamp >= MAX_TIMESTAMP:
+                raise NegentropyError("bound timestamp out of range")
+        self.last_in = timestamp
+        length = reader.varint()
+        if length > ID_SIZE:
+            raise NegentropyError("bound ID prefix is too long")
+        return _bound(timestamp, reader.take(length))
+
+
+def pack_items(items: Iterable[Tuple[int, str]]) -> bytes:
+    """
+    Packs (created_at, hex ID) pairs into sorted fixed-size items, the form
+    the event handler sends them to the websocket handler in. Pairs whose ID
+    is not 32 bytes of hex are left out.
+    """
+    keys = []
+    for created_at, event_id in items:
+        try:
+            raw_id = bytes.fromhex(event_id)
+        except ValueError:
+            continue
+        if len(raw_id) == ID_SIZE:
+            keys.append(_ITEM.pack(min(max(created_at, 0), MAX_TIMESTAMP - 1), raw_id))
+    keys.sort()
+    return b"".join(keys)
+
+
+class NegentropyIndex:
+    """
+    The events matching a sync filter as (created_at, id) items in sync order.
+
+    Each item keeps only its timestamp and ID. A running sum of the IDs is
+    kept alongside, so the fingerprint of any range costs two lookups and
+    one hash instead of a pass over the range.
+
+    Attributes:
+        keys (List[bytes]): Sorted items, each created_at then the raw ID.
+    """
+
+    __slots__ = ("keys", "_sums")
+
+    def __init__(self, keys: List[bytes]):
+        self.keys = keys
+        sums = [0] * (len(keys) + 1)
+        total = 0
+        for position, key in enumerate(keys, 1):
+            total = (total + int.from_bytes(key[8:], "little")) & _SUM_MASK
+            sums[position] = total
+        self._sums = sums
+
+    @classmethod
+    def from_packed(cls, data: bytes) -> "NegentropyIndex":
+        """Builds the index from the output of ``pack_items``."""
+        if len(data) % ITEM_SIZE:
+            raise NegentropyError("packed items are truncated")
+        return cls([data[i : i + ITEM_SIZE] for i in range(0, len(data), ITEM_SIZE)])
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def fingerprint(self, start: int, end: int) -> bytes:
+        total = (self._sums[end] - self._sums[start]) & _SUM_MASK
+        digest = hashlib.sha256(
+            total.to_bytes(32, "little") + encode_varint(end - start)
+        ).digest()
+        return digest[:FINGERPRINT_SIZE]
+
+    def ids(self, start: int, end: int) -> Iterator[bytes]:
+        for position in range(start, end):
+            yield self.keys[position][8:]
+
+    def approx_size(self) -> int:
+        return sys.getsizeof(self.keys) * 2 + len(self.keys) * _ITEM_OVERHEAD
+
+
+class Negentropy:
+    """
+    One side of a negentropy reconciliation over an index.
+
+    The relay only answers: ``reconcile`` takes a client message and returns
+    the reply. ``initiate`` and ``reconcile_initiator`` play the client side,
+    which learns the IDs each side is missing.
+
+    Attributes:
+        index (NegentropyIndex): Our items.
+        frame_size_limit (int): Largest reply in bytes before hex encoding, 0 for unlimited.
+        is_initiator (bool): Whether ``initiate`` was called.
+    """
+
+    def __init__(self, index: NegentropyIndex, frame_size_limit: int = 0):
+        if frame_size_limit and frame_size_limit < MIN_FRAME_SIZE_LIMIT:
+            raise ValueError(
+                f"frame size limit must be at least {MIN_FRAME_SIZE_LIMIT}"
+            )
+        self.index = index
+        self.frame_size_limit = frame_size_limit
+        self.is_initiator = False
+
+    def initiate(self) -> bytes:
+        self.is_initiator = True
+        return bytes([PROTOCOL_VERSION]) + self._split_range(
+            _BoundCodec(), 0, len(self.index), MAX_BOUND
+        )
+
+    def reconcile(self, query: bytes) -> bytes:
+        """
+        Answers a message from the initiator.
+
+        Raises:
+            NegentropyError: If the message is malformed.
+        """
+        if self.is_initiator:
+            raise NegentropyError("the initiator must use reconcile_initiator")
+        return self._reconcile(query, [], [])
+
+    def reconcile_initiator(
+        self, query: bytes
+    ) -> Tuple[Optional[bytes], List[bytes], List[bytes]]:
+        """
+        Handles a reply as the initiator.
+
+        Returns:
+            Tuple[Optional[bytes], List[bytes], List[bytes]]: The next message,
+            or None once reconciliation is complete, then the IDs only we have
+            and the IDs only the other side has, found in this round.
+        """
+        if not self.is_initiator:
+            raise NegentropyError("call initiate first")
+        have: List[bytes] = []
+        need: List[bytes] = []
+        output = self._reconcile(query, have, need)
+        return (None if len(output) == 1 else output), have, need
+
+    def _exceeded(self, size: int) -> bool:
+        # Leaves room for the closing fingerprint range
+        return bool(self.frame_size_limit) and size > self.frame_size_limit - 200
+
+    def _reconcile(self, query: bytes, have: List[bytes], need: List[bytes]) -> bytes:
+        reader = _Reader(query)
+        version = reader.take(1)[0]
+        if version < 0x60 or version > 0x6F:
+            raise NegentropyError("invalid protocol version byte")
+        if version != PROTOCOL_VERSION:
+            if self.is_initiator:
+                raise NegentropyError(f"unsupported protocol version {version:#x}")
+            # Tells the initiator which version we speak
+            return bytes([PROTOCOL_VERSION])
+
+        index = self.index
+        size = len(index)
+        codec = _BoundCodec()
+        output = bytearray([PROTOCOL_VERSION])
+        prev_bound = MIN_BOUND
+        prev_position = 0
+        skip = False
+
+        while not reader.at_end():
+            chunk = bytearray()
+
+            def flush_skip():
+                nonlocal skip
+                if skip:
+                    skip = False
+                    chunk.extend(codec.encode(prev_bound) + encode_varint(MODE_SKIP))
+
+            curr_bound = codec.decode(reader)
+            mode = reader.varint()
+            lower = prev_position
+            upper = bisect_left(index.keys, curr_bound, lower, size)
+
+            if mode == MODE_SKIP:
+                skip = True
+            elif mode == MODE_FINGERPRINT:
+                if reader.take(FINGERPRINT_SIZE) == index.fingerprint(lower, upper):
+                    skip = True
+                else:
+                    flush_skip()
+                    chunk += self._split_range(codec, lower, upper, curr_bound)
+            elif mode == MODE_ID_LIST:
+                count = reader.varint()
+                if self.is_initiator:
+                    their_ids = {reader.take(ID_SIZE) for _ in range(count)}
+                    for event_id in index.ids(lower, upper):
+                        if event_id in their_ids:
+                            their_ids.discard(event_id)
+                        else:
+                            have.append(event_id)
+                    need.extend(their_ids)
+                    skip = True
+                else:
+                    reader.take(ID_SIZE * count)
+                    flush_skip()
+                    # Reply with all of our IDs in the range, cut short at the
+                    # frame limit; the initiator continues from the cut
+                    response_ids = bytearray()
+                    end_bound = curr_bound
+                    for position in range(lower, upper):
+                        if self._exceeded(len(output) + len(response_ids)):
+                            end_bound = index.keys[position]
+                            upper = position
+                            break
+                        response_ids += index.keys[position][8:]
+                    chunk += codec.encode(end_bound) + encode_varint(MODE_ID_LIST)
+                    chunk += encode_varint(len(response_ids) // ID_SIZE) + response_ids
+                    output += chunk
+                    chunk.clear()
+            else:
+                raise NegentropyError(f"unexpected mode {mode}")
+
+            if self._exceeded(len(output) + len(chunk)):
+                # Stop here and leave the rest as a single fingerprint range
+                output += codec.encode(MAX_BOUND) + encode_varint(MODE_FINGERPRINT)
+                output += index.fingerprint(upper, size)
+                break
+            output += chunk
+            prev_position = upper
+            prev_bound = curr_bound
+
+        return bytes(output)
+
+    def _split_range(
+        self, codec: _BoundCodec, lower: int, upper: int, upper_bound: bytes
+    ) -> bytes:
+        index = self.index
+        count = upper - lower
+        if count < BUCKETS * 2:
+            return (
+                codec.encode(upper_bound)
+                + encode_varint(MODE_ID_LIST)
+                + encode_varint(count)
+                + b"".join(index.ids(lower, upper))
+            )
+
+        output = bytearray()
+        per_bucket, extra = divmod(count, BUCKETS)
+        current = lower
+        for bucket in range(BUCKETS):
+            bucket_size = per_bucket + (1 if bucket < extra else 0)
+            fingerprint = index.fingerprint(current, current + bucket_size)
+            current += bucket_size
+            if current == upper:
+                next_bound = upper_bound
+            else:
+                next_bound = _minimal_bound(
+                    index.keys[current - 1], index.keys[current]
+                )
+            output += codec.encode(next_bound) + encode_varint(MODE_FINGERPRINT)
+            output += fingerprint
+        return bytes(output)
@@ -0,0 +1,127 @@
+import asyncio
+import cProfile
+import gc
+import io
+import os
+import pstats
+import resource
+import tracemalloc
+from typing import Any, Dict, List
+
+MAX_CAPTURE_SECONDS = 60
+
+# Only one capture of each kind may run at a time in a process
+_profile_lock = asyncio.Lock()
+_tracemalloc_lock = asyncio.Lock()
+
+
+class CaptureBusy(Exception):
+    """Raised when a capture of the same kind is already running."""
+
+
+def _clamp_seconds(seconds: float) -> float:
+    return max(0.1, min(float(seconds), MAX_CAPTURE_SECONDS))
+
+
+async def profile_for(
+    seconds: float = 5, top: int = 30, sort: str = "cumulative"
+) -> str:
+    """
+    Profiles everything the event loop runs for ``seconds`` with cProfile and
+    returns the ``top`` functions as pstats text.
+
+    Args:
+        seconds (float): Length of the capture, capped at MAX_CAPTURE_SECONDS.
+        top (int): Number of functions to return.
+        sort (str): pstats sort key, e.g. "cumulative" or "tottime".
+
+    Returns:
+        str: The pstats report.
+
+    Raises:
+        ValueError: If ``sort`` is not a pstats sort key.
+        CaptureBusy: If another profile is running in this process.
+    """
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise ValueError(f"unknown sort key: {sort}")
+    if _profile_lock.locked():
+        raise CaptureBusy("a profile is already running")
+    async with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(_clamp_seconds(seconds))
+        finally:
+            profiler.disable()
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(sort).print_stats(top)
+    return output.getvalue()
+
+
+async def tracemalloc_diff(
+    seconds: float = 10, top: int = 25, frames: int = 1
+) -> List[Dict[str, Any]]:
+    """
+    Traces allocations for ``seconds`` and returns the ``top`` source lines
+    whose live allocations grew the most over the window.
+
+    Tracing is switched off again afterwards unless it was already on, since
+    it slows every allocation down.
+
+    Args:
+        seconds (float): Length of the window, capped at MAX_CAPTURE_SECONDS.
+        top (int): Number of entries to return.
+        frames (int): Stack frames kept per allocation; above 1 entries are grouped by traceback.
+
+    Returns:
+        List[Dict[str, Any]]: Growth in bytes and allocation count per location.
+
+    Raises:
+        CaptureBusy: If another snapshot diff is running in this process.
+    """
+    if _tracemalloc_lock.locked():
+        raise CaptureBusy("a tracemalloc capture is already running")
+    async with _tracemalloc_lock:
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(max(1, frames))
+        try:
+            before = tracemalloc.take_snapshot()
+            await asyncio.sleep(_clamp_seconds(seconds))
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+
+    # Leave out the allocations made by the snapshots themselves
+    own_traces = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = before.filter_traces(own_traces)
+    after = after.filter_traces(own_traces)
+    key_type = "traceback" if frames > 1 else "lineno"
+    return [
+        {
+            "location": [str(frame) for frame in stat.traceback],
+            "size_diff": stat.size_diff,
+            "size": stat.size,
+            "count_diff": stat.count_diff,
+        }
+        for stat in after.compare_to(before, key_type)[:top]
+    ]
+
+
+def process_sizes() -> Dict[str, Any]:
+    """Returns process-wide figures every service includes in its size dump."""
+    try:
+        task_count = len(asyncio.all_tasks())
+    except RuntimeError:
+        task_count = 0
+    return {
+        "pid": os.getpid(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "gc_counts": gc.get_count(),
+        "gc_objects": len(gc.get_objects()),
+        "asyncio_tasks": task_count,
+        "tracemalloc_tracing": tracemalloc.is_tracing(),
+    }
@@ -0,0 +1,126 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+
+def _size_bucket(value: Any) -> str:
+    if not isinstance(value, list):
+        return ""
+    count = len(value)
+    if count <= 1:
+        return f"[{count}]"
+    if count <= 10:
+        return "[<=10]"
+    if count <= 100:
+        return "[<=100]"
+    return "[>100]"
+
+
+def filter_shape(filters: Dict[str, Any]) -> str:
+    """
+    Reduces a REQ filter to its shape: the sorted filter keys, with a bucketed
+    size for list values and without the values themselves.
+
+    ``{"kinds": [1], "authors": [a, b, c], "limit": 20}`` becomes
+    ``"authors[<=10] kinds[1] limit"``, so slow queries that differ only in
+    their values group together.
+    """
+    if not isinstance(filters, dict) or not filters:
+        return "empty"
+    return " ".join(f"{key}{_size_bucket(filters[key])}" for key in sorted(filters))
+
+
+class SlowQueryLog:
+    """
+    Records subscription queries slower than a threshold in a bounded ring
+    buffer and asks the storage backend to explain a sample of them, keeping
+    the plan next to the entry. On Postgres that is ``EXPLAIN (ANALYZE,
+    BUFFERS)`` on the read replica.
+
+    Every event handler worker keeps its own buffer.
+
+    Attributes:
+        threshold_ms (float): Queries at least this slow are recorded.
+        explain_sample_rate (float): Fraction of slow queries that get an EXPLAIN plan.
+        entries (Deque[Dict[str, Any]]): The most recent slow queries, oldest first.
+        total (int): Slow queries seen since start, including evicted ones.
+    """
+
+    def __init__(
+        self,
+        logger,
+        threshold_ms: float = 250,
+        explain_sample_rate: float = 0.1,
+        max_entries: int = 100,
+    ):
+        self.logger = logger
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.entries: Deque[Dict[str, Any]] = deque(maxlen=max_entries)
+        self.total = 0
+        self._explains: Set[asyncio.Task] = set()
+
+    def observe(
+        self,
+        explain: Callable[[], Awaitable[List[str]]],
+        filters: Dict[str, Any],
+        sql_query: str,
+        rows: int,
+        duration_ms: float,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Records the query if it crossed the threshold and, when sampled,
+        schedules its EXPLAIN in the background.
+
+        Args:
+            explain (Callable[[], Awaitable[List[str]]]): Returns the plan of the query.
+            filters (Dict[str, Any]): The REQ filter the query was built from.
+            sql_query (str): The SQL that ran.
+            rows (int): Number of rows it returned.
+            duration_ms (float): How long it took.
+
+        Returns:
+            Optional[Dict[str, Any]]: The recorded entry, or None if the query was fast enough.
+        """
+        if duration_ms < self.threshold_ms:
+            return None
+
+        entry = {
+            "time": int(time.time()),
+            "shape": filter_shape(filters),
+            "filter": filters,
+            "rows": rows,
+            "duration_ms": round(duration_ms, 2),
+            "sql": sql_query,
+            "plan": None,
+        }
+        self.entries.append(entry)
+        self.total += 1
+        self.logger.warning(
+            f"Slow query ({entry['duration_ms']} ms, {rows} rows) for filter shape {entry['shape']}"
+        )
+
+        if random.random() < self.explain_sample_rate:
+            task = asyncio.create_task(self.explain(explain, entry))
+            self._explains.add(task)
+            task.add_done_callback(self._explains.discard)
+        return entry
+
+    async def explain(
+        self, explain: Callable[[], Awaitable[List[str]]], entry: Dict[str, Any]
+    ) -> None:
+        try:
+            entry["plan"] = await explain()
+        except Exception as exc:
+            self.logger.error(f"Could not explain slow query: {exc}")
+            entry["plan"] = [f"EXPLAIN failed: {exc}"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "threshold_ms": self.threshold_ms,
+            "explain_sample_rate": self.explain_sample_rate,
+            "total": self.total,
+            "entries": list(self.entries),
+        }
@@ -0,0 +1,252 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional
+
+from event_classes import QUERY_DEFAULT_LIMIT
+
+LANES = ("cheap", "normal", "expensive")
+# Rows an unindexed predicate may read for each row the filter returns. Tags
+# are matched by unpacking the tags JSON of every candidate row and search by
+# a LIKE over the content, so both are checked row by row.
+TAG_SCAN_FACTOR = 100
+SEARCH_SCAN_FACTOR = 500
+# Authors narrow the rows an unindexed predicate is checked on this much
+AUTHOR_NARROWING = 10
+# A time window this wide, or none at all, leaves the scan unbounded
+FULL_SPAN_SECONDS = 7 * 86400
+MIN_SPAN_FACTOR = 0.01
+
+
+def _values(value: Any) -> list:
+    return value if isinstance(value, list) else []
+
+
+def span_factor(filters: Dict[str, Any], now: Optional[float] = None) -> float:
+    """The share of a full scan the since/until window of a filter leaves."""
+    since = filters.get("since")
+    if not isinstance(since, (int, float)):
+        return 1.0
+    until = filters.get("until")
+    if not isinstance(until, (int, float)):
+        until = time.time() if now is None else now
+    span = max(until - since, 0) / FULL_SPAN_SECONDS
+    return min(max(span, MIN_SPAN_FACTOR), 1.0)
+
+
+def estimate_cost(
+    filters: Any, max_limit: int = QUERY_DEFAULT_LIMIT, now: Optional[float] = None
+) -> float:
+    """
+    Estimates how much a REQ filter costs the database, in rows it may read.
+
+    ``ids`` are primary key lookups and cost one row each. Otherwise the
+    filter returns up to its limit, capped at ``max_limit``, read through
+    the authors or kinds indexes, or in created_at order when it has
+    neither. Tag and search predicates have no index: each multiplies the
+    rows read, less so once authors narrow them, and a since/until window
+    shorter than a week scales that scan down.
+
+    ``{"ids": [a, b]}`` costs 2, ``{"kinds": [1], "limit": 50}`` costs 51
+    and a bare ``{"#t": ["nostr"]}`` costs 20000.
+    """
+    if not isinstance(filters, dict):
+        return 1.0
+    ids = _values(filters.get("ids"))
+    if ids:
+        return float(len(ids))
+
+    limit = filters.get("limit")
+    if not isinstance(limit, int) or limit <= 0:
+        limit = QUERY_DEFAULT_LIMIT
+    rows = float(min(limit, max_limit))
+    authors = _values(filters.get("authors"))
+    kinds = _values(filters.get("kinds"))
+    if authors:
+        cost = rows + len(authors)
+    elif kinds:
+        cost = rows + len(kinds)
+    else:
+        cost = rows * 2
+
+    scan = sum(TAG_SCAN_FACTOR for key in filters if key.startswith("#"))
+    if filters.get("search"):
+        scan += SEARCH_SCAN_FACTOR
+    if scan:
+        if authors:
+            scan = max(scan / AUTHOR_NARROWING, 1)
+        cost *= scan * span_factor(filters, now)
+    return cost
+
+
+class LaneBusy(Exception):
+    """Raised when a query waits in its lane longer than the queue timeout."""
+
+
+class _Lane:
+    __slots__ = ("limit", "running", "queues", "turns", "admitted", "timed_out")
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        # Waiters per client, and the clients with waiters in turn order
+        self.queues: Dict[str, Deque[asyncio.Future]] = {}
+        self.turns: Deque[str] = deque()
+        self.admitted = 0
+        self.timed_out = 0
+
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+
+class QueryScheduler:
+    """
+    Limits how many storage queries of each cost run at once, so cheap
+    lookups never queue behind a few slow scans.
+
+    Filters are sorted by ``estimate_cost`` into a cheap, a normal and an
+    expensive lane, each with its own concurrency limit. Filters costing
+    more than ``max_cost`` are not run at all. A query waiting for its lane
+    queues with the other queries of its client, and a freed slot goes to
+    the next client in turn, so a client sending many filters waits behind
+    its own queries rather than holding up everyone else's.
+
+    Every event handler worker has its own scheduler, so the lane limits
+    apply per worker.
+
+    Attributes:
+        lanes (Dict[str, _Lane]): The lanes by name; a limit of 0 leaves a lane unlimited.
+        cheap_cost (float): Filters up to this cost run in the cheap lane.
+        expensive_cost (float): Filters above this cost run in the expensive lane.
+        max_cost (float): Filters above this cost are rejected, 0 for no limit.
+        queue_timeout (float): Seconds a query waits for its lane before LaneBusy.
+        page_size (int): The largest limit a single query is run with.
+        rejected (int): Filters rejected for their cost since start.
+    """
+
+    def __init__(
+        self,
+        lane_limits: Dict[str, int],
+        cheap_cost: float = 1000,
+        expensive_cost: float = 10000,
+        max_cost: float = 250000,
+        queue_timeout: float = 5,
+        page_size: int = QUERY_DEFAULT_LIMIT,
+        wait_observer: Optional[Callable[[str, float], None]] = None,
+    ):
+        self.lanes = {name: _Lane(lane_limits.get(name, 0)) for name in LANES}
+        self.cheap_cost = cheap_cost
+        self.expensive_cost = expensive_cost
+        self.max_cost = max_cost
+        self.queue_timeout = queue_timeout
+        self.page_size = page_size
+        self.wait_observer = wait_observer
+        self.rejected = 0
+
+    def cost(self, filters: Any) -> float:
+        return estimate_cost(filters, self.page_size)
+
+    def count_cost(self, filters: Any) -> float:
+        """Costs a COUNT filter as a full page, since it reads every match."""
+        if isinstance(filters, dict):
+            filters = {**filters, "limit": self.page_size}
+        return self.cost(filters)
+
+    def lane(self, cost: float) -> str:
+        if cost <= self.cheap_cost:
+            return "cheap"
+        if cost <= self.expensive_cost:
+            return "normal"
+        return "expensive"
+
+    def too_expensive(self, cost: float) -> bool:
+        """Tells whether a filter of this cost is rejected, and counts it if so."""
+        if self.max_cost and cost > self.max_cost:
+            self.rejected += 1
+            return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self, lane_name: str, client: str = "") -> AsyncIterator[None]:
+        """
+        Holds a slot of a lane for the duration of a query, waiting for one
+        in turn with the other clients.
+
+        Raises:
+            LaneBusy: If no slot frees up within the queue timeout.
+        """
+        lane = self.lanes[lane_name]
+        start = time.perf_counter()
+        await self._enter(lane, client)
+        if self.wait_observer is not None:
+            self.wait_observer(lane_name, (time.perf_counter() - start) * 1000)
+        try:
+            yield
+        finally:
+            self._leave(lane)
+
+    async def _enter(self, lane: _Lane, client: str) -> None:
+        if not lane.limit or (lane.running < lane.limit and not lane.turns):
+            lane.running += 1
+            lane.admitted += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        queue = lane.queues.get(client)
+        if queue is None:
+            queue = lane.queues[client] = deque()
+            lane.turns.append(client)
+        queue.append(future)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended; pass it on
+                self._leave(lane)
+            self._drop(lane, client, future)
+            if isinstance(exc, asyncio.TimeoutError):
+                lane.timed_out += 1
+                raise LaneBusy(
+                    f"no query slot freed up within {self.queue_timeout}s"
+                ) from None
+            raise
+        lane.admitted += 1
+
+    def _drop(self, lane: _Lane, client: str, future: asyncio.Future) -> None:
+        queue = lane.queues.get(client)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        if not queue:
+            del lane.queues[client]
+            lane.turns.remove(client)
+
+    def _leave(self, lane: _Lane) -> None:
+        lane.running -= 1
+        while lane.turns and lane.running < lane.limit:
+            client = lane.turns.popleft()
+            queue = lane.queues[client]
+            future = queue.popleft()
+            if queue:
+                lane.turns.append(client)
+            else:
+                del lane.queues[client]
+            if not future.done():
+                future.set_result(None)
+                lane.running += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lanes": {
+                name: {
+                    "limit": lane.limit,
+                    "running": lane.running,
+                    "waiting": lane.waiting(),
+                    "admitted": lane.admitted,
+                    "timed_out": lane.timed_out,
+                }
+                for name, lane in self.lanes.items()
+            },
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,254 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+# Scopes a message is limited by, in the order they are checked
+SCOPES = ("conn", "ip", "pubkey")
+# What a message spends tokens on: EVENTs, REQ-like messages and their filters
+ACTIONS = ("event", "req", "filter")
+
+# Refills and takes from every bucket in KEYS, or from none of them, in one
+# atomic step. ARGV holds the cost, then the rate and burst of each key.
+# Returns 0 when the message is allowed, else the 1-based index of the first
+# bucket that ran out. Redis time keeps replicas with skewed clocks in step.
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local tokens = {}
+local refused = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local level = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    level = math.min(burst, level + math.max(now - updated, 0) * rate)
+    if refused == 0 and level < cost then
+        refused = i
+    end
+    tokens[i] = level
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local level = tokens[i]
+    if refused == 0 then
+        level = level - cost
+    end
+    redis.call('HSET', key, 'tokens', tostring(level), 'updated', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return refused
+"""
+
+
+class RateLimit(NamedTuple):
+    """Tokens added per second and the most a bucket holds."""
+
+    rate: float
+    burst: float
+
+
+def parse_rate_limit(value: Optional[str]) -> Optional[RateLimit]:
+    """
+    Parses a limit written as ``rate/burst``, such as ``5/20``, or just
+    ``rate`` for a burst of one second's worth. Empty or zero turns it off.
+
+    Raises:
+        ValueError: For a malformed or negative value.
+    """
+    if not value or not value.strip():
+        return None
+    rate, _, burst = value.partition("/")
+    limit = RateLimit(float(rate), float(burst or rate))
+    if limit.rate < 0 or limit.burst < 0:
+        raise ValueError(f"rate limit cannot be negative: {value}")
+    if not limit.rate or not limit.burst:
+        return None
+    return limit
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, limit: RateLimit, now: float):
+        self.tokens = limit.burst
+        self.updated = now
+
+    def refill(self, limit: RateLimit, now: float) -> float:
+        self.tokens = min(
+            limit.burst, self.tokens + max(now - self.updated, 0) * limit.rate
+        )
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per connection, per obfuscated client IP and
+    per event author, each with separate limits for EVENTs, REQ-like
+    messages and the filters they carry.
+
+    A message is checked against every bucket that applies to it and takes
+    its cost from all of them, or from none when any is short, so a
+    refused message does not use up the other budgets. Buckets live in
+    process memory, the least recently used dropped beyond ``max_buckets``.
+    With a Redis client, the IP and pubkey buckets are also kept in Redis,
+    so the limits hold across websocket handler replicas; if Redis fails,
+    the local buckets alone decide.
+
+    Attributes:
+        limits (Dict[Tuple[str, str], RateLimit]): Limit per (scope, action); missing pairs are unlimited.
+        shared_scopes (Tuple[str, ...]): Scopes also limited through Redis.
+        refused (Dict[Tuple[str, str], int]): Refused messages per (action, scope).
+    """
+
+    def __init__(
+        self,
+        limits: Dict[Tuple[str, str], RateLimit],
+        logger,
+        redis_client=None,
+        max_buckets: int = 100000,
+        shared_scopes: Tuple[str, ...] = ("ip", "pubkey"),
+        key_prefix: str = "rl",
+    ):
+        self.limits = limits
+        self.logger = logger
+        self.redis_client = redis_client
+        self.max_buckets = max_buckets
+        self.shared_scopes = shared_scopes
+        self.key_prefix = key_prefix
+        self.refused: Dict[Tuple[str, str], int] = {}
+        self._buckets: "OrderedDict[Tuple[str, str, str], TokenBucket]" = (
+            OrderedDict()
+        )
+        self._script = None
+
+    def __bool__(self) -> bool:
+        return bool(self.limits)
+
+    def _applicable(
+        self, action: str, keys: Dict[str, Optional[str]]
+    ) -> List[Tuple[str, str, RateLimit]]:
+        return [
+            (scope, keys[scope], self.limits[(scope, action)])
+            for scope in SCOPES
+            if keys.get(scope) and (scope, action) in self.limits
+        ]
+
+    def take_local(
+        self,
+        action: str,
+        keys: Dict[str, Optional[str]],
+        cost: float = 1,
+        now: Optional[float] = None,
+    ) -> Optional[str]:
+        """
+        Takes ``cost`` tokens from the in-memory buckets of ``keys``.
+
+        Returns:
+            Optional[str]: The scope whose bucket ran out, or None if allowed.
+        """
+        now = time.monotonic() if now is None else now
+        buckets = []
+        refused = None
+        for scope, key, limit in self._applicable(action, keys):
+            bucket_key = (scope, key, action)
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = TokenBucket(limit, now)
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(bucket_key)
+            if bucket.refill(limit, now) < cost and refused is None:
+                refused = scope
+            buckets.append(bucket)
+        if refused is None:
+            for bucket in buckets:
+                bucket.tokens -= cost
+        return refused
+
+    async def take_shared(
+        self, action: str, keys: Dict[str, Optional[str]], cost: float = 1
+    ) -> Optional[str]:
+        """Takes ``cost`` tokens from the Redis buckets of the shared scopes."""
+        applicable = [
+            entry
+            for entry in self._applicable(action, keys)
+            if entry[0] in self.shared_scopes
+        ]
+        if self.redis_client is None or not applicable:
+            return None
+        if self._script is None:
+            self._script = self.redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        args: List[float] = [cost]
+        for _, _, limit in applicable:
+            args += [limit.rate, limit.burst]
+        try:
+            refused = await self._script(
+                keys=[
+                    f"{self.key_prefix}:{scope}:{action}:{key}"
+                    for scope, key, _ in applicable
+                ],
+                args=args,
+            )
+        except Exception as exc:
+            self.logger.warning(f"Shared rate limit check failed: {exc}")
+            return None
+        return applicable[int(refused) - 1][0] if int(refused) else None
+
+    async def check(
+        self, action: str, cost: float = 1, **keys: Optional[str]
+    ) -> Optional[str]:
+        """
+        Checks one message against the limits of ``action``, given the
+        ``conn``, ``ip`` and ``pubkey`` it came from; a missing key skips
+        that scope.
+
+        Returns:
+            Optional[str]: The scope that refused the message, or None if allowed.
+        """
+        refused = self.take_local(action, keys, cost)
+        if refused is None:
+            refused = await self.take_shared(action, keys, cost)
+        if refused is not None:
+            counter = (action, refused)
+            self.refused[counter] = self.refused.get(counter, 0) + 1
+        return refused
+
+    def forget(self, scope: str, key: str) -> None:
+        """Drops the buckets of one key, such as a closed connection."""
+        for action in ACTIONS:
+            self._buckets.pop((scope, key, action), None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buckets": len(self._buckets),
+            "refused": sum(self.refused.values()),
+        }
+
+
+# Default of each RATE_LIMIT_<SCOPE>_<ACTION> setting. Authors are only
+# known for EVENTs, so pubkeys have no REQ or filter limits.
+RATE_LIMIT_DEFAULTS = {
+    ("conn", "event"): "10/50",
+    ("conn", "req"): "10/50",
+    ("conn", "filter"): "50/200",
+    ("ip", "event"): "30/150",
+    ("ip", "req"): "30/150",
+    ("ip", "filter"): "150/600",
+    ("pubkey", "event"): "5/30",
+}
+
+
+def rate_limits_from_env(environ) -> Dict[Tuple[str, str], RateLimit]:
+    """Reads the RATE_LIMIT_<SCOPE>_<ACTION> settings, leaving out disabled ones."""
+    limits = {}
+    for (scope, action), default in RATE_LIMIT_DEFAULTS.items():
+        name = f"RATE_LIMIT_{scope.upper()}_{action.upper()}"
+        limit = parse_rate_limit(environ.get(name, default))
+        if limit is not None:
+            limits[(scope, action)] = limit
+    return limits
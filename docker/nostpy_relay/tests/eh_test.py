@@ -1,12 +1,38 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
 import unittest
+from contextlib import asynccontextmanager
 from http import HTTPStatus
 from unittest.mock import AsyncMock, MagicMock, patch
+import orjson
+from psycopg_pool import PoolTimeout
 from requests import RequestException
 from fastapi.testclient import TestClient
 import sys
 
 sys.path.insert(0, "../")
 import event_handler as app
+from event_classes import (
+    Event,
+    Subscription,
+    count_sketch_key,
+    replaceable_cache_key,
+)
+from event_storage import (
+    DuplicateEvent,
+    PostgresStorage,
+    SqliteStorage,
+    StorageBusy,
+    UntrustedAuthor,
+)
+from profiling import profile_for, tracemalloc_diff
+from query_log import SlowQueryLog, filter_shape
+from query_scheduler import LaneBusy, QueryScheduler, estimate_cost
+from utils import admin_authorized
+from websocket_classes import HotTimeline, split_redis_payload
 
 
 class TestEvent(unittest.TestCase):
@@ -37,7 +63,7 @@ class TestEvent(unittest.TestCase):
         # Mock Redis and PostgreSQL clients
         self.mock_redis = patch("event_handler.redis.Redis").start()
         self.mock_async_connection_pool = patch(
-            "event_handler.AsyncConnectionPool"
+            "event_storage.AsyncConnectionPool"
         ).start()
 
         # Mock instances for connection pools
@@ -187,5 +213,920 @@ class TestEvent(unittest.TestCase):
         )
 
 
+class TestEventRecord(unittest.TestCase):
+    def test_from_raw_keeps_original_bytes(self):
+        raw = b'{"id":"test_id","pubkey":"test_pubkey","kind":1,"created_at":123456,"tags":[["t","x"]],"content":"c","sig":"test_sig"}'
+        event_obj = Event.from_raw(raw)
+        self.assertIs(event_obj.raw, raw)
+        self.assertEqual(event_obj.tags, [["t", "x"]])
+        self.assertEqual(event_obj.tags_param().dumps(event_obj.raw), raw)
+
+    def test_tags_param_without_raw(self):
+        event_obj = Event("id", "pubkey", 1, 1, [["t", "x"]], "c", "sig")
+        self.assertEqual(event_obj.tags_param(), '[["t","x"]]')
+
+
+class TestCounts(unittest.IsolatedAsyncioTestCase):
+    def test_count_sketch_entries(self):
+        follow = Event("f1", "alice", 3, 1, [["p", "bob"], ["p", "bob"]], "", "s")
+        self.assertEqual(
+            follow.count_sketch_entries({3, 7}, {"p", "e"}),
+            [(count_sketch_key(3, "p", "bob"), "alice")],
+        )
+        reaction = Event("r1", "alice", 7, 1, [["e", "note"], ["t", "x"]], "+", "s")
+        self.assertEqual(
+            reaction.count_sketch_entries({3, 7}, {"p", "e"}),
+            [("hll:7:e:note", "r1")],
+        )
+        note = Event("n1", "alice", 1, 1, [["p", "bob"]], "", "s")
+        self.assertEqual(note.count_sketch_entries({3, 7}, {"p", "e"}), [])
+
+    def test_count_sketch_keys(self):
+        subscription = Subscription({"event_dict": []})
+        keys = subscription.count_sketch_keys(
+            {"kinds": [3], "#p": ["bob", "carol"], "limit": 1}, {3}, {"p"}
+        )
+        self.assertEqual(keys, ["hll:3:p:bob", "hll:3:p:carol"])
+        for filters in (
+            {"kinds": [3, 7], "#p": ["bob"]},
+            {"kinds": [3], "#p": ["bob"], "authors": ["alice"]},
+            {"kinds": [1], "#p": ["bob"]},
+            {"kinds": [3], "#t": ["bob"]},
+            {"#p": ["bob"]},
+        ):
+            self.assertIsNone(subscription.count_sketch_keys(filters, {3}, {"p"}))
+
+    async def test_count_query_builder(self):
+        subscription = Subscription({"event_dict": []})
+        filter_set = await subscription.parse_filters(
+            {"kinds": [1], "limit": 5}, MagicMock()
+        )
+        self.assertEqual(
+            subscription.count_query_builder(*filter_set, MagicMock()),
+            "SELECT COUNT(*) FROM events WHERE kind = ANY(%s)",
+        )
+        self.assertEqual(subscription.params, [[1]])
+
+
+class TestQueryBuilder(unittest.IsolatedAsyncioTestCase):
+    async def build(self, filters, **kwargs):
+        subscription = Subscription({"event_dict": [filters]})
+        filter_set = await subscription.parse_filters(filters, MagicMock())
+        query = subscription.base_query_builder(*filter_set, MagicMock(), **kwargs)
+        return query, subscription.params
+
+    async def test_orders_by_created_at_and_id(self):
+        self.assertEqual(
+            await self.build({"kinds": [1], "since": 10, "until": 20}),
+            (
+                "SELECT * FROM events WHERE kind = ANY(%s) AND created_at >= %s"
+                " AND created_at <= %s ORDER BY created_at DESC, id DESC LIMIT 100 ;",
+                [[1], 10, 20],
+            ),
+        )
+
+    async def test_cursor_and_limit_cap(self):
+        cursor = (150, "ab" * 32)
+        query = await self.build({"limit": 2000}, max_limit=500, cursor=cursor)
+        self.assertEqual(
+            query,
+            (
+                "SELECT * FROM events WHERE (created_at, id) < (%s, %s)"
+                " ORDER BY created_at DESC, id DESC LIMIT 500 ;",
+                [150, "ab" * 32],
+            ),
+        )
+        query, _ = await self.build({}, cursor=(150, "x'; DROP TABLE"))
+        self.assertIsNone(query)
+
+    async def test_filter_values_are_bound(self):
+        injection = "x') OR 1=1 --"
+        query, params = await self.build(
+            {"authors": [injection], "#e": [injection], "search": injection}
+        )
+        self.assertNotIn(injection, query)
+        self.assertEqual(
+            params,
+            [
+                [injection],
+                json.dumps(["e", injection]),
+                f"%{injection}%",
+                f"%{injection}%",
+            ],
+        )
+
+    async def test_non_list_values_match_nothing(self):
+        query, params = await self.build({"kinds": "1) OR (1=1", "ids": ["ab"]})
+        self.assertEqual(
+            query,
+            "SELECT * FROM events WHERE FALSE AND id = ANY(%s)"
+            " ORDER BY created_at DESC, id DESC LIMIT 100 ;",
+        )
+        self.assertEqual(params, [["ab"]])
+
+
+class TestSlowQueryLog(unittest.IsolatedAsyncioTestCase):
+    def test_filter_shape_drops_values(self):
+        self.assertEqual(
+            filter_shape({"kinds": [1], "authors": ["a", "b", "c"], "limit": 20}),
+            "authors[<=10] kinds[1] limit",
+        )
+        self.assertEqual(filter_shape({}), "empty")
+
+    async def test_records_slow_queries_and_explains_sample(self):
+        explained = []
+
+        async def explain():
+            explained.append(True)
+            return ["Seq Scan on events", "Execution Time: 1.0 ms"]
+
+        query_log = SlowQueryLog(
+            MagicMock(), threshold_ms=100, explain_sample_rate=1.0, max_entries=2
+        )
+        self.assertIsNone(query_log.observe(explain, {"kinds": [1]}, "SELECT 1", 5, 50))
+        for duration in (150, 200, 250):
+            query_log.observe(explain, {"kinds": [1]}, "SELECT 1 ;", 5, duration)
+        await asyncio.gather(*query_log._explains)
+
+        snapshot = query_log.snapshot()
+        self.assertEqual(snapshot["total"], 3)
+        self.assertEqual([e["duration_ms"] for e in snapshot["entries"]], [200, 250])
+        self.assertEqual(snapshot["entries"][-1]["plan"][0], "Seq Scan on events")
+        self.assertEqual(len(explained), 3)
+
+
+class TestAdminHelpers(unittest.IsolatedAsyncioTestCase):
+    def test_admin_authorized(self):
+        self.assertTrue(admin_authorized("Bearer secret", "secret"))
+        self.assertFalse(admin_authorized("Bearer wrong", "secret"))
+        self.assertFalse(admin_authorized("secret", "secret"))
+        self.assertFalse(admin_authorized("Bearer ", None))
+
+    async def test_captures(self):
+        report = await profile_for(seconds=0.1, top=5)
+        self.assertIn("function calls", report)
+        with self.assertRaises(ValueError):
+            await profile_for(seconds=0.1, sort="unknown")
+
+        async def allocate(store):
+            await asyncio.sleep(0.02)
+            store.append([object() for _ in range(1000)])
+
+        store = []
+        diff, _ = await asyncio.gather(
+            tracemalloc_diff(seconds=0.2, top=5), allocate(store)
+        )
+        self.assertTrue(diff)
+        self.assertEqual(set(diff[0]), {"location", "size_diff", "size", "count_diff"})
+
+
+def make_event(event_id, pubkey="author", kind=1, created_at=100, tags=None):
+    return Event(event_id, pubkey, kind, created_at, tags or [], "content", "sig")
+
+
+class TestSqliteStorage(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = SqliteStorage(
+            os.path.join(self.directory.name, "events.sqlite3"), MagicMock()
+        )
+        await self.storage.open()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.directory.cleanup()
+
+    async def test_add_query_and_count(self):
+        await self.storage.add_event(make_event("a", tags=[["e", "x"], ["t", "n"]]))
+        await self.storage.add_event(make_event("b", created_at=200, tags=[["e", "y"]]))
+        await self.storage.add_event(make_event("c", pubkey="other", kind=7))
+        with self.assertRaises(DuplicateEvent):
+            await self.storage.add_event(make_event("a"))
+
+        result = await self.storage.query({"authors": ["author"], "kinds": [1]})
+        self.assertEqual([event["id"] for event in result.events], ["b", "a"])
+        self.assertEqual(result.events[1]["tags"], [["e", "x"], ["t", "n"]])
+        result = await self.storage.query({"#e": ["x", "z"]})
+        self.assertEqual([event["id"] for event in result.events], ["a"])
+        result = await self.storage.query({"since": 150, "limit": 1})
+        self.assertEqual([event["id"] for event in result.events], ["b"])
+        self.assertEqual(await self.storage.count({"kinds": [1, 7]}), 3)
+        self.assertEqual(
+            await self.storage.sync_items({"kinds": [1, 7]}, 10),
+            [(100, "a"), (100, "c"), (200, "b")],
+        )
+        self.assertTrue(await self.storage.explain(result))
+
+    async def test_query_pages(self):
+        self.storage.page_size = 2
+        for event_id in "abcde":
+            await self.storage.add_event(make_event(event_id, created_at=100))
+        await self.storage.add_event(make_event("f", created_at=200))
+
+        pages, cursor = [], None
+        while True:
+            result = await self.storage.query({"kinds": [1], "limit": 10}, cursor)
+            pages.append([event["id"] for event in result.events])
+            if len(result.events) < 2:
+                break
+            last = result.events[-1]
+            cursor = (last["created_at"], last["id"])
+        self.assertEqual(pages, [["f", "e"], ["d", "c"], ["b", "a"], []])
+
+    async def test_replace_and_delete(self):
+        await self.storage.replace_event(make_event("p1", kind=0, tags=[["p", "x"]]))
+        await self.storage.replace_event(make_event("p2", kind=0, created_at=200))
+        await self.storage.add_event(make_event("n1"))
+        await self.storage.delete_events(make_event("d", kind=5), ["n1", "missing"])
+
+        result = await self.storage.query({"authors": ["author"]})
+        self.assertEqual([event["id"] for event in result.events], ["p2"])
+        self.assertEqual(await self.storage.count({"#p": ["x"]}), 0)
+
+    async def test_trusted_only(self):
+        await self.storage._write(
+            self.storage._write_conn.execute,
+            "INSERT INTO trust_network (pubkey) VALUES (?)",
+            ("author",),
+        )
+        await self.storage.add_event(make_event("a"), trusted_only=True)
+        with self.assertRaises(UntrustedAuthor):
+            await self.storage.add_event(make_event("b", pubkey="x"), trusted_only=True)
+        with self.assertRaises(UntrustedAuthor):
+            await self.storage.replace_event(
+                make_event("p", pubkey="x", kind=0), trusted_only=True
+            )
+        self.assertEqual(await self.storage.count({}), 1)
+
+    async def test_sketch_elements(self):
+        await self.storage.add_event(make_event("r1", kind=7, tags=[["e", "x"]]))
+        await self.storage.add_event(make_event("r2", kind=7, tags=[["e", "x"]]))
+        await self.storage.add_event(make_event("r3", kind=7, tags=[["e", "y"]]))
+        filters = {"kinds": [7], "#e": ["x"]}
+        self.assertEqual(
+            sorted(await self.storage.sketch_elements(filters, False, 10)),
+            ["r1", "r2"],
+        )
+        self.assertEqual(
+            await self.storage.sketch_elements(filters, True, 10), ["author"]
+        )
+        self.assertEqual(len(await self.storage.sketch_elements(filters, False, 1)), 1)
+
+
+class FakeRedis:
+    """The few string commands the replaceable cache uses, kept in a dict."""
+
+    def __init__(self):
+        self.values = {}
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if not (nx and key in self.values):
+            self.values[key] = value.decode() if isinstance(value, bytes) else value
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.set = redis_client.set
+
+    async def execute(self):
+        return []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class TestReplaceableCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = SqliteStorage(
+            os.path.join(self.directory.name, "events.sqlite3"), MagicMock()
+        )
+        await self.storage.open()
+        self.app = MagicMock(storage=self.storage)
+        self.redis = FakeRedis()
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.directory.cleanup()
+
+    def test_replaceable_pairs(self):
+        subscription = Subscription({"event_dict": []})
+        self.assertEqual(
+            subscription.replaceable_pairs(
+                {"kinds": [0, 3], "authors": ["a", "b", "a"], "limit": 4}, {0, 3}
+            ),
+            [(0, "a"), (0, "b"), (3, "a"), (3, "b")],
+        )
+        for filters in (
+            {"kinds": [0, 1], "authors": ["a"]},
+            {"kinds": [0], "authors": []},
+            {"kinds": [0], "authors": ["a"], "#p": ["b"]},
+            {"authors": ["a"]},
+        ):
+            self.assertIsNone(subscription.replaceable_pairs(filters, {0, 3}))
+
+    async def test_lookup_fills_cache_for_misses(self):
+        await self.storage.replace_event(make_event("a0", pubkey="a", kind=0))
+        await self.storage.replace_event(make_event("b3", pubkey="b", kind=3))
+        filters = {"kinds": [0, 3], "authors": ["a", "b"]}
+        pairs = Subscription({"event_dict": []}).replaceable_pairs(filters, {0, 3})
+
+        events = await app.query_replaceable(self.app, self.redis, filters, pairs)
+        self.assertEqual({event["id"] for event in events}, {"a0", "b3"})
+        self.assertEqual(self.redis.values[replaceable_cache_key(0, "b")], "")
+        self.assertIn('"a0"', self.redis.values[replaceable_cache_key(0, "a")])
+
+        # Answered from the cache alone, including the cached absence
+        self.storage.replaceable_events = AsyncMock()
+        events = await app.query_replaceable(
+            self.app, self.redis, {**filters, "limit": 1}, pairs
+        )
+        self.assertEqual(len(events), 1)
+        self.storage.replaceable_events.assert_not_called()
+
+    async def test_deletion_tombstone_reads_primary_without_caching(self):
+        key = replaceable_cache_key(0, "a")
+        self.redis.values[key] = orjson.dumps(
+            {"id": "a0", "pubkey": "a", "kind": 0, "created_at": 100}
+        ).decode()
+        await app.update_replaceable_cache(self.redis, make_event("d", "a", kind=5))
+        self.assertEqual(self.redis.values[key], app.REPLACEABLE_TOMBSTONE)
+
+        self.storage.replaceable_events = AsyncMock(
+            wraps=self.storage.replaceable_events
+        )
+        filters = {"kinds": [0], "authors": ["a"]}
+        events = await app.query_replaceable(self.app, self.redis, filters, [(0, "a")])
+        self.assertEqual(events, [])
+        self.storage.replaceable_events.assert_awaited_once_with(
+            [0], ["a"], primary=True
+        )
+        self.assertEqual(self.redis.values[key], app.REPLACEABLE_TOMBSTONE)
+
+
+class TestReplicaRouting(unittest.TestCase):
+    def setUp(self):
+        self.storage = PostgresStorage(
+            "host=primary port=5432",
+            ["host=r1 port=5432", "host=r2 port=5433"],
+            MagicMock(),
+            max_lag_seconds=5,
+            recent_seconds=600,
+        )
+        self.first, self.second = self.storage.replicas
+        for replica in (self.first, self.second, self.storage.primary):
+            replica.pool = MagicMock(max_size=10)
+
+    def test_names(self):
+        self.assertEqual(
+            [r.name for r in self.storage.replicas], ["r1:5432", "r2:5433"]
+        )
+
+    def test_least_utilized_replica(self):
+        self.first.in_flight = 3
+        self.assertIs(self.storage._choose(), self.second)
+        self.second.healthy = False
+        self.assertIs(self.storage._choose(), self.first)
+        self.first.healthy = False
+        self.assertIs(self.storage._choose(), self.storage.primary)
+
+    def test_recent_queries_avoid_lagging_replicas(self):
+        self.second.in_flight = 3
+        self.first.lag_seconds = 30
+        recent = self.storage._is_recent({"since": int(time.time()) - 60})
+        self.assertTrue(recent)
+        self.assertFalse(self.storage._is_recent({"since": 1000}))
+        self.assertIs(self.storage._choose(recent), self.second)
+        self.assertIs(self.storage._choose(False), self.first)
+        self.second.lag_seconds = 10
+        self.assertIs(self.storage._choose(recent), self.storage.primary)
+
+    def test_read_conn_strs(self):
+        with patch.dict(
+            "os.environ", {"PGHOST_READ": "r1, r2:5433", "PGPORT_READ": "5432"}
+        ):
+            conn_strs = app.get_read_conn_strs()
+        self.assertEqual(len(conn_strs), 2)
+        self.assertIn("host=r1 port=5432", conn_strs[0])
+        self.assertIn("host=r2 port=5433", conn_strs[1])
+
+
+class FakePool:
+    def __init__(self, stats, available=True, conn=None):
+        self.stats = stats
+        self.available = available
+        self.conn = conn or MagicMock()
+
+    @asynccontextmanager
+    async def connection(self):
+        if not self.available:
+            raise PoolTimeout("couldn't get a connection after 3.00 sec")
+        yield self.conn
+
+    def get_stats(self):
+        return self.stats
+
+
+class TestConnectionPools(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.waits = []
+        self.storage = PostgresStorage(
+            "host=primary port=5432",
+            "host=r1 port=5432",
+            MagicMock(),
+            pool_wait_observer=lambda *wait: self.waits.append(wait),
+        )
+        stats = {
+            "pool_max": 10,
+            "pool_size": 6,
+            "pool_available": 2,
+            "requests_waiting": 0,
+        }
+        self.storage.write_pool = self.storage.primary.pool = FakePool(stats)
+        self.replica = self.storage.replicas[0]
+        self.replica.pool = FakePool({**stats, "requests_waiting": 3}, False)
+
+    async def test_acquire_timeout_is_busy(self):
+        async with self.storage._write_connection():
+            pass
+        with self.assertRaises(StorageBusy):
+            async with self.storage._read_connection(self.replica):
+                pass
+        self.assertEqual(self.replica.in_flight, 0)
+        self.assertEqual(
+            [wait[:2] for wait in self.waits],
+            [("write", "primary"), ("read", "r1:5432")],
+        )
+
+    async def test_errors_after_acquire_pass_through(self):
+        with self.assertRaises(PoolTimeout):
+            async with self.storage._write_connection():
+                raise PoolTimeout("raised by the caller")
+
+    def test_pool_stats(self):
+        stats = self.storage.pool_stats()
+        self.assertEqual(
+            [(s["role"], s["server"]) for s in stats],
+            [("write", "primary"), ("read", "r1:5432")],
+        )
+        self.assertEqual(stats[0]["in_use"], 4)
+        self.assertEqual(stats[1]["waiting"], 3)
+
+    async def test_busy_count_is_503(self):
+        storage = MagicMock(count=AsyncMock(side_effect=StorageBusy("busy")))
+        redis_client = AsyncMock()
+        redis_client.get.return_value = None
+        with patch.object(
+            app, "get_redis_client", AsyncMock(return_value=redis_client)
+        ):
+            response, status = await app.process_count(
+                MagicMock(storage=storage),
+                {"event_dict": [{"kinds": [1]}], "subscription_id": "c"},
+            )
+        self.assertEqual(status, 503)
+        self.assertEqual(response["count"], 0)
+
+
+class FakeWriteConnection:
+    """A connection and cursor in one, recording statements and pipeline mode."""
+
+    def __init__(self, rowcount=1):
+        self.rowcount = rowcount
+        self.statements = []
+        self.pipelined = False
+
+    @asynccontextmanager
+    async def cursor(self):
+        yield self
+
+    @asynccontextmanager
+    async def pipeline(self):
+        self.pipelined = True
+        yield
+        self.pipelined = False
+
+    async def execute(self, query, params=None):
+        self.statements.append((" ".join(query.split())[:25], self.pipelined))
+
+    async def commit(self):
+        self.statements.append(("COMMIT", self.pipelined))
+
+
+class TestPipelinedWrites(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.storage = PostgresStorage("host=primary", "host=r1", MagicMock())
+
+    def connect(self, rowcount=1):
+        conn = FakeWriteConnection(rowcount)
+        self.storage.write_pool = FakePool({}, conn=conn)
+        return conn
+
+    async def test_replace_is_one_pipeline(self):
+        conn = self.connect()
+        await self.storage.replace_event(make_event("p", kind=0), trusted_only=True)
+        self.assertEqual(
+            conn.statements,
+            [
+                ("DELETE FROM events WHERE ", True),
+                ("INSERT INTO events (id,pu", True),
+                ("COMMIT", True),
+            ],
+        )
+
+    async def test_untrusted_insert(self):
+        self.connect(rowcount=0)
+        with self.assertRaises(UntrustedAuthor):
+            await self.storage.add_event(make_event("a"), trusted_only=True)
+
+
+class TestQueryScheduler(unittest.IsolatedAsyncioTestCase):
+    def test_estimate_cost(self):
+        now = 1700000000
+        self.assertEqual(estimate_cost({"ids": ["a", "b"]}), 2)
+        self.assertEqual(estimate_cost({"kinds": [1], "limit": 50}), 51)
+        self.assertEqual(estimate_cost({"authors": ["a"] * 3, "limit": 50}), 53)
+        self.assertEqual(estimate_cost({"#t": ["nostr"]}, now=now), 20000)
+        self.assertEqual(
+            estimate_cost({"#t": ["nostr"], "since": now - 3600}, now=now), 200
+        )
+        self.assertEqual(
+            estimate_cost({"authors": ["a"], "#e": ["x"], "limit": 50}), 510
+        )
+        self.assertEqual(estimate_cost({"search": "x", "limit": 5000}, 500), 500000)
+
+    def test_lanes_and_rejection(self):
+        scheduler = QueryScheduler({}, max_cost=250000, page_size=500)
+        self.assertEqual(scheduler.lane(scheduler.cost({"ids": ["a"]})), "cheap")
+        self.assertEqual(
+            scheduler.lane(scheduler.cost({"authors": ["a"], "#e": ["x"]})),
+            "normal",
+        )
+        self.assertEqual(scheduler.lane(scheduler.cost({"#t": ["x"]})), "expensive")
+        self.assertFalse(scheduler.too_expensive(250000))
+        self.assertTrue(scheduler.too_expensive(250001))
+        self.assertEqual(scheduler.rejected, 1)
+
+    async def test_slots_go_to_clients_in_turn(self):
+        scheduler = QueryScheduler({"expensive": 1})
+        order = []
+        release = asyncio.Event()
+
+        async def query(client, name):
+            async with scheduler.slot("expensive", client):
+                order.append(name)
+                await release.wait()
+
+        first = asyncio.create_task(query("a", "a0"))
+        await asyncio.sleep(0)
+        queued = [
+            asyncio.create_task(query(client, name))
+            for client, name in [("a", "a1"), ("a", "a2"), ("b", "b1")]
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()["lanes"]["expensive"]["waiting"], 3)
+        release.set()
+        await asyncio.gather(first, *queued)
+        self.assertEqual(order, ["a0", "a1", "b1", "a2"])
+        self.assertEqual(scheduler.stats()["lanes"]["expensive"]["running"], 0)
+
+    async def test_queue_timeout_is_busy(self):
+        scheduler = QueryScheduler({"cheap": 1}, queue_timeout=0.01)
+        async with scheduler.slot("cheap", "a"):
+            with self.assertRaises(LaneBusy):
+                async with scheduler.slot("cheap", "b"):
+                    pass
+        lane = scheduler.stats()["lanes"]["cheap"]
+        self.assertEqual(
+            (lane["running"], lane["waiting"], lane["timed_out"]), (0, 0, 1)
+        )
+
+    async def test_expensive_subscription_is_413(self):
+        storage = MagicMock(query=AsyncMock())
+        with patch.object(app, "get_redis_client", AsyncMock()):
+            response, status = await app.process_subscription(
+                MagicMock(storage=storage),
+                {
+                    "event_dict": [{"ids": ["a"]}, {"search": "x", "limit": 500}],
+                    "subscription_id": "s",
+                },
+            )
+        self.assertEqual(status, 413)
+        self.assertEqual(response["event"], "EOSE")
+        storage.query.assert_not_called()
+
+
+class TestRedisClient(unittest.IsolatedAsyncioTestCase):
+    async def test_lifespan_opens_one_shared_client(self):
+        storage = MagicMock(open=AsyncMock(), close=AsyncMock())
+        redis_client = MagicMock(close=AsyncMock())
+        worker_app = MagicMock()
+        with patch.object(app, "create_storage", return_value=storage), patch.object(
+            app, "create_redis_client", return_value=redis_client
+        ) as create, patch.object(app, "setup_telemetry"):
+            async with app.lifespan(worker_app):
+                self.assertIs(await app.get_redis_client(worker_app), redis_client)
+                self.assertIs(await app.get_redis_client(worker_app), redis_client)
+        create.assert_called_once()
+        redis_client.close.assert_awaited_once()
+        storage.close.assert_awaited_once()
+
+
+class TestTelemetrySetup(unittest.TestCase):
+    def setup(self, tracer_provider, meter_provider):
+        with patch.object(
+            app.trace, "get_tracer_provider", return_value=tracer_provider
+        ), patch.object(
+            app.metrics, "get_meter_provider", return_value=meter_provider
+        ), patch.object(
+            app.trace, "set_tracer_provider"
+        ) as set_tracer, patch.object(
+            app.metrics, "set_meter_provider"
+        ) as set_meter, patch.multiple(
+            app,
+            OTLPSpanExporter=MagicMock(),
+            OTLPMetricExporter=MagicMock(),
+            BatchSpanProcessor=MagicMock(),
+            PeriodicExportingMetricReader=MagicMock(),
+            RedisInstrumentor=MagicMock(),
+        ):
+            app.setup_telemetry()
+        return set_tracer, set_meter
+
+    def test_installs_providers_once_per_worker(self):
+        set_tracer, set_meter = self.setup(
+            app.trace.ProxyTracerProvider(), app.metrics.NoOpMeterProvider()
+        )
+        set_tracer.assert_called_once()
+        set_meter.assert_called_once()
+        resource = set_meter.call_args.args[0]._sdk_config.resource
+        self.assertEqual(
+            resource.attributes["service.instance.id"], app.SERVICE_INSTANCE_ID
+        )
+
+    def test_keeps_installed_providers(self):
+        set_tracer, set_meter = self.setup(
+            app.TracerProvider(), app.MeterProvider(metric_readers=[])
+        )
+        set_tracer.assert_not_called()
+        set_meter.assert_not_called()
+
+
+class FakeSketchRedis:
+    """HyperLogLog commands kept as exact sets, plain keys and the sketch add script."""
+
+    def __init__(self):
+        self.sketches = {}
+        self.values = {}
+        self.expiring = set()
+
+    def _exists(self, key):
+        return key in self.sketches or key in self.values
+
+    async def pfadd(self, key, *elements):
+        self.sketches.setdefault(key, set()).update(elements)
+
+    async def pfcount(self, *keys):
+        return len(set().union(*(self.sketches.get(key, set()) for key in keys)))
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value, nx=False, ex=None):
+        if nx and self._exists(key):
+            return None
+        self.values[key] = value
+        return True
+
+    async def setex(self, key, seconds, value):
+        self.values[key] = value
+
+    async def expire(self, key, seconds):
+        if self._exists(key):
+            self.expiring.add(key)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.sketches.pop(key, None)
+            self.values.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakeSketchPipeline(self)
+
+    def register_script(self, script):
+        async def add(keys, args):
+            for key, element in zip(keys, args):
+                if key in self.sketches:
+                    self.sketches[key].add(element)
+
+        return add
+
+
+class FakeSketchPipeline:
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.commands = []
+
+    def exists(self, *keys):
+        self.commands.append(
+            lambda: sum(self.redis_client._exists(key) for key in keys)
+        )
+
+    def expire(self, key, seconds):
+        self.commands.append(lambda: self.redis_client.expiring.add(key))
+
+    async def execute(self):
+        return [command() for command in self.commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class TestCountSketches(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.redis_client = FakeSketchRedis()
+        self.storage = MagicMock(sketch_elements=AsyncMock(return_value=["a", "b"]))
+
+    async def count(self, filters):
+        with patch.object(
+            app, "get_redis_client", AsyncMock(return_value=self.redis_client)
+        ):
+            return await app.process_count(
+                MagicMock(storage=self.storage),
+                {"event_dict": [filters], "subscription_id": "c"},
+            )
+
+    async def test_first_count_seeds_from_storage(self):
+        reactions = {"kinds": [7], "#e": ["x"]}
+        response, status = await self.count(reactions)
+        self.assertEqual((status, response["count"]), (200, 2))
+        self.assertTrue(response["approximate"])
+        self.storage.sketch_elements.assert_awaited_once_with(
+            reactions, False, app.COUNT_SKETCH_SEED_MAX
+        )
+
+        reaction = Event("c", "author", 7, 100, [["e", "x"]], "", "sig")
+        await app.update_count_sketches(self.redis_client, reaction)
+        response, status = await self.count(reactions)
+        self.assertEqual(response["count"], 3)
+        self.storage.sketch_elements.assert_awaited_once()
+
+    async def test_ingest_does_not_create_sketches(self):
+        follow = Event("f", "alice", 3, 100, [["p", "bob"]], "", "sig")
+        await app.update_count_sketches(self.redis_client, follow)
+        self.assertEqual(self.redis_client.sketches, {})
+
+    async def test_failed_seed_is_retried(self):
+        self.storage.sketch_elements.side_effect = StorageBusy("busy")
+        followers = {"kinds": [3], "#p": ["bob"]}
+        response, status = await self.count(followers)
+        self.assertEqual(status, 503)
+        key = count_sketch_key(3, "p", "bob")
+        self.assertEqual(self.redis_client.values, {})
+
+        # What ingest added meanwhile survives the next seed
+        follow = Event("f", "carol", 3, 100, [["p", "bob"]], "", "sig")
+        await app.update_count_sketches(self.redis_client, follow)
+        self.storage.sketch_elements.side_effect = None
+        response, status = await self.count(followers)
+        self.assertEqual((status, response["count"]), (200, 3))
+        self.assertIn(key, self.redis_client.expiring)
+
+    async def test_count_during_seed_is_exact(self):
+        key = count_sketch_key(7, "e", "x")
+        self.redis_client.values[app.sketch_marker(key, "seeding")] = 1
+        await self.redis_client.pfadd(key)
+        self.storage.count = AsyncMock(return_value=40)
+        response, status = await self.count({"kinds": [7], "#e": ["x"]})
+        self.assertEqual((status, response["count"]), (200, 40))
+        self.assertFalse(response["approximate"])
+        self.storage.sketch_elements.assert_not_awaited()
+
+    async def test_expensive_exact_count_is_rejected(self):
+        self.storage.count = AsyncMock(return_value=5)
+        response, status = await self.count({"search": "nostr"})
+        self.assertEqual(status, 413)
+        self.storage.count.assert_not_awaited()
+
+    async def test_exact_count_waits_in_its_lane(self):
+        self.storage.count = AsyncMock(return_value=5)
+        scheduler = QueryScheduler({"cheap": 1}, queue_timeout=0.01)
+        with patch.object(app, "query_scheduler", scheduler):
+            async with scheduler.slot("cheap"):
+                response, status = await self.count({"kinds": [1]})
+            self.assertEqual(status, 503)
+            self.storage.count.assert_not_awaited()
+
+            response, status = await self.count({"kinds": [1]})
+            self.assertEqual((status, response["count"]), (200, 5))
+            self.assertEqual(scheduler.stats()["lanes"]["cheap"]["timed_out"], 1)
+
+
+class TestDeletionFanout(unittest.IsolatedAsyncioTestCase):
+    async def test_verified_event_is_not_verified_again(self):
+        redis_client = MagicMock(publish=AsyncMock())
+        storage = MagicMock(add_event=AsyncMock())
+        note = {
+            "id": "b" * 64,
+            "pubkey": "author",
+            "kind": 1,
+            "created_at": 100,
+            "tags": [],
+            "content": "hello",
+            "sig": "s" * 128,
+        }
+        with patch.object(
+            app, "get_redis_client", AsyncMock(return_value=redis_client)
+        ), patch.object(Event, "verify_signature") as verify_signature:
+            response, status = await app.process_new_event(
+                MagicMock(storage=storage), orjson.dumps(note), verified=True
+            )
+        self.assertEqual((status, response["results_json"]), (200, "true"))
+        verify_signature.assert_not_called()
+
+    async def test_failed_publish_still_stores_and_announces_gap(self):
+        redis_client = MagicMock(publish=AsyncMock(side_effect=[ConnectionError, 1]))
+        storage = MagicMock(add_event=AsyncMock())
+        note = {
+            "id": "a" * 64,
+            "pubkey": "author",
+            "kind": 1,
+            "created_at": 100,
+            "tags": [],
+            "content": "hello",
+            "sig": "s" * 128,
+        }
+        with patch.object(
+            app, "get_redis_client", AsyncMock(return_value=redis_client)
+        ), patch.object(Event, "verify_signature", return_value=True), patch.object(
+            app, "fanout_gap_task", None
+        ):
+            response, status = await app.process_new_event(
+                MagicMock(storage=storage), orjson.dumps(note)
+            )
+            self.assertEqual((status, response["results_json"]), (200, "true"))
+            await app.fanout_gap_task
+        storage.add_event.assert_awaited_once()
+        self.assertEqual(
+            redis_client.publish.await_args.args, (app.REDIS_CHANNEL, app.FANOUT_GAP)
+        )
+
+    async def test_deletion_drops_event_from_hot_timeline(self):
+        note = {
+            "id": "a" * 64,
+            "pubkey": "author",
+            "kind": 1,
+            "created_at": 100,
+            "tags": [],
+            "content": "hello",
+            "sig": "s" * 128,
+        }
+        timeline = HotTimeline([1], 10, MagicMock())
+        timeline.prime(1, [note], 10)
+        recent = {"kinds": [1], "since": 0}
+        self.assertEqual(len(timeline.query(recent)), 1)
+
+        cache = FakeRedis()
+        redis_client = MagicMock(publish=AsyncMock(), pipeline=cache.pipeline)
+        storage = MagicMock(delete_events=AsyncMock())
+        deletion = {
+            "id": "d" * 64,
+            "pubkey": "author",
+            "kind": 5,
+            "created_at": 200,
+            "tags": [["e", note["id"]]],
+            "content": "",
+            "sig": "s" * 128,
+        }
+        with patch.object(
+            app, "get_redis_client", AsyncMock(return_value=redis_client)
+        ), patch.object(Event, "verify_signature", return_value=True):
+            response, status = await app.process_new_event(
+                MagicMock(storage=storage), orjson.dumps(deletion)
+            )
+        self.assertEqual((status, response["results_json"]), (200, "true"))
+        storage.delete_events.assert_awaited_once()
+        self.assertEqual(
+            cache.values[replaceable_cache_key(0, "author")], app.REPLACEABLE_TOMBSTONE
+        )
+
+        for call in redis_client.publish.await_args_list:
+            published_ms, raw_event = split_redis_payload(call.args[1])
+            timeline.add(orjson.loads(raw_event), raw_event.decode())
+        self.assertEqual(timeline.query(recent), [])
+
+
 if __name__ == "__main__":
     unittest.main()
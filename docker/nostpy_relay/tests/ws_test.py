@@ -0,0 +1,676 @@
+import asyncio
+import logging
+import os
+import random
+import unittest
+import sys
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import orjson
+import secp256k1
+
+sys.path.insert(0, "../")
+from websocket_classes import (
+    ConnectionWriter,
+    HotTimeline,
+    SubscriptionMatcher,
+    SubscriptionRegistry,
+    client_address,
+    event_frame_prefix,
+    extract_event_json,
+    split_redis_payload,
+)
+from negentropy import (
+    Negentropy,
+    NegentropyError,
+    NegentropyIndex,
+    encode_varint,
+    pack_items,
+)
+from rate_limit import (
+    RateLimit,
+    RateLimiter,
+    parse_rate_limit,
+    rate_limits_from_env,
+)
+from utils import StageTimer, kind_class
+import websocket_handler
+
+
+class TestEventFrames(unittest.TestCase):
+    def setUp(self):
+        self.event = {
+            "id": "test_id",
+            "pubkey": "test_pubkey",
+            "kind": 1,
+            "created_at": 123456,
+            "tags": [["p", "test_pubkey"]],
+            "content": 'quoted "content" and unicode é',
+            "sig": "test_sig",
+        }
+
+    def test_spliced_frame_matches_encoded_frame(self):
+        event_json = orjson.dumps(self.event).decode("utf-8")
+        frame = event_frame_prefix("sub1") + event_json + "]"
+        self.assertEqual(frame, orjson.dumps(("EVENT", "sub1", self.event)).decode())
+
+    def test_prefix_escapes_subscription_id(self):
+        event_json = orjson.dumps(self.event).decode("utf-8")
+        frame = event_frame_prefix('sub"1') + event_json + "]"
+        self.assertEqual(orjson.loads(frame), ["EVENT", 'sub"1', self.event])
+
+
+class TestExtractEventJson(unittest.TestCase):
+    def test_slices_event_from_frame(self):
+        frame = '[ "EVENT" , {"id":"a","tags":[["e","b"]],"content":"}{ é"} ]'
+        message = orjson.loads(frame)
+        raw_event = extract_event_json(message, frame, message[1])
+        self.assertEqual(
+            raw_event, '{"id":"a","tags":[["e","b"]],"content":"}{ é"}'.encode()
+        )
+
+    def test_unexpected_shape_is_reencoded(self):
+        frame = '["EVENT", {"id":"a"}, {"extra":1}]'
+        message = orjson.loads(frame)
+        self.assertEqual(extract_event_json(message, frame, message[1]), b'{"id":"a"}')
+
+
+class TestRedisPayload(unittest.TestCase):
+    def test_timestamped_payload(self):
+        published_ms, event_json = split_redis_payload(b'1700000000123 {"id":"a"}')
+        self.assertEqual(published_ms, 1700000000123)
+        self.assertEqual(event_json, b'{"id":"a"}')
+
+    def test_plain_payload(self):
+        published_ms, event_json = split_redis_payload(b'{"id":"a"}')
+        self.assertIsNone(published_ms)
+        self.assertEqual(event_json, b'{"id":"a"}')
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.id = "test_ws"
+        self.sent = []
+        self.closed_with = None
+        self.transport = self
+        self.release = asyncio.Event()
+
+    def get_extra_info(self, name):
+        return None
+
+    async def send(self, frame):
+        await self.release.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = (code, reason)
+
+
+class TestConnectionWriter(unittest.IsolatedAsyncioTestCase):
+    async def test_drop_policy_sends_notice(self):
+        websocket = FakeWebsocket()
+        writer = ConnectionWriter(websocket, logging.getLogger(), max_queue_size=2)
+        writer.start()
+        await asyncio.sleep(0)
+        results = [writer.offer(f"frame{i}") for i in range(4)]
+        self.assertEqual(results, [True, True, False, False])
+        websocket.release.set()
+        await asyncio.sleep(0.01)
+        await writer.close()
+        self.assertEqual(websocket.sent[:2], ["frame0", "frame1"])
+        self.assertEqual(
+            orjson.loads(websocket.sent[2]),
+            ["NOTICE", "error: slow consumer, dropped 2 live events"],
+        )
+
+    async def test_disconnect_policy_closes_connection(self):
+        websocket = FakeWebsocket()
+        writer = ConnectionWriter(
+            websocket,
+            logging.getLogger(),
+            max_queue_size=1,
+            overflow_policy="disconnect",
+        )
+        writer.offer("frame0")
+        self.assertFalse(writer.offer("frame1"))
+        await asyncio.sleep(0)
+        self.assertEqual(websocket.closed_with, (1013, "slow consumer"))
+
+
+class FakeHistogram:
+    def __init__(self):
+        self.records = []
+
+    def record(self, value, attributes=None):
+        self.records.append((value, attributes))
+
+
+class TestStageTimer(unittest.TestCase):
+    def test_records_low_cardinality_attributes(self):
+        histogram = FakeHistogram()
+        with StageTimer(histogram, "db_write", kind_class(30023)) as timer:
+            timer.result = "duplicate"
+        with self.assertRaises(ValueError):
+            with StageTimer(histogram, "json_parse"):
+                raise ValueError
+        self.assertEqual(
+            [attributes for _, attributes in histogram.records],
+            [
+                {
+                    "stage": "db_write",
+                    "kind_class": "addressable",
+                    "result": "duplicate",
+                },
+                {"stage": "json_parse", "kind_class": "none", "result": "error"},
+            ],
+        )
+        self.assertTrue(all(value >= 0 for value, _ in histogram.records))
+
+
+class TestSubscriptionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = SubscriptionRegistry(
+            logging.getLogger(), max_subscriptions=2, max_filters=2
+        )
+        self.first = FakeWebsocket()
+        self.second = FakeWebsocket()
+        self.second.id = "other_ws"
+
+    def test_same_subscription_id_on_two_connections(self):
+        first_state = self.registry.register(self.first, writer=None)
+        second_state = self.registry.register(self.second, writer=None)
+        self.registry.add(first_state, "sub1", [{"kinds": [1]}])
+        self.registry.add(second_state, "sub1", [{"kinds": [1]}])
+        matched = list(self.registry.matching({"kind": 1}))
+        self.assertEqual(
+            {state.websocket.id for state, _ in matched}, {"test_ws", "other_ws"}
+        )
+        self.assertEqual(self.registry.subscription_count, 2)
+
+    def test_limits(self):
+        state = self.registry.register(self.first, writer=None)
+        self.assertIsNotNone(self.registry.add(state, "sub1", [{}, {}, {}]))
+        self.assertIsNone(self.registry.add(state, "sub1", [{}]))
+        self.assertIsNone(self.registry.add(state, "sub2", [{}]))
+        self.assertIsNone(self.registry.add(state, "sub1", [{}]))
+        self.assertIsNotNone(self.registry.add(state, "sub3", [{}]))
+
+    def test_remove_unknown_and_drop(self):
+        state = self.registry.register(self.first, writer=None)
+        self.assertFalse(self.registry.remove(state, "unknown"))
+        self.registry.add(state, "sub1", [{"kinds": [1]}])
+        self.registry.add(state, "sub2", [{"kinds": [1]}])
+        self.assertGreater(self.registry.memory_usage()[0], 0)
+        self.assertEqual(self.registry.drop(state), 2)
+        self.assertEqual(self.registry.subscription_count, 0)
+        self.assertEqual(self.registry.connections, {})
+
+
+class TestSubscriptionMatcher(unittest.TestCase):
+    event = {
+        "id": "a" * 64,
+        "pubkey": "alice",
+        "kind": 1,
+        "created_at": 1000,
+        "tags": [["e", "note"], ["t", "nostr"]],
+        "content": "Hello relay",
+    }
+
+    def matches(self, *filters):
+        matcher = SubscriptionMatcher("sub1", list(filters), logging.getLogger())
+        return matcher.match_event(self.event)
+
+    def test_conditions_of_a_filter_all_apply(self):
+        self.assertTrue(
+            self.matches({"kinds": [1], "authors": ["alice"], "#t": ["nostr"]})
+        )
+        self.assertFalse(self.matches({"kinds": [1], "authors": ["bob"]}))
+        self.assertFalse(self.matches({"kinds": [7], "#e": ["note"]}))
+        self.assertFalse(self.matches({"kinds": [1], "since": 1001}))
+        self.assertFalse(self.matches({"kinds": [1], "until": 999}))
+        self.assertTrue(self.matches({"kinds": [1], "limit": 1, "search": "hello"}))
+
+    def test_any_filter_of_a_req_matches(self):
+        self.assertTrue(self.matches({"kinds": [7]}, {"ids": ["a" * 64]}))
+        self.assertFalse(self.matches({"kinds": [7]}, {"authors": ["bob"]}))
+        self.assertTrue(self.matches({}))
+
+    def test_tag_values_match_exactly(self):
+        self.assertFalse(self.matches({"#t": ["nos"]}))
+        self.assertFalse(self.matches({"#p": ["note"]}))
+        self.assertFalse(self.matches({"kinds": 1}))
+        self.assertFalse(self.matches({"#t": "nostr"}))
+
+    def test_hot_timeline_agrees(self):
+        timeline = HotTimeline([1], size=10, logger=logging.getLogger())
+        timeline.prime(1, [self.event], limit=10)
+        for filters in (
+            {"kinds": [1], "authors": ["alice"], "#t": ["nostr"]},
+            {"kinds": [1], "authors": ["bob"], "#t": ["nostr"]},
+            {"kinds": [1], "#t": ["nos"]},
+            {"kinds": [1], "ids": ["a" * 64], "until": 999},
+        ):
+            answer = timeline.query({**filters, "since": 0})
+            self.assertEqual(bool(answer), self.matches(filters), filters)
+
+
+def hot_event(number, kind=1, created_at=None, pubkey="alice", tags=None):
+    return {
+        "id": f"{number:064x}",
+        "pubkey": pubkey,
+        "kind": kind,
+        "created_at": 1000 + number if created_at is None else created_at,
+        "tags": tags or [],
+        "content": "",
+        "sig": "",
+    }
+
+
+class TestHotTimeline(unittest.TestCase):
+    def setUp(self):
+        self.timeline = HotTimeline([1, 3], size=4, logger=logging.getLogger())
+        # Storage holds more kind 1 events than the page read at priming
+        self.timeline.prime(1, [hot_event(n) for n in (5, 4, 3)], limit=3)
+
+    def add(self, event):
+        self.timeline.add(event, orjson.dumps(event).decode("utf-8"))
+
+    def ids(self, answer):
+        return [orjson.loads(event_json)["id"][-1] for event_json in answer]
+
+    def test_only_regular_kinds_are_buffered(self):
+        self.assertEqual(list(self.timeline.kinds), [1])
+        self.assertIsNone(self.timeline.query({"kinds": [3]}))
+
+    def test_answers_inside_the_window(self):
+        self.add(hot_event(6, pubkey="bob", tags=[["t", "x"]]))
+        self.assertEqual(
+            self.ids(self.timeline.query({"kinds": [1], "limit": 2})), ["6", "5"]
+        )
+        self.assertEqual(
+            self.ids(self.timeline.query({"kinds": [1], "since": 1004})),
+            ["6", "5", "4"],
+        )
+        self.assertEqual(
+            self.ids(
+                self.timeline.query(
+                    {"kinds": [1], "authors": ["bob"], "#t": ["x"], "since": 1006}
+                )
+            ),
+            ["6"],
+        )
+        # Event 2 may be in storage, below the floor
+        self.assertIsNone(self.timeline.query({"kinds": [1], "limit": 5}))
+        self.assertIsNone(self.timeline.query({"kinds": [1], "since": 1002}))
+        self.assertIsNone(self.timeline.query({"kinds": [1], "search": "x"}))
+        self.assertEqual((self.timeline.hits, self.timeline.misses), (3, 3))
+
+    def test_eviction_raises_floor_and_deletion_removes(self):
+        for number in (6, 7, 8):
+            self.add(hot_event(number))
+        self.assertEqual(self.timeline.kinds[1].floor, 1005)
+        self.assertEqual(len(self.timeline.kinds[1].events), 4)
+        self.assertIsNone(self.timeline.query({"kinds": [1], "limit": 5}))
+        self.add(hot_event(90, kind=5, pubkey="mallory", tags=[["e", f"{8:064x}"]]))
+        self.add(hot_event(91, kind=5, tags=[["e", f"{7:064x}"]]))
+        self.assertEqual(
+            self.ids(self.timeline.query({"kinds": [1], "limit": 2})), ["8", "6"]
+        )
+
+
+def random_items(count):
+    return [(random.randint(1000, 1100), os.urandom(32).hex()) for _ in range(count)]
+
+
+def sync(ours, theirs, frame_size_limit=0):
+    """Reconciles ``ours`` as the initiator against ``theirs`` as the relay."""
+    client = Negentropy(NegentropyIndex.from_packed(pack_items(ours)), frame_size_limit)
+    relay = Negentropy(
+        NegentropyIndex.from_packed(pack_items(theirs)), frame_size_limit
+    )
+    message, have, need, rounds = client.initiate(), set(), set(), 0
+    while message is not None:
+        reply = relay.reconcile(message)
+        if frame_size_limit:
+            assert len(reply) <= frame_size_limit
+        message, round_have, round_need = client.reconcile_initiator(reply)
+        have.update(event_id.hex() for event_id in round_have)
+        need.update(event_id.hex() for event_id in round_need)
+        rounds += 1
+    return have, need, rounds
+
+
+class TestNegentropy(unittest.TestCase):
+    def test_varint(self):
+        self.assertEqual(encode_varint(0), b"\x00")
+        self.assertEqual(encode_varint(127), b"\x7f")
+        self.assertEqual(encode_varint(128), b"\x81\x00")
+
+    def test_pack_items_sorts_and_skips_bad_ids(self):
+        items = [(2, "bb" * 32), (1, "cc" * 32), (2, "aa" * 32), (3, "not hex")]
+        index = NegentropyIndex.from_packed(pack_items(items))
+        self.assertEqual(
+            [key[8:].hex() for key in index.keys], ["cc" * 32, "aa" * 32, "bb" * 32]
+        )
+
+    def test_finds_differences(self):
+        shared = random_items(3000)
+        only_ours, only_theirs = random_items(40), random_items(25)
+        have, need, _ = sync(shared + only_ours, shared + only_theirs)
+        self.assertEqual(have, {event_id for _, event_id in only_ours})
+        self.assertEqual(need, {event_id for _, event_id in only_theirs})
+
+    def test_identical_sets_finish_in_one_round(self):
+        shared = random_items(1000)
+        self.assertEqual(sync(shared, shared), (set(), set(), 1))
+
+    def test_frame_size_limit(self):
+        shared, only_theirs = random_items(2000), random_items(400)
+        have, need, rounds = sync(shared, shared + only_theirs, frame_size_limit=4096)
+        self.assertEqual(need, {event_id for _, event_id in only_theirs})
+        self.assertGreater(rounds, 1)
+
+    def test_unsupported_and_malformed_messages(self):
+        relay = Negentropy(NegentropyIndex([]))
+        self.assertEqual(relay.reconcile(b"\x62"), b"\x61")
+        with self.assertRaises(NegentropyError):
+            relay.reconcile(b"\x01")
+        with self.assertRaises(NegentropyError):
+            relay.reconcile(b"\x61\x00\x00\x01\x00")
+
+
+class FakeScriptRedis:
+    """Answers the token bucket script with a fixed result."""
+
+    def __init__(self, result):
+        self.result = result
+        self.calls = []
+
+    def register_script(self, script):
+        async def run(keys, args):
+            self.calls.append((keys, args))
+            if isinstance(self.result, Exception):
+                raise self.result
+            return self.result
+
+        return run
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(
+            {
+                ("conn", "event"): RateLimit(1, 2),
+                ("ip", "event"): RateLimit(10, 3),
+                ("pubkey", "event"): RateLimit(1, 5),
+            },
+            logging.getLogger("test"),
+        )
+
+    def test_parse_rate_limit(self):
+        self.assertEqual(parse_rate_limit("5/20"), RateLimit(5, 20))
+        self.assertEqual(parse_rate_limit("2.5"), RateLimit(2.5, 2.5))
+        self.assertIsNone(parse_rate_limit(""))
+        self.assertIsNone(parse_rate_limit("0/10"))
+        with self.assertRaises(ValueError):
+            parse_rate_limit("fast")
+        limits = rate_limits_from_env(
+            {"RATE_LIMIT_CONN_EVENT": "1/1", "RATE_LIMIT_IP_REQ": ""}
+        )
+        self.assertEqual(limits[("conn", "event")], RateLimit(1, 1))
+        self.assertNotIn(("ip", "req"), limits)
+        self.assertIn(("ip", "filter"), limits)
+
+    def test_burst_then_refill(self):
+        keys = {"conn": "c1", "ip": "i1"}
+        take = self.limiter.take_local
+        self.assertIsNone(take("event", keys, now=0))
+        self.assertIsNone(take("event", keys, now=0))
+        self.assertEqual(take("event", keys, now=0), "conn")
+        # Another connection from the same IP still has its own budget
+        self.assertIsNone(take("event", {"conn": "c2", "ip": "i1"}, now=0))
+        self.assertEqual(take("event", {"conn": "c3", "ip": "i1"}, now=0), "ip")
+        self.assertIsNone(take("event", keys, now=1))
+
+    def test_refusal_takes_nothing(self):
+        keys = {"conn": "c1", "pubkey": "alice"}
+        self.assertEqual(self.limiter.take_local("event", keys, cost=3, now=0), "conn")
+        self.assertIsNone(self.limiter.take_local("event", keys, cost=2, now=0))
+        self.assertEqual(
+            self.limiter.take_local("event", {"pubkey": "alice"}, cost=4, now=0),
+            "pubkey",
+        )
+        self.assertIsNone(self.limiter.take_local("req", keys, cost=100, now=0))
+
+    def test_bucket_eviction(self):
+        self.limiter.max_buckets = 2
+        for conn in ("a", "b", "c"):
+            self.limiter.take_local("event", {"conn": conn}, now=0)
+        self.assertEqual(self.limiter.stats()["buckets"], 2)
+        self.limiter.forget("conn", "c")
+        self.assertEqual(self.limiter.stats()["buckets"], 1)
+
+    async def test_shared_buckets(self):
+        self.limiter.redis_client = FakeScriptRedis(2)
+        refused = await self.limiter.check("event", conn="c1", ip="i1", pubkey="alice")
+        self.assertEqual(refused, "pubkey")
+        keys, args = self.limiter.redis_client.calls[0]
+        self.assertEqual(keys, ["rl:ip:event:i1", "rl:pubkey:event:alice"])
+        self.assertEqual(args, [1, 10, 3, 1, 5])
+        self.assertEqual(self.limiter.refused, {("event", "pubkey"): 1})
+
+        # A Redis failure leaves the decision to the local buckets
+        self.limiter.redis_client = FakeScriptRedis(ConnectionError("down"))
+        self.limiter._script = None
+        self.assertIsNone(await self.limiter.check("event", conn="c1", ip="i1"))
+
+    async def test_forged_event_spends_no_author_budget(self):
+        private_key = secp256k1.PrivateKey()
+        pubkey = private_key.pubkey.serialize()[1:].hex()
+        event_id = "ab" * 32
+        signature = private_key.schnorr_sign(bytes.fromhex(event_id), None, raw=True)
+        forged = {"id": event_id, "pubkey": pubkey, "sig": "00" * 64}
+        signed = {**forged, "sig": signature.hex()}
+        limiter = RateLimiter(
+            {("conn", "event"): RateLimit(1, 10), ("pubkey", "event"): RateLimit(1, 1)},
+            logging.getLogger("test"),
+        )
+        writer = MagicMock(send=AsyncMock())
+
+        def message(payload, conn="c1"):
+            return MagicMock(
+                event_type="EVENT",
+                uuid=conn,
+                obfuscated_client_ip="i1",
+                event_payload=payload,
+            )
+
+        with patch.object(websocket_handler, "rate_limiter", limiter):
+            for _ in range(3):
+                forged_message = message(forged)
+                self.assertFalse(
+                    await websocket_handler.rate_limited(forged_message, writer)
+                )
+                self.assertIs(forged_message.signature_verified, False)
+            # The author still has the whole burst for their own event
+            signed_message = message(signed)
+            self.assertFalse(
+                await websocket_handler.rate_limited(signed_message, writer)
+            )
+            self.assertIs(signed_message.signature_verified, True)
+            self.assertTrue(
+                await websocket_handler.rate_limited(message(signed), writer)
+            )
+        self.assertEqual(limiter.refused, {("event", "pubkey"): 1})
+
+    async def test_author_refusal_takes_no_connection_tokens(self):
+        private_key = secp256k1.PrivateKey()
+        event_id = "cd" * 32
+        signed = {
+            "id": event_id,
+            "pubkey": private_key.pubkey.serialize()[1:].hex(),
+            "sig": private_key.schnorr_sign(
+                bytes.fromhex(event_id), None, raw=True
+            ).hex(),
+        }
+        limiter = RateLimiter(
+            {
+                ("conn", "event"): RateLimit(0.001, 2),
+                ("pubkey", "event"): RateLimit(0.001, 1),
+            },
+            logging.getLogger("test"),
+        )
+        writer = MagicMock(send=AsyncMock())
+        message = MagicMock(
+            event_type="EVENT", uuid="c1", obfuscated_client_ip="", event_payload=signed
+        )
+        with patch.object(websocket_handler, "rate_limiter", limiter):
+            self.assertFalse(await websocket_handler.rate_limited(message, writer))
+            self.assertTrue(await websocket_handler.rate_limited(message, writer))
+        # The refused EVENT left the connection its second token
+        self.assertIsNone(limiter.take_local("event", {"conn": "c1"}))
+        self.assertEqual(limiter.take_local("event", {"conn": "c1"}), "conn")
+
+    def test_client_address(self):
+        websocket = FakeWebsocket()
+        websocket.remote_address = ("10.0.0.9", 5000)
+        websocket.request_headers = {"X-Real-IP": "1.2.3.4"}
+        self.assertEqual(client_address(websocket), "1.2.3.4")
+        websocket.request_headers = {"X-Forwarded-For": "5.6.7.8, 10.0.0.1"}
+        self.assertEqual(client_address(websocket), "5.6.7.8")
+        websocket.request_headers = {}
+        self.assertEqual(client_address(websocket), "10.0.0.9")
+
+
+class FakePubSub:
+    """Yields ``messages``, then fails like a dropped connection or blocks."""
+
+    def __init__(self, messages, fail):
+        self.messages = messages
+        self.fail = fail
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def subscribe(self, channel):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages, timeout):
+        if self.messages:
+            return self.messages.pop(0)
+        if timeout == 0:
+            return None
+        if self.fail:
+            raise ConnectionError("connection lost")
+        await asyncio.Future()
+
+
+class TestSubscriptionRequests(unittest.IsolatedAsyncioTestCase):
+    async def test_empty_single_page_reply_still_streams_paged_filters(self):
+        writer = MagicMock(send=AsyncMock())
+        stream = AsyncMock(return_value=200)
+        with patch.multiple(
+            websocket_handler,
+            hot_timeline=None,
+            fetch_subscription=AsyncMock(return_value=({}, 200)),
+            stream_paged_filter=stream,
+        ):
+            closed = await websocket_handler.send_subscription_to_handler(
+                MagicMock(),
+                [{"kinds": [1]}, {"kinds": [1], "limit": 10000}],
+                "s",
+                writer,
+            )
+        self.assertIsNone(closed)
+        stream.assert_awaited_once()
+        frames = [orjson.loads(call.args[0]) for call in writer.send.await_args_list]
+        self.assertEqual(frames, [["EOSE", "s"]])
+
+
+class TestHandlerTimeouts(unittest.IsolatedAsyncioTestCase):
+    async def test_count_timeout_closes_subscription(self):
+        writer = MagicMock(send=AsyncMock())
+        with patch.object(
+            websocket_handler,
+            "post_to_event_handler",
+            AsyncMock(side_effect=asyncio.TimeoutError),
+        ):
+            await websocket_handler.send_count_to_handler(
+                MagicMock(), [{"kinds": [3], "#p": ["bob"]}], "c", writer
+            )
+        frame = orjson.loads(writer.send.await_args.args[0])
+        self.assertEqual(frame[:2], ["CLOSED", "c"])
+
+    async def test_negentropy_timeout_is_an_error_status(self):
+        session = MagicMock(post=MagicMock(side_effect=asyncio.TimeoutError))
+        self.assertEqual(
+            await websocket_handler.fetch_negentropy_items(session, {"kinds": [1]}),
+            (b"", 502),
+        )
+
+
+class TestRedisListener(unittest.IsolatedAsyncioTestCase):
+    async def test_resubscribes_after_failure(self):
+        pubsubs = [
+            FakePubSub([{"type": "message", "data": b"1 {}"}], fail=True),
+            FakePubSub([], fail=False),
+        ]
+        redis_client = MagicMock(pubsub=MagicMock(side_effect=pubsubs))
+        hot_timeline = MagicMock()
+        prime = AsyncMock()
+        queue = asyncio.Queue()
+        with patch.multiple(
+            websocket_handler,
+            redis_client=redis_client,
+            hot_timeline=hot_timeline,
+            prime_hot_timeline=prime,
+            fanout_queue=queue,
+            fanout_subscribed=asyncio.Event(),
+            fanout_generation=0,
+            REDIS_RECONNECT_MIN_DELAY=0.01,
+        ):
+            listener = asyncio.create_task(websocket_handler.redis_listener())
+            for _ in range(100):
+                if websocket_handler.fanout_generation == 2:
+                    break
+                await asyncio.sleep(0.01)
+            listener.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await listener
+            self.assertEqual(websocket_handler.fanout_generation, 2)
+            self.assertTrue(websocket_handler.fanout_subscribed.is_set())
+        self.assertEqual(queue.get_nowait(), [b"1 {}"])
+        hot_timeline.reset.assert_called_once()
+        self.assertEqual([call.args for call in prime.call_args_list], [(1,), (2,)])
+
+    async def test_fanout_gap_reloads_hot_timeline(self):
+        timeline = HotTimeline([1], size=4, logger=logging.getLogger())
+        timeline.prime(1, [hot_event(1)], limit=4)
+        prime = AsyncMock()
+        queue = asyncio.Queue()
+        subscribed = asyncio.Event()
+        subscribed.set()
+        with patch.multiple(
+            websocket_handler,
+            hot_timeline=timeline,
+            prime_hot_timeline=prime,
+            fanout_queue=queue,
+            fanout_subscribed=subscribed,
+            fanout_generation=3,
+            fanout_pending=1,
+        ):
+            queue.put_nowait([websocket_handler.FANOUT_GAP])
+            worker = asyncio.create_task(websocket_handler.fanout_worker())
+            await asyncio.sleep(0.01)
+            worker.cancel()
+            self.assertEqual(websocket_handler.fanout_generation, 4)
+        # The timeline no longer claims to be complete until primed again
+        self.assertIsNone(timeline.query({"kinds": [1], "since": 0}))
+        prime.assert_called_once_with(4)
+
+
+if __name__ == "__main__":
+    unittest.main()
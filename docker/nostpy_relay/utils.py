@@ -1,4 +1,7 @@
+import hmac
+import time
 from collections import OrderedDict
+from typing import Any, Optional
 
 
 class LimitedDict(OrderedDict):
@@ -22,3 +25,81 @@ class LimitedDict(OrderedDict):
         if len(self) >= self.max_size:
             self.popitem(last=False)  # Remove the oldest item
         super().__setitem__(key, value)
+
+
+def kind_class(kind: Any) -> str:
+    """
+    Maps an event kind to one of a handful of classes so it can be used as a
+    metric attribute without creating a series per kind.
+    """
+    if not isinstance(kind, int):
+        return "none"
+    if kind in (0, 3) or 10000 <= kind < 20000:
+        return "replaceable"
+    if kind == 5:
+        return "deletion"
+    if 20000 <= kind < 30000:
+        return "ephemeral"
+    if 30000 <= kind < 40000:
+        return "addressable"
+    return "regular"
+
+
+class StageTimer:
+    """
+    Context manager recording how long one hot-path stage took, in
+    milliseconds, on a shared histogram.
+
+    The only attributes are the stage name, the kind class and the result, so
+    the number of series stays fixed however many events pass through. The
+    result is "ok" unless the block raises ("error") or sets ``result``
+    itself, e.g. to "invalid" or "hit".
+
+    Attributes:
+        histogram: OpenTelemetry histogram to record on, or None to do nothing.
+        stage (str): Name of the stage, e.g. "signature_verify".
+        kind_class (str): Class of the event kind, see ``kind_class``.
+        result (Optional[str]): Outcome to record instead of the default.
+        elapsed_ms (float): Duration of the block, set when it exits.
+    """
+
+    __slots__ = ("histogram", "stage", "kind_class", "result", "start", "elapsed_ms")
+
+    def __init__(self, histogram, stage: str, kind_class: str = "none"):
+        self.histogram = histogram
+        self.stage = stage
+        self.kind_class = kind_class
+        self.result: Optional[str] = None
+        self.start = 0
+        self.elapsed_ms = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.elapsed_ms = (time.perf_counter_ns() - self.start) / 1_000_000
+        if self.histogram is None:
+            return
+        result = self.result or ("error" if exc_type else "ok")
+        self.histogram.record(
+            self.elapsed_ms,
+            {"stage": self.stage, "kind_class": self.kind_class, "result": result},
+        )
+
+
+# Histogram buckets for StageTimer; most stages take well under a millisecond
+STAGE_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+
+
+def admin_authorized(authorization: Optional[str], admin_token: Optional[str]) -> bool:
+    """
+    Checks an ``Authorization: Bearer <token>`` header against the configured
+    admin token. Admin endpoints stay closed while no token is configured.
+    """
+    if not admin_token or not authorization:
+        return False
+    scheme, _, supplied = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(
+        supplied.encode(), admin_token.encode()
+    )
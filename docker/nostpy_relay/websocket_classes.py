@@ -1,7 +1,92 @@
 import asyncio
 import hashlib
 import orjson
-from typing import Any, Dict, List, Optional, Tuple, Union
+import socket
+import sys
+import time
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import secp256k1
+
+from negentropy import Negentropy
+from utils import StageTimer, kind_class
+
+
+def event_frame_prefix(subscription_id: str) -> str:
+    """
+    Builds the leading part of an EVENT frame for a subscription.
+
+    The full frame is the prefix, the serialized event and a closing bracket,
+    so an event that is already serialized can be sent to many subscriptions
+    without being encoded again for each of them.
+
+    Args:
+        subscription_id (str): The subscription ID the frame is addressed to.
+
+    Returns:
+        str: The frame prefix, e.g. '["EVENT","sub1",'.
+    """
+    return '["EVENT",' + orjson.dumps(subscription_id).decode("utf-8") + ","
+
+
+def extract_event_json(
+    message: List, raw_message: Optional[Union[str, bytes]], event: Dict[str, Any]
+) -> bytes:
+    """
+    Returns the event JSON of an EVENT frame without re-encoding it.
+
+    A well-formed ``["EVENT", {...}]`` frame has nothing but the "EVENT"
+    string before the event object and nothing but a closing bracket after
+    it, so the object runs from the first "{" to the last "}" of the frame.
+    Any other frame shape falls back to encoding the decoded event.
+
+    Args:
+        message (List): The decoded frame.
+        raw_message (Optional[Union[str, bytes]]): The frame as received.
+        event (Dict[str, Any]): The decoded event.
+
+    Returns:
+        bytes: The event JSON.
+    """
+    if raw_message is None or len(message) != 2:
+        return orjson.dumps(event)
+    if isinstance(raw_message, str):
+        raw_message = raw_message.encode("utf-8")
+    return raw_message[raw_message.index(b"{") : raw_message.rindex(b"}") + 1]
+
+
+def split_redis_payload(payload: bytes) -> Tuple[Optional[int], bytes]:
+    """
+    Splits a pub/sub payload into its publish timestamp and the event JSON.
+
+    The event handler publishes "<publish time in ms> <event JSON>". Payloads
+    that are plain event JSON are accepted too and have no timestamp.
+
+    Args:
+        payload (bytes): The raw message data received from Redis.
+
+    Returns:
+        Tuple[Optional[int], bytes]: The publish time in milliseconds, or None, and the event JSON.
+    """
+    if payload[:1] == b"{":
+        return None, payload
+    published_ms, _, event_json = payload.partition(b" ")
+    return int(published_ms), event_json
+
+
+def event_signature_valid(event: Any) -> bool:
+    """
+    Checks the Schnorr signature of an event over its id, as the event
+    handler does before storing it. Malformed events are invalid.
+    """
+    try:
+        pub_key = secp256k1.PublicKey(bytes.fromhex("02" + event["pubkey"]), True)
+        return pub_key.schnorr_verify(
+            bytes.fromhex(event["id"]), bytes.fromhex(event["sig"]), None, raw=True
+        )
+    except Exception:
+        return False
 
 
 class ExtractedResponse:
@@ -66,30 +151,177 @@ class ExtractedResponse:
 
         return client_response
 
-    async def send_event_loop(self, response_list, websocket, logger) -> None:
+    async def send_event_loop(self, response_list, writer, logger) -> None:
         """
-        Sends a tuple of event items to a WebSocket using a faster JSON library (orjson).
+        Queues a tuple of event items on a connection's writer using a faster JSON library (orjson).
+
+        Each frame waits for room in the writer's queue, so a client that reads
+        slowly holds back its own query results instead of growing a buffer.
 
         Parameters:
             response_list (List[Dict]): A list of dictionaries representing event items.
-            websocket (websockets.WebSocketClientProtocol): The WebSocket connection to send the events to.
+            writer (ConnectionWriter): The writer of the WebSocket connection to send the events to.
         """
         try:
-            tasks = tuple(
-                asyncio.create_task(
-                    websocket.send(
-                        orjson.dumps(
-                            (self.event_type, self.subscription_id, event_item)
-                        ).decode("utf-8")
-                    )
+            prefix = event_frame_prefix(self.subscription_id)
+            for event_item in response_list:
+                await writer.send(
+                    prefix + orjson.dumps(event_item).decode("utf-8") + "]"
                 )
-                for event_item in response_list
-            )
-            await asyncio.gather(*tasks)
         except Exception as e:
             logger.error(f"Error while sending events: {e}")
 
 
+class ConnectionWriter:
+    """
+    Owns all outbound traffic of one WebSocket connection.
+
+    Frames are put on a bounded queue and a single writer task drains it,
+    writing every frame that is ready back to back while the socket is corked
+    so they leave in as few TCP segments as possible.
+
+    Attributes:
+        websocket (websockets.WebSocketServerProtocol): The connection to write to.
+        queue (asyncio.Queue): Bounded queue of (frame, publish time in ms) pairs.
+        overflow_policy (str): "drop" to drop live events and send a NOTICE, "disconnect" to close the connection.
+        batch_size (int): Maximum number of frames written per wakeup.
+        dropped (int): Live events dropped since the last overflow NOTICE.
+
+    Methods:
+        start(): Starts the writer task.
+        send(frame): Queues a reply frame, waiting for room in the queue.
+        offer(frame, published_ms): Queues a live event frame without waiting, applying the overflow policy.
+        close(): Stops the writer task.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        logger,
+        max_queue_size: int = 1000,
+        overflow_policy: str = "drop",
+        batch_size: int = 64,
+        depth_histogram=None,
+        latency_histogram=None,
+        stage_histogram=None,
+    ):
+        self.websocket = websocket
+        self.logger = logger
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self.overflow_policy = overflow_policy
+        self.batch_size = batch_size
+        self.depth_histogram = depth_histogram
+        self.latency_histogram = latency_histogram
+        self.stage_histogram = stage_histogram
+        self.dropped = 0
+        self.closing = False
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def send(self, frame: str) -> None:
+        if not self.closing:
+            await self.queue.put((frame, None))
+
+    def offer(self, frame: str, published_ms: Optional[int] = None) -> bool:
+        """
+        Queues a live event frame if there is room.
+
+        Args:
+            frame (str): The EVENT frame.
+            published_ms (Optional[int]): When the event was published to Redis, for latency metrics.
+
+        Returns:
+            bool: True if the frame was queued, False if it was dropped.
+        """
+        try:
+            self.queue.put_nowait((frame, published_ms))
+            return True
+        except asyncio.QueueFull:
+            if self.overflow_policy == "disconnect":
+                if not self.closing:
+                    self.closing = True
+                    self.logger.warning(
+                        f"Disconnecting slow consumer {self.websocket.id}"
+                    )
+                    asyncio.create_task(
+                        self.websocket.close(code=1013, reason="slow consumer")
+                    )
+            else:
+                self.dropped += 1
+            return False
+
+    async def close(self) -> None:
+        if self.task:
+            self.task.cancel()
+
+    def _set_cork(self, enabled: bool) -> None:
+        sock = self.websocket.transport.get_extra_info("socket")
+        if sock is None or not hasattr(socket, "TCP_CORK"):
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, int(enabled))
+        except OSError:
+            pass
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                frames = [await self.queue.get()]
+                if self.depth_histogram is not None:
+                    self.depth_histogram.record(self.queue.qsize() + 1)
+                while len(frames) < self.batch_size:
+                    try:
+                        frames.append(self.queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                if self.dropped:
+                    notice = (
+                        "NOTICE",
+                        f"error: slow consumer, dropped {self.dropped} live events",
+                    )
+                    frames.append((orjson.dumps(notice).decode("utf-8"), None))
+                    self.dropped = 0
+
+                self._set_cork(True)
+                try:
+                    # One sample per batch written, not per frame
+                    with StageTimer(self.stage_histogram, "websocket_send"):
+                        await self._write(frames)
+                finally:
+                    self._set_cork(False)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.debug(f"Writer for {self.websocket.id} stopped: {e}")
+            # Unblock any reply still waiting for room, nothing will drain it now
+            self.closing = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+    async def _write(self, frames: List[Tuple[str, Optional[int]]]) -> None:
+        for frame, published_ms in frames:
+            await self.websocket.send(frame)
+            if published_ms is not None and self.latency_histogram:
+                self.latency_histogram.record(
+                    time.time_ns() // 1_000_000 - published_ms
+                )
+
+
+def client_address(websocket) -> str:
+    """
+    The client's IP: the X-Real-IP header nginx sets, else the first
+    X-Forwarded-For entry, else the peer address of the connection.
+    """
+    headers = websocket.request_headers
+    forwarded = headers.get("X-Forwarded-For", "")
+    address = headers.get("X-Real-IP") or forwarded.split(",")[0].strip()
+    if not address and websocket.remote_address:
+        address = websocket.remote_address[0]
+    return address or ""
+
+
 class WebsocketMessages:
     """
     A class representing WebSocket messages.
@@ -98,49 +330,145 @@ class WebsocketMessages:
         event_type (str): The type of the WebSocket event.
         subscription_id (str): The subscription ID associated with the event.
         event_payload (Union[List[Dict[str, Any]], Dict[str, Any]]): The payload of the event.
+        raw_event (Optional[bytes]): For EVENT messages, the event JSON exactly as the client sent it.
         origin (str): The origin or referer of the WebSocket request.
         obfuscate_ip (function): A lambda function to obfuscate the client IP address.
-        obfuscated_client_ip (str): The obfuscated client IP address.
+        obfuscated_client_ip (str): The obfuscated client IP address, empty if unknown.
         uuid (str): The unique identifier of the WebSocket connection.
+        signature_verified (Optional[bool]): For EVENTs, whether the signature verified, or None if it was left to the event handler.
 
     Methods:
         __init__(self, message: List[Union[str, Dict[str, Any]]], websocket): Initializes the WebSocketMessages object.
 
     """
 
-    def __init__(self, message: List[Union[str, Dict[str, Any]]], websocket, logger):
+    def __init__(
+        self,
+        message: List[Union[str, Dict[str, Any]]],
+        websocket,
+        logger,
+        raw_message: Optional[Union[str, bytes]] = None,
+    ):
         """
         Initializes the WebSocketMessages object.
 
         Args:
             message (List[Union[str, Dict[str, Any]]]): The WebSocket message.
             websocket: The WebSocket connection.
+            raw_message (Optional[Union[str, bytes]]): The undecoded frame, used to keep the event JSON of EVENT messages.
 
         """
         self.event_type = message[0]
-        if self.event_type in ("REQ", "CLOSE"):
+        self.raw_event: Optional[bytes] = None
+        self.signature_verified: Optional[bool] = None
+        if self.event_type in (
+            "REQ",
+            "CLOSE",
+            "COUNT",
+            "NEG-OPEN",
+            "NEG-MSG",
+            "NEG-CLOSE",
+        ):
             self.subscription_id: str = message[1]
             raw_payload = message[2:]
             logger.debug(f"Raw payload is {raw_payload} and len {len(raw_payload)}")
             self.event_payload = raw_payload
         else:
             self.event_payload: Dict[str, Any] = message[1]
+            if self.event_type == "EVENT":
+                self.raw_event = extract_event_json(
+                    message, raw_message, self.event_payload
+                )
         headers = websocket.request_headers
         self.origin: str = headers.get("origin", "") or headers.get("referer", "")
         self.obfuscate_ip = lambda ip: hashlib.sha256(ip.encode("utf-8")).hexdigest()
-        self.obfuscated_client_ip = self.obfuscate_ip("X-Real-IP") or headers.get(
-            "X-Forwarded-For"
-        )
+        client_ip = client_address(websocket)
+        self.obfuscated_client_ip = self.obfuscate_ip(client_ip) if client_ip else ""
         logger.debug(f"Client obfuscated IP is {self.obfuscated_client_ip}")
         self.uuid: str = websocket.id
 
 
+# Filter keys matched against one field of an event
+FILTER_FIELDS = {"ids": "id", "authors": "pubkey", "kinds": "kind"}
+
+
+def prepare_filter(filters: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copies a REQ filter with its ids, authors, kinds and tag values as sets,
+    for matching it against many events. A value that is not a list, or
+    that holds unhashable items, is kept as it is.
+    """
+    prepared = dict(filters)
+    for key, value in filters.items():
+        if (key in FILTER_FIELDS or key.startswith("#")) and isinstance(value, list):
+            try:
+                prepared[key] = frozenset(value)
+            except TypeError:
+                pass
+    return prepared
+
+
+def filter_matches(filters: Dict[str, Any], event: Dict[str, Any]) -> bool:
+    """
+    Whether an event matches one REQ filter, as NIP-01 and storage define it.
+
+    Every condition of the filter must hold: the event's id, pubkey and kind
+    are among the listed ones, each tag filter is met by a tag of the event
+    with that name and one of the values, created_at is within since and
+    until, and a search term appears in the content or a tag. ``limit`` does
+    not restrict matching, and keys storage does not know are ignored. A list
+    condition that is not a list matches nothing, as in storage.
+
+    Args:
+        filters (Dict[str, Any]): The filter, as sent or from ``prepare_filter``.
+        event (Dict[str, Any]): The event to match.
+
+    Returns:
+        bool: True if the event matches the filter.
+    """
+    for key, value in filters.items():
+        field = FILTER_FIELDS.get(key)
+        if field is not None:
+            if (
+                not isinstance(value, (list, frozenset))
+                or event.get(field) not in value
+            ):
+                return False
+        elif key.startswith("#"):
+            if not isinstance(value, (list, frozenset)):
+                return False
+            name = key[1:]
+            if not any(
+                len(tag) >= 2 and tag[0] == name and tag[1] in value
+                for tag in event.get("tags", [])
+            ):
+                return False
+        elif key == "since":
+            if event.get("created_at", 0) < value:
+                return False
+        elif key == "until":
+            if event.get("created_at", 0) > value:
+                return False
+        elif key == "search":
+            term = str(value).lower()
+            if term not in event.get("content", "").lower() and not any(
+                term in str(tag_value).lower()
+                for tag in event.get("tags", [])
+                for tag_value in tag[1:]
+            ):
+                return False
+    return True
+
+
 class SubscriptionMatcher:
     """
     Matches a raw Redis event against filters defined in a REQ query.
 
+    An event matches the REQ when it matches any of its filters, see
+    ``filter_matches``.
+
     Attributes:
-        filters (List[Dict[str, Any]]): A list of filter dictionaries.
+        filters (List[Dict[str, Any]]): The filters, prepared for matching.
     """
 
     def __init__(self, subscription_id: str, req_query: List, logger):
@@ -153,7 +481,11 @@ class SubscriptionMatcher:
             logger: Logger instance for debugging.
         """
         self.subscription_id = subscription_id
-        self.filters = req_query
+        self.filters = [
+            prepare_filter(filters)
+            for filters in req_query
+            if isinstance(filters, dict)
+        ]
         self.logger = logger
 
     def match_event(self, event: Dict[str, Any]) -> bool:
@@ -166,92 +498,370 @@ class SubscriptionMatcher:
         Returns:
             bool: True if the event matches any of the filters, False otherwise.
         """
-        for list_item in self.filters:
-            for filter_, value in list_item.items():
-                if filter == 'limit':
-                    self.logger.debug('Ignoring limit filter')
-                    continue
-                self.logger.debug(f"Checking filter: {filter_}, value : {value}")
-                combined = {filter_: value}
-                if self._match_single_filter(combined, event):
-                    self.logger.debug(f"Event matches filter: {filter_}")
-                    return True
-                else:
-                    self.logger.debug("filter did not match the event.")
-
-            self.logger.debug("Returning false")
-            return False
+        return any(filter_matches(filters, event) for filters in self.filters)
 
-    def _match_single_filter(
-        self, filter_: Dict[str, Any], event: Dict[str, Any]
-    ) -> bool:
-        """
-        Matches an event against a single filter.
 
-        Args:
-            filter_ (Dict[str, Any]): The filter to apply.
-            event (Dict[str, Any]): The raw Redis event to match.
+def _approx_size(obj: Any) -> int:
+    """Approximate deep size in bytes of decoded JSON data (dicts, lists, scalars)."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _approx_size(key) + _approx_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += _approx_size(item)
+    return size
 
-        Returns:
-            bool: True if the event matches the filter, False otherwise.
-        """
-        for key, value in filter_.items():
-            self.logger.debug(f"Checking key: {key}, value: {value}")
 
-            if key == "kinds":
-                if event.get("kind") not in value:
-                    self.logger.debug(
-                        f"Filter mismatch for 'kinds': {event.get('kind')} not in {value}"
-                    )
-                    return False
-            elif key == "authors":
-                if event.get("pubkey") not in value:
-                    self.logger.debug(
-                        f"Filter mismatch for 'authors': {event.get('pubkey')} not in {value}"
-                    )
-                    return False
-            elif key.startswith("#"):
-                tag_key = key[1:]
-                if not any(
-                    tag_key == tag[0] and any(v in tag[1] for v in value)
-                    for tag in event.get("tags", [])
-                ):
-                    self.logger.debug(
-                        f"Filter mismatch for tag '{key}': {event.get('tags', [])}"
-                    )
-                    return False
-            elif key == "since":
-                if event.get("created_at", 0) < value:
-                    return False
-            elif key == "until":
-                if event.get("created_at", 0) > value:
-                    return False
-            elif key == "search":
-                self.logger.debug(
-                    f"Performing search for value '{value}' in content and tags"
-                )
-                content = event.get("content", "")
-                tags = event.get("tags", [])
-                self.logger.debug(f"Event content: {content}")
-                self.logger.debug(f"Event tags: {tags}")
-
-                # Check if `value` exists in content or tags
-                if value.lower() not in content.lower() and not any(
-                    value.lower() in tag_value.lower() for _, tag_value in tags
-                ):
-                    self.logger.debug(
-                        f"Search mismatch: '{value}' not found in content or tags"
-                    )
-                    return False
-            elif key == "id":
-                if event.get("id", "") != value:
-                    return False
-            else:
-                if key in event and event[key] != value:
-                    self.logger.debug(
-                        f"Filter mismatch for key '{key}': {event.get(key)} != {value}"
-                    )
-                    return False
+class SubscriptionRecord:
+    """
+    A live subscription of one connection.
+
+    Attributes:
+        subscription_id (str): The client-chosen subscription ID.
+        filters (List[Dict[str, Any]]): The filters of the REQ.
+        matcher (SubscriptionMatcher): Matcher built once for the filters.
+        frame_prefix (str): EVENT frame prefix for the subscription ID.
+    """
+
+    __slots__ = ("subscription_id", "filters", "matcher", "frame_prefix")
 
-        self.logger.debug("Filter matched successfully.")
+    def __init__(self, subscription_id: str, filters: List, logger):
+        self.subscription_id = subscription_id
+        self.filters = filters
+        self.matcher = SubscriptionMatcher(subscription_id, filters, logger)
+        self.frame_prefix = event_frame_prefix(subscription_id)
+
+    def approx_size(self) -> int:
+        return (
+            sys.getsizeof(self)
+            + _approx_size(self.subscription_id)
+            + _approx_size(self.filters)
+            + sys.getsizeof(self.matcher)
+            + sys.getsizeof(self.frame_prefix)
+        )
+
+
+class ConnectionState:
+    """
+    Per-connection state: the outbound writer and the connection's subscriptions.
+
+    Attributes:
+        websocket (websockets.WebSocketServerProtocol): The client connection.
+        writer (ConnectionWriter): The connection's outbound writer.
+        subscriptions (Dict[str, SubscriptionRecord]): Live subscriptions keyed by subscription ID.
+        negentropy (Dict[str, Negentropy]): Open NIP-77 syncs keyed by subscription ID.
+    """
+
+    __slots__ = ("websocket", "writer", "subscriptions", "negentropy")
+
+    def __init__(self, websocket, writer: ConnectionWriter):
+        self.websocket = websocket
+        self.writer = writer
+        self.subscriptions: Dict[str, SubscriptionRecord] = {}
+        self.negentropy: Dict[str, Negentropy] = {}
+
+    def approx_size(self) -> int:
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.subscriptions)
+            + sum(record.approx_size() for record in self.subscriptions.values())
+            + sum(sync.index.approx_size() for sync in self.negentropy.values())
+        )
+
+
+class SubscriptionRegistry:
+    """
+    Tracks every connection and its subscriptions.
+
+    Subscriptions are scoped to their connection, so two clients may use the
+    same subscription ID, and all subscriptions of a connection are dropped
+    together when it closes.
+
+    Attributes:
+        max_subscriptions (int): Maximum live subscriptions per connection.
+        max_filters (int): Maximum filters per REQ.
+        connections (Dict[str, ConnectionState]): Connection state keyed by websocket ID.
+        subscription_count (int): Live subscriptions across all connections.
+
+    Methods:
+        register(websocket, writer): Adds a connection and returns its state.
+        add(state, subscription_id, filters): Adds or replaces a subscription, returning a CLOSED reason if it is refused.
+        remove(state, subscription_id): Removes a subscription if it exists.
+        drop(state): Removes a connection and all of its subscriptions.
+        matching(event): Yields the (state, record) pairs whose filters match an event.
+        memory_usage(): Returns approximate total, mean and max bytes per connection.
+    """
+
+    def __init__(self, logger, max_subscriptions: int = 20, max_filters: int = 10):
+        self.logger = logger
+        self.max_subscriptions = max_subscriptions
+        self.max_filters = max_filters
+        self.connections: Dict[Any, ConnectionState] = {}
+        self.subscription_count = 0
+
+    def register(self, websocket, writer: ConnectionWriter) -> ConnectionState:
+        state = ConnectionState(websocket, writer)
+        self.connections[websocket.id] = state
+        return state
+
+    def add(
+        self, state: ConnectionState, subscription_id: str, filters: List
+    ) -> Optional[str]:
+        if len(filters) > self.max_filters:
+            return f"error: too many filters in REQ (max {self.max_filters})"
+        replacing = subscription_id in state.subscriptions
+        if not replacing and len(state.subscriptions) >= self.max_subscriptions:
+            return f"error: too many subscriptions on this connection (max {self.max_subscriptions})"
+        state.subscriptions[subscription_id] = SubscriptionRecord(
+            subscription_id, filters, self.logger
+        )
+        if not replacing:
+            self.subscription_count += 1
+        return None
+
+    def remove(self, state: ConnectionState, subscription_id: str) -> bool:
+        if state.subscriptions.pop(subscription_id, None) is None:
+            return False
+        self.subscription_count -= 1
         return True
+
+    def drop(self, state: ConnectionState) -> int:
+        self.connections.pop(state.websocket.id, None)
+        dropped = len(state.subscriptions)
+        self.subscription_count -= dropped
+        state.subscriptions.clear()
+        return dropped
+
+    def matching(self, event: Dict[str, Any]):
+        for state in list(self.connections.values()):
+            for record in list(state.subscriptions.values()):
+                try:
+                    if record.matcher.match_event(event):
+                        yield state, record
+                except Exception as e:
+                    self.logger.error(
+                        f"Error matching subscription {record.subscription_id}: {e}"
+                    )
+
+    def memory_usage(self) -> Tuple[int, float, int]:
+        sizes = [state.approx_size() for state in self.connections.values()]
+        if not sizes:
+            return 0, 0.0, 0
+        total = sum(sizes)
+        return total, total / len(sizes), max(sizes)
+
+
+# Filter keys besides single-letter tags that the hot timeline evaluates
+# exactly like storage does
+HOT_FILTER_KEYS = {"ids", "authors", "kinds", "since", "until", "limit"}
+
+
+class KindTimeline:
+    """
+    The buffered events of one kind.
+
+    Attributes:
+        keys (List[Tuple[int, str]]): (created_at, id) of each event, oldest first.
+        events (Dict[str, Tuple[Dict[str, Any], str]]): Decoded event and its JSON text by ID.
+        floor (int): Every stored event of the kind created at or after this is buffered.
+        primed (bool): Whether the buffer was loaded from storage, so ``floor`` holds.
+    """
+
+    __slots__ = ("keys", "events", "floor", "primed")
+
+    def __init__(self):
+        self.keys: List[Tuple[int, str]] = []
+        self.events: Dict[str, Tuple[Dict[str, Any], str]] = {}
+        self.floor = 0
+        self.primed = False
+
+    def trim(self) -> None:
+        cut = bisect_left(self.keys, (self.floor,))
+        for _, event_id in self.keys[:cut]:
+            del self.events[event_id]
+        del self.keys[:cut]
+
+
+class HotTimeline:
+    """
+    The newest events of a few regular kinds, kept in memory from the
+    fan-out stream so that REQs for recent events skip the event handler.
+
+    Each kind holds at most ``size`` events and a floor: every stored event
+    of the kind created at or after the floor is in the buffer. A buffer is
+    primed with the newest events in storage once the worker listens to the
+    fan-out channel, and evicting the oldest event raises the floor past it.
+    Deletions arriving on the stream remove their targets.
+
+    A filter is answered from memory when all of its kinds are primed, it
+    has no keys besides ids, authors, kinds, tags, since, until and limit,
+    and either ``limit`` events match at or above the floor or ``since`` is
+    not below it. Otherwise the caller queries storage.
+
+    Attributes:
+        size (int): Most events kept per kind.
+        default_limit (int): Limit of a filter without one, as in storage.
+        kinds (Dict[int, KindTimeline]): The buffers by kind.
+        hits (int): Filters answered from memory.
+        misses (int): Filters left to storage.
+    """
+
+    def __init__(
+        self, kinds: Iterable[int], size: int, logger, default_limit: int = 100
+    ):
+        self.size = size
+        self.logger = logger
+        self.default_limit = default_limit
+        # Replaceable and addressable events are overwritten in storage and
+        # ephemeral ones are never stored, so only regular kinds are buffered
+        self.kinds: Dict[int, KindTimeline] = {
+            kind: KindTimeline() for kind in kinds if kind_class(kind) == "regular"
+        }
+        self.hits = 0
+        self.misses = 0
+        # Deletions seen before priming, so a primed page read before the
+        # deletion was stored cannot bring its targets back
+        self._deleted: Set[Tuple[str, str]] = set()
+
+    def add(self, event: Dict[str, Any], event_json: str) -> None:
+        """Takes an event from the fan-out stream."""
+        kind = event.get("kind")
+        if kind == 5:
+            self._delete(event)
+            return
+        timeline = self.kinds.get(kind)
+        if timeline is None:
+            return
+        self._insert(timeline, event, event_json)
+
+    def prime(self, kind: int, events: List[Dict[str, Any]], limit: int) -> None:
+        """
+        Loads the newest stored events of a kind, read with ``limit``. If
+        fewer came back, storage holds no others, otherwise the floor moves
+        just above the oldest of them.
+        """
+        timeline = self.kinds[kind]
+        if len(events) >= limit:
+            oldest = min(event["created_at"] for event in events)
+            timeline.floor = max(timeline.floor, oldest + 1)
+        for event in events:
+            if (event["id"], event["pubkey"]) not in self._deleted:
+                self._insert(timeline, event, orjson.dumps(event).decode("utf-8"))
+        timeline.trim()
+        timeline.primed = True
+        if all(timeline.primed for timeline in self.kinds.values()):
+            self._deleted.clear()
+
+    def reset(self) -> None:
+        """Forgets every event, for when the fan-out stream may have missed some."""
+        for kind in self.kinds:
+            self.kinds[kind] = KindTimeline()
+        self._deleted.clear()
+
+    def query(self, filters: Any) -> Optional[List[str]]:
+        """
+        Answers one REQ filter from memory.
+
+        Returns:
+            Optional[List[str]]: JSON text of the matching events, newest first,
+            or None if storage has to answer the filter.
+        """
+        try:
+            answer = self._answer(filters)
+        except (KeyError, TypeError, ValueError):
+            answer = None
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "kinds": {
+                kind: {
+                    "events": len(timeline.keys),
+                    "floor": timeline.floor,
+                    "primed": timeline.primed,
+                }
+                for kind, timeline in self.kinds.items()
+            },
+        }
+
+    def _insert(
+        self, timeline: KindTimeline, event: Dict[str, Any], event_json: str
+    ) -> None:
+        key = (event["created_at"], event["id"])
+        if key[0] < timeline.floor or key[1] in timeline.events:
+            return
+        insort(timeline.keys, key)
+        timeline.events[key[1]] = (event, event_json)
+        if len(timeline.keys) > self.size:
+            timeline.floor = timeline.keys[0][0] + 1
+            timeline.trim()
+
+    def _delete(self, deletion: Dict[str, Any]) -> None:
+        pubkey = deletion.get("pubkey")
+        for tag in deletion.get("tags", []):
+            if len(tag) < 2 or tag[0] != "e":
+                continue
+            if not all(timeline.primed for timeline in self.kinds.values()):
+                self._deleted.add((tag[1], pubkey))
+            for timeline in self.kinds.values():
+                entry = timeline.events.get(tag[1])
+                if entry is not None and entry[0].get("pubkey") == pubkey:
+                    del timeline.events[tag[1]]
+                    timeline.keys.remove((entry[0]["created_at"], tag[1]))
+
+    def _answer(self, filters: Any) -> Optional[List[str]]:
+        if not isinstance(filters, dict):
+            return None
+        kinds = filters.get("kinds")
+        if not kinds or not isinstance(kinds, list):
+            return None
+        timelines = [self.kinds.get(kind) for kind in set(kinds)]
+        if not all(timeline and timeline.primed for timeline in timelines):
+            return None
+
+        for key, value in filters.items():
+            if key in HOT_FILTER_KEYS:
+                continue
+            if len(key) == 2 and key[0] == "#" and isinstance(value, list):
+                continue
+            return None
+        prepared = prepare_filter(filters)
+        since = filters.get("since")
+        until = filters.get("until")
+        limit = filters.get("limit")
+        if not isinstance(limit, int) or limit <= 0:
+            limit = self.default_limit
+
+        floor = max(timeline.floor for timeline in timelines)
+        lower = floor if since is None else max(floor, int(since))
+        matched = []
+        for timeline in timelines:
+            keys = timeline.keys
+            start = len(keys) if until is None else bisect_left(keys, (int(until) + 1,))
+            found = 0
+            for position in range(start - 1, -1, -1):
+                key = keys[position]
+                if key[0] < lower:
+                    break
+                event, event_json = timeline.events[key[1]]
+                if not filter_matches(prepared, event):
+                    continue
+                matched.append((key, event_json))
+                found += 1
+                if found >= limit:
+                    break
+
+        # Events missing from memory are older than the floor, so the newest
+        # ``limit`` matches at or above it are the answer; with fewer, only a
+        # since at or above the floor proves that none are missing
+        if len(matched) < limit and (since is None or int(since) < floor):
+            return None
+        matched.sort(reverse=True)
+        return [event_json for _, event_json in matched[:limit]]
@@ -1,8 +1,15 @@
 import asyncio
 import logging
+import multiprocessing
 import orjson
 import os
-from typing import Any, Dict, Tuple
+import signal
+import socket
+import sys
+import time
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
 
 import aiohttp
 import redis.asyncio as redis
@@ -10,7 +17,21 @@ import websockets
 from aiohttp.client_exceptions import ClientConnectionError
 import websockets.exceptions
 
-from websocket_classes import ExtractedResponse, WebsocketMessages, SubscriptionMatcher
+from websocket_classes import (
+    ConnectionState,
+    ConnectionWriter,
+    ExtractedResponse,
+    HotTimeline,
+    SubscriptionRegistry,
+    WebsocketMessages,
+    event_frame_prefix,
+    event_signature_valid,
+    split_redis_payload,
+)
+from negentropy import Negentropy, NegentropyError, NegentropyIndex
+from rate_limit import RateLimiter, rate_limits_from_env
+from profiling import CaptureBusy, process_sizes, profile_for, tracemalloc_diff
+from utils import STAGE_BUCKETS_MS, StageTimer, admin_authorized, kind_class
 
 from opentelemetry import metrics, trace
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
@@ -33,8 +54,49 @@ AioHttpClientInstrumentor().instrument()
 OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
 EVENT_HANDLER_SVC = os.getenv("EVENT_HANDLER_SVC")
 EVENT_HANDLER_PORT = os.getenv("EVENT_HANDLER_PORT")
+EVENT_HANDLER_UDS = os.getenv("EVENT_HANDLER_UDS")
+EVENT_HANDLER_URL = f"http://{EVENT_HANDLER_SVC}:{EVENT_HANDLER_PORT}"
+HANDLER_POOL_LIMIT = int(os.getenv("HANDLER_POOL_LIMIT", 100))
+HANDLER_KEEPALIVE_TIMEOUT = float(os.getenv("HANDLER_KEEPALIVE_TIMEOUT", 60))
+HANDLER_POOL_TIMEOUT = float(os.getenv("HANDLER_POOL_TIMEOUT", 5))
+HANDLER_REQUEST_TIMEOUT = float(os.getenv("HANDLER_REQUEST_TIMEOUT", 30))
+RELAY_MODE = os.getenv("RELAY_MODE", "split")
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_CHANNEL = "new_events_channel"
+# Tells the event handler that this process already verified the signature
+SIGNATURE_VERIFIED_HEADER = "X-Signature-Verified"
+INVALID_SIGNATURE_REASON = "invalid: signature verification failed"
+# Sent by the event handler after it failed to publish an event
+FANOUT_GAP = b"gap"
+REDIS_BATCH_SIZE = int(os.getenv("REDIS_BATCH_SIZE", 256))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 1000))
+WS_SEND_BATCH_SIZE = int(os.getenv("WS_SEND_BATCH_SIZE", 64))
+WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop")
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", 20))
+WS_MAX_FILTERS = int(os.getenv("WS_MAX_FILTERS", 10))
+WS_WORKERS = int(os.getenv("WS_WORKERS", 1))
+WS_WORKER_ID = os.getenv("WS_WORKER_ID", "0")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+NEG_MAX_SESSIONS = int(os.getenv("NEG_MAX_SESSIONS", 2))
+NEG_FRAME_SIZE_LIMIT = int(os.getenv("NEG_FRAME_SIZE_LIMIT", 60000))
+QUERY_PAGE_SIZE = int(os.getenv("QUERY_PAGE_SIZE", 500))
+QUERY_MAX_LIMIT = int(os.getenv("QUERY_MAX_LIMIT", 5000))
+HOT_TIMELINE_KINDS = [
+    int(kind) for kind in os.getenv("HOT_TIMELINE_KINDS", "1,6,7").split(",") if kind
+]
+HOT_TIMELINE_SIZE = int(os.getenv("HOT_TIMELINE_SIZE", 1000))
+REDIS_RECONNECT_MIN_DELAY = 1.0
+REDIS_RECONNECT_MAX_DELAY = 30.0
+# The event handler answers 503 when no database connection freed up in time
+BUSY_REASON = "rate-limited: relay is busy, try again later"
+# CLOSED reason of a REQ the event handler did not run, by its status
+SUBSCRIPTION_CLOSED_REASONS = {
+    413: "blocked: filter is too expensive, narrow it with ids, authors, kinds or since",
+    503: BUSY_REASON,
+}
+RATE_LIMITS = rate_limits_from_env(os.environ)
+RATE_LIMIT_REDIS = os.getenv("RATE_LIMIT_REDIS", "false").lower() == "true"
+SERVICE_INSTANCE_ID = f"{socket.gethostname()}-ws{WS_WORKER_ID}"
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -44,7 +106,14 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 
 trace.set_tracer_provider(
-    TracerProvider(resource=Resource.create({"service.name": "websocket_handler_otel"}))
+    TracerProvider(
+        resource=Resource.create(
+            {
+                "service.name": "websocket_handler_otel",
+                "service.instance.id": SERVICE_INSTANCE_ID,
+            }
+        )
+    )
 )
 tracer = trace.get_tracer(__name__)
 
@@ -52,7 +121,9 @@ otlp_exporter = OTLPSpanExporter(endpoint=OTLP_ENDPOINT)
 span_processor = BatchSpanProcessor(otlp_exporter)
 otlp_tracer = trace.get_tracer_provider().add_span_processor(span_processor)
 
-resource = Resource.create({"service.name": "websocket-handler"})
+resource = Resource.create(
+    {"service.name": "websocket-handler", "service.instance.id": SERVICE_INSTANCE_ID}
+)
 metric_exporter = OTLPMetricExporter(endpoint=OTLP_ENDPOINT)
 metric_reader = PeriodicExportingMetricReader(metric_exporter)
 
@@ -63,14 +134,32 @@ meter = metrics.get_meter("example-meter", version="1.0")
 
 redis_client = redis.from_url(f"redis://{REDIS_HOST}")
 
-active_subscriptions = {}
+handler_session: Optional[aiohttp.ClientSession] = None
+embedded_handler = None
+registry = SubscriptionRegistry(
+    logger, max_subscriptions=WS_MAX_SUBSCRIPTIONS, max_filters=WS_MAX_FILTERS
+)
+rate_limiter = RateLimiter(
+    RATE_LIMITS, logger, redis_client=redis_client if RATE_LIMIT_REDIS else None
+)
+fanout_queue: asyncio.Queue = asyncio.Queue()
+fanout_subscribed = asyncio.Event()
+# Counts the fan-out subscriptions made, so work started under one that has
+# since dropped can tell it is stale
+fanout_generation = 0
+hot_timeline = (
+    HotTimeline(HOT_TIMELINE_KINDS, HOT_TIMELINE_SIZE, logger)
+    if HOT_TIMELINE_KINDS
+    else None
+)
+fanout_pending = 0
 
 
 def active_websockets_subscriptions_callback(options: CallbackOptions):
     """
     Callback to return the current number of active WebSocket subscriptions.
     """
-    len_act_sub = len(active_subscriptions)
+    len_act_sub = registry.subscription_count
     logger.debug(f"Gauge callback - Active WebSocket subscriptions: {len_act_sub}")
     return [Observation(value=len_act_sub, attributes={})]
 
@@ -84,235 +173,1014 @@ active_websockets_subs_gauge = meter.create_observable_gauge(
 )
 
 
+def connection_memory_callback(options: CallbackOptions):
+    """
+    Callback to return the approximate memory held by connection and subscription state.
+    """
+    total, mean, largest = registry.memory_usage()
+    return [
+        Observation(value=total, attributes={"stat": "total"}),
+        Observation(value=mean, attributes={"stat": "mean"}),
+        Observation(value=largest, attributes={"stat": "max"}),
+    ]
+
+
+connection_memory_gauge = meter.create_observable_gauge(
+    name="ws_connection_memory",
+    description="Approximate subscription state memory per WebSocket connection",
+    unit="By",
+    callbacks=[connection_memory_callback],
+)
+
+active_connections_gauge = meter.create_observable_gauge(
+    name="active_websockets",
+    description="Open WebSocket connections",
+    unit="count",
+    callbacks=[
+        lambda options: [Observation(value=len(registry.connections), attributes={})]
+    ],
+)
+
+
+def fanout_queue_depth_callback(options: CallbackOptions):
+    """
+    Callback to return the number of Redis events waiting for fan-out.
+    """
+    return [Observation(value=fanout_pending, attributes={})]
+
+
+fanout_queue_depth_gauge = meter.create_observable_gauge(
+    name="redis_listener_queue_depth",
+    description="Events received from Redis and not yet fanned out",
+    unit="count",
+    callbacks=[fanout_queue_depth_callback],
+)
+
+rate_limited_counter = meter.create_observable_counter(
+    name="rate_limited",
+    description="Messages refused by a rate limit, by action and scope",
+    unit="count",
+    callbacks=[
+        lambda options: [
+            Observation(value=count, attributes={"action": action, "scope": scope})
+            for (action, scope), count in rate_limiter.refused.items()
+        ]
+    ],
+)
+
+delivery_latency_histogram = meter.create_histogram(
+    name="event_delivery_latency",
+    description="Time from Redis publish to websocket send of a live event",
+    unit="ms",
+)
+
+handler_pool_wait_histogram = meter.create_histogram(
+    name="handler_pool_wait",
+    description="Time a request to the event handler waited for a pooled connection",
+    unit="ms",
+)
+
+send_queue_depth_histogram = meter.create_histogram(
+    name="ws_send_queue_depth",
+    description="Frames waiting in a connection's outbound queue when its writer wakes up",
+    unit="count",
+)
+
+stage_histogram = meter.create_histogram(
+    name="relay_stage_duration",
+    description="Time spent in each hot-path stage, by stage, kind class and result",
+    unit="ms",
+    explicit_bucket_boundaries_advisory=STAGE_BUCKETS_MS,
+)
+
+
+def create_handler_session() -> aiohttp.ClientSession:
+    """
+    Creates the process-wide HTTP client used for every request to the event handler.
+
+    Connections are kept alive and shared by all websocket clients, over TCP or,
+    when ``EVENT_HANDLER_UDS`` is set, over a Unix domain socket. The time each
+    request waits for a free pooled connection is recorded in
+    ``handler_pool_wait``.
+    """
+
+    async def on_request_start(session, context, params):
+        context.queued_at = None
+        context.pool_wait = 0.0
+
+    async def on_connection_queued_start(session, context, params):
+        context.queued_at = time.perf_counter()
+
+    async def on_connection_queued_end(session, context, params):
+        context.pool_wait = (time.perf_counter() - context.queued_at) * 1000
+
+    async def on_request_end(session, context, params):
+        handler_pool_wait_histogram.record(context.pool_wait)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_request_end.append(on_request_end)
+
+    if EVENT_HANDLER_UDS:
+        connector = aiohttp.UnixConnector(
+            path=EVENT_HANDLER_UDS,
+            limit=HANDLER_POOL_LIMIT,
+            keepalive_timeout=HANDLER_KEEPALIVE_TIMEOUT,
+        )
+    else:
+        connector = aiohttp.TCPConnector(
+            limit=HANDLER_POOL_LIMIT, keepalive_timeout=HANDLER_KEEPALIVE_TIMEOUT
+        )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=HANDLER_REQUEST_TIMEOUT, connect=HANDLER_POOL_TIMEOUT
+        ),
+        trace_configs=[trace_config],
+    )
+
+
 async def handle_websocket_connection(
     websocket: websockets.WebSocketServerProtocol,
 ) -> None:
-    conn = aiohttp.TCPConnector(limit=500)
-    async with aiohttp.ClientSession(connector=conn) as session:
-        try:
-            async for message in websocket:
-                try:
-                    logger.debug(f"message in loop is {message}")
-                    ws_message = message
-                    if ws_message:
-                        ws_message = WebsocketMessages(
-                            message=orjson.loads(message),
-                            websocket=websocket,
-                            logger=logger,
-                        )
-                except orjson.JSONDecodeError as json_error:
-                    logger.error(f"Error decoding JSON message: {json_error}")
-                    continue
+    writer = ConnectionWriter(
+        websocket,
+        logger,
+        max_queue_size=WS_SEND_QUEUE_SIZE,
+        overflow_policy=WS_OVERFLOW_POLICY,
+        batch_size=WS_SEND_BATCH_SIZE,
+        depth_histogram=send_queue_depth_histogram,
+        latency_histogram=delivery_latency_histogram,
+        stage_histogram=stage_histogram,
+    )
+    writer.start()
+    state = registry.register(websocket, writer)
+    try:
+        async for message in websocket:
+            try:
+                logger.debug(f"message in loop is {message}")
+                ws_message = message
+                if ws_message:
+                    with StageTimer(stage_histogram, "json_parse"):
+                        decoded = orjson.loads(message)
+                    ws_message = WebsocketMessages(
+                        message=decoded,
+                        websocket=websocket,
+                        logger=logger,
+                        raw_message=message,
+                    )
+            except orjson.JSONDecodeError as json_error:
+                logger.error(f"Error decoding JSON message: {json_error}")
+                continue
 
-                if ws_message.event_type == "EVENT":
-                    logger.debug(
-                        f"Event to be sent payload is: {ws_message.event_payload} of type {type(ws_message.event_payload)}"
+            if rate_limiter and await rate_limited(ws_message, writer):
+                if ws_message.event_type == "REQ":
+                    registry.remove(state, ws_message.subscription_id)
+                continue
+
+            if ws_message.event_type == "EVENT":
+                if ws_message.signature_verified is False:
+                    payload = ws_message.event_payload
+                    event_id = (
+                        payload.get("id", "") if isinstance(payload, dict) else ""
                     )
-                    with tracer.start_as_current_span("send_event_to_handle") as span:
-                        current_span = trace.get_current_span()
-                        current_span.set_attribute(
-                            "operation.name", "send.event.handler"
-                        )
-                        await send_event_to_handler(
-                            session=session,
-                            event_dict=dict(ws_message.event_payload),
-                            websocket=websocket,
-                        )
-                elif ws_message.event_type == "REQ":
-                    logger.debug(
-                        f"Payload is {ws_message.event_payload} and of type: {type(ws_message.event_payload)}"
+                    await writer.send(
+                        orjson.dumps(
+                            ("OK", event_id, False, INVALID_SIGNATURE_REASON)
+                        ).decode("utf-8")
                     )
-                    with tracer.start_as_current_span(
-                        "send_event_to_subscription"
-                    ) as span:
-                        current_span = trace.get_current_span()
-                        current_span.set_attribute(
-                            "operation.name", "send.event.subscription"
-                        )
-                        await send_subscription_to_handler(
-                            session=session,
-                            event_dict=ws_message.event_payload,
-                            subscription_id=ws_message.subscription_id,
-                            websocket=websocket,
+                    continue
+                logger.debug(
+                    f"Event to be sent payload is: {ws_message.event_payload} of type {type(ws_message.event_payload)}"
+                )
+                with tracer.start_as_current_span("send_event_to_handle") as span:
+                    current_span = trace.get_current_span()
+                    current_span.set_attribute("operation.name", "send.event.handler")
+                    await send_event_to_handler(
+                        session=handler_session,
+                        raw_event=ws_message.raw_event,
+                        event_dict=ws_message.event_payload,
+                        writer=writer,
+                        verified=bool(ws_message.signature_verified),
+                    )
+            elif ws_message.event_type == "REQ":
+                logger.debug(
+                    f"Payload is {ws_message.event_payload} and of type: {type(ws_message.event_payload)}"
+                )
+                with tracer.start_as_current_span("send_event_to_subscription") as span:
+                    current_span = trace.get_current_span()
+                    current_span.set_attribute(
+                        "operation.name", "send.event.subscription"
+                    )
+                    refused = registry.add(
+                        state, ws_message.subscription_id, ws_message.event_payload
+                    )
+                    if refused:
+                        await writer.send(
+                            orjson.dumps(
+                                ("CLOSED", ws_message.subscription_id, refused)
+                            ).decode("utf-8")
                         )
-                    active_subscriptions[ws_message.subscription_id] = {
-                        "event": ws_message.event_payload,
-                        "websocket": websocket,
-                    }
-                    logger.info(
-                        f"Stored subscription: {ws_message.subscription_id} with event {ws_message.event_payload}"
+                        continue
+                    closed = await send_subscription_to_handler(
+                        session=handler_session,
+                        event_dict=ws_message.event_payload,
+                        subscription_id=ws_message.subscription_id,
+                        writer=writer,
+                        client=str(ws_message.uuid),
                     )
-                elif ws_message.event_type == "CLOSE":
-                    response: Tuple[str, str] = (
-                        "CLOSED",
-                        ws_message.subscription_id,
-                        "error: shutting down idle subscription",
+                    if closed:
+                        registry.remove(state, ws_message.subscription_id)
+                        continue
+                logger.info(
+                    f"Stored subscription: {ws_message.subscription_id} with event {ws_message.event_payload}"
+                )
+            elif ws_message.event_type == "CLOSE":
+                response: Tuple[str, str] = (
+                    "CLOSED",
+                    ws_message.subscription_id,
+                    "error: shutting down idle subscription",
+                )
+                registry.remove(state, ws_message.subscription_id)
+                await writer.send(orjson.dumps(response).decode("utf-8"))
+            elif ws_message.event_type == "COUNT":
+                if len(ws_message.event_payload) > WS_MAX_FILTERS:
+                    refused = f"error: too many filters in COUNT (max {WS_MAX_FILTERS})"
+                    await writer.send(
+                        orjson.dumps(
+                            ("CLOSED", ws_message.subscription_id, refused)
+                        ).decode("utf-8")
                     )
-                    await websocket.send(orjson.dumps(response).decode("utf-8"))
-                    del active_subscriptions[ws_message.subscription_id]
-
-        except (
-            websockets.exceptions.ConnectionClosedError,
-            ClientConnectionError,
-            aiohttp.ClientError,
-            Exception,
-        ) as error:
-            logger.error(
-                f"An error occurred while processing the WebSocket message: {error}",
-                exc_info=True,
-            )
+                    continue
+                await send_count_to_handler(
+                    session=handler_session,
+                    filters=ws_message.event_payload,
+                    subscription_id=ws_message.subscription_id,
+                    writer=writer,
+                    client=str(ws_message.uuid),
+                )
+            elif ws_message.event_type in ("NEG-OPEN", "NEG-MSG", "NEG-CLOSE"):
+                await handle_negentropy(handler_session, state, ws_message)
+
+    except (
+        websockets.exceptions.ConnectionClosedError,
+        ClientConnectionError,
+        aiohttp.ClientError,
+        Exception,
+    ) as error:
+        logger.error(
+            f"An error occurred while processing the WebSocket message: {error}",
+            exc_info=True,
+        )
+    finally:
+        registry.drop(state)
+        rate_limiter.forget("conn", str(websocket.id))
+        await writer.close()
 
 
-async def send_event_to_handler(
+# What each rate limited action and scope is called in refusal reasons
+RATE_LIMIT_NAMES = {
+    "event": "events",
+    "req": "requests",
+    "filter": "filters",
+    "conn": "connection",
+    "ip": "IP address",
+    "pubkey": "pubkey",
+}
+
+
+async def rate_limited(ws_message: WebsocketMessages, writer: ConnectionWriter) -> bool:
+    """
+    Checks a message against the rate limits before it reaches the event
+    handler, and sends the rate-limited refusal if it is over one.
+
+    EVENTs are limited per connection, IP and author. With an author limit,
+    the signature is verified here first and the author only counts once
+    it verifies, so forged EVENTs cannot spend the budget of the pubkey
+    they claim; the result is kept on the message, so the event handler
+    does not verify it again. REQ, COUNT and NEG-OPEN are limited per
+    connection and IP, both as requests and by the number of filters they
+    carry. Every scope of a message is charged in one check, so a refused
+    message takes nothing.
+
+    Returns:
+        bool: Whether the message was refused.
+    """
+    keys = {"conn": str(ws_message.uuid), "ip": ws_message.obfuscated_client_ip}
+    payload = ws_message.event_payload
+    if ws_message.event_type == "EVENT":
+        action = "event"
+        if ("pubkey", "event") in rate_limiter.limits:
+            kind = payload.get("kind") if isinstance(payload, dict) else None
+            with StageTimer(
+                stage_histogram, "signature_verify", kind_class(kind)
+            ) as timer:
+                ws_message.signature_verified = event_signature_valid(payload)
+                timer.result = "ok" if ws_message.signature_verified else "invalid"
+            if ws_message.signature_verified:
+                keys["pubkey"] = payload["pubkey"]
+        refused = await rate_limiter.check("event", **keys)
+    elif ws_message.event_type in ("REQ", "COUNT", "NEG-OPEN"):
+        action = "req"
+        refused = await rate_limiter.check("req", **keys)
+        if refused is None:
+            filters = 1 if ws_message.event_type == "NEG-OPEN" else len(payload)
+            action = "filter"
+            refused = await rate_limiter.check("filter", filters, **keys)
+    else:
+        return False
+    if refused is None:
+        return False
+
+    reason = (
+        f"rate-limited: too many {RATE_LIMIT_NAMES[action]}"
+        f" from this {RATE_LIMIT_NAMES[refused]}, slow down"
+    )
+    if ws_message.event_type == "EVENT":
+        event_id = payload.get("id", "") if isinstance(payload, dict) else ""
+        frame = ("OK", event_id, False, reason)
+    elif ws_message.event_type == "NEG-OPEN":
+        frame = ("NEG-ERR", ws_message.subscription_id, reason)
+    else:
+        frame = ("CLOSED", ws_message.subscription_id, reason)
+    await writer.send(orjson.dumps(frame).decode("utf-8"))
+    return True
+
+
+async def post_to_event_handler(
     session: aiohttp.ClientSession,
+    path: str,
+    body: bytes,
+    headers: Optional[Dict[str, str]] = None,
+) -> Tuple[Dict[str, Any], int]:
+    """Posts a JSON body to the event handler and returns the decoded reply and HTTP status."""
+    async with session.post(
+        f"{EVENT_HANDLER_URL}{path}", data=body, headers=headers
+    ) as response:
+        return await response.json(loads=orjson.loads), response.status
+
+
+async def send_event_to_handler(
+    session: Optional[aiohttp.ClientSession],
+    raw_event: bytes,
     event_dict: Dict[str, Any],
-    websocket: websockets.WebSocketServerProtocol,
+    writer: ConnectionWriter,
+    verified: bool = False,
 ) -> None:
-    url: str = f"http://{EVENT_HANDLER_SVC}:{EVENT_HANDLER_PORT}/new_event"
+    """
+    Hands an EVENT to the ingest logic and queues the OK reply.
+
+    The event JSON is forwarded exactly as the client sent it. In embedded
+    mode the ingest logic runs in this process and also reuses the already
+    decoded event, so the event is parsed once end to end. A ``verified``
+    event's signature is not checked again.
+    """
     try:
-        async with session.post(url, data=orjson.dumps(event_dict)) as response:
-            current_span = trace.get_current_span()
-            current_span.set_attribute("operation.name", "post.event.handler")
-            response_data: Dict[str, Any] = await response.json(loads=orjson.loads)
-            logger.debug(
-                f"Received response from Event Handler {response_data}, data types is {type(response_data)}"
+        current_span = trace.get_current_span()
+        current_span.set_attribute("operation.name", "post.event.handler")
+        if embedded_handler is not None:
+            response_data, status = await embedded_handler.process_new_event(
+                embedded_handler.app, raw_event, event_dict, verified=verified
             )
-            response_object = ExtractedResponse(response_data, logger)
-            if response.status:
-                formatted_response = await response_object.format_response()
-                await websocket.send(orjson.dumps(formatted_response).decode())
+        else:
+            response_data, status = await post_to_event_handler(
+                session,
+                "/new_event",
+                raw_event,
+                headers={SIGNATURE_VERIFIED_HEADER: "true"} if verified else None,
+            )
+        logger.debug(
+            f"Received response from Event Handler {response_data}, data types is {type(response_data)}"
+        )
+        response_object = ExtractedResponse(response_data, logger)
+        if status:
+            formatted_response = await response_object.format_response()
+            await writer.send(orjson.dumps(formatted_response).decode())
     except Exception as e:
         logger.error(f"An error occurred while sending the event to the handler: {e}")
 
 
+async def fetch_subscription(
+    session: Optional[aiohttp.ClientSession], payload: Dict[str, Any]
+) -> Tuple[Dict[str, Any], int]:
+    """Runs a REQ payload through the event handler, in process when embedded."""
+    if embedded_handler is not None:
+        return await embedded_handler.process_subscription(
+            embedded_handler.app, payload
+        )
+    return await post_to_event_handler(session, "/subscription", orjson.dumps(payload))
+
+
+def is_paged_filter(filters: Any) -> bool:
+    """Tells whether a filter asks for more events than fit in one page."""
+    limit = filters.get("limit") if isinstance(filters, dict) else None
+    return isinstance(limit, int) and limit > QUERY_PAGE_SIZE
+
+
+async def stream_paged_filter(
+    session: Optional[aiohttp.ClientSession],
+    filters: Dict[str, Any],
+    subscription_id: str,
+    writer: ConnectionWriter,
+    client: str = "",
+) -> int:
+    """
+    Sends the events of a filter with a limit larger than a page, one page
+    at a time, up to QUERY_MAX_LIMIT events. Each page continues after the
+    (created_at, id) of the last event of the previous one, so the event
+    handler never holds more than a page and no event is skipped or repeated.
+
+    Returns:
+        int: The HTTP status of the last page request.
+    """
+    remaining = min(filters["limit"], QUERY_MAX_LIMIT)
+    payload: Dict[str, Any] = {"subscription_id": subscription_id, "client": client}
+    while remaining > 0:
+        page_limit = min(remaining, QUERY_PAGE_SIZE)
+        payload["event_dict"] = [{**filters, "limit": page_limit}]
+        response_data, status = await fetch_subscription(session, payload)
+        if status != 200 or not response_data or response_data["event"] != "EVENT":
+            logger.debug(f"Paged query stopped with status {status}")
+            return status
+        response_object = ExtractedResponse(response_data, logger)
+        page = response_object.results
+        await response_object.send_event_loop(page, writer, logger)
+        if len(page) < page_limit:
+            break
+        remaining -= len(page)
+        payload["cursor"] = [page[-1]["created_at"], page[-1]["id"]]
+    return 200
+
+
+async def send_hot_timeline(
+    filters: List[Dict[str, Any]], subscription_id: str, writer: ConnectionWriter
+) -> List[Dict[str, Any]]:
+    """Sends the events of the filters the hot timeline answers and returns the others."""
+    remaining = []
+    prefix = event_frame_prefix(subscription_id)
+    for filter_ in filters:
+        with StageTimer(stage_histogram, "hot_timeline") as timer:
+            events = hot_timeline.query(filter_)
+            timer.result = "miss" if events is None else "hit"
+        if events is None:
+            remaining.append(filter_)
+            continue
+        for event_json in events:
+            await writer.send(prefix + event_json + "]")
+    return remaining
+
+
 async def send_subscription_to_handler(
-    session: aiohttp.ClientSession,
+    session: Optional[aiohttp.ClientSession],
     event_dict: Dict,
     subscription_id: str,
-    websocket: websockets.WebSocketServerProtocol,
-) -> None:
-    url: str = f"http://{EVENT_HANDLER_SVC}:{EVENT_HANDLER_PORT}/subscription"
+    writer: ConnectionWriter,
+    client: str = "",
+) -> Optional[str]:
+    """
+    Sends the stored events matching a REQ, then EOSE.
 
-    payload: Dict[str, Any] = {
-        "event_dict": event_dict,
-        "subscription_id": subscription_id,
-    }
-    logger.debug(f"send payload is {payload}")
+    Filters with a limit of up to a page are answered from the hot timeline
+    when it holds their events, the rest by one request to the event
+    handler. Each filter with a larger limit is streamed in pages.
 
-    async with session.post(url, data=orjson.dumps(payload)) as response:
-        current_span = trace.get_current_span()
-        current_span.set_attribute("operation.name", "post.event.subscription")
-        response_data = await response.json(loads=orjson.loads)
+    When the event handler is too busy to query, or finds a filter too
+    expensive to run, the subscription is sent CLOSED instead of EOSE. The
+    event handler queues the queries of each ``client`` fairly against
+    those of other clients.
+
+    Returns:
+        Optional[str]: The CLOSED reason, or None if the subscription stays open.
+    """
+    filters = event_dict if isinstance(event_dict, list) else [event_dict]
+    paged = [f for f in filters if is_paged_filter(f)]
+    single = [f for f in filters if not is_paged_filter(f)]
+    EOSE = ("EOSE", subscription_id)
+
+    if hot_timeline is not None and single:
+        single = await send_hot_timeline(single, subscription_id, writer)
+
+    current_span = trace.get_current_span()
+    current_span.set_attribute("operation.name", "post.event.subscription")
+    if single:
+        payload: Dict[str, Any] = {
+            "event_dict": single,
+            "subscription_id": subscription_id,
+            "client": client,
+        }
+        logger.debug(f"send payload is {payload}")
+        response_data, status = await fetch_subscription(session, payload)
         logger.debug(
             f"Data type of response_data: {type(response_data)}, Response Data: {response_data}"
         )
-        if not response_data:
-            logger.debug("Response data none, returning")
-            await websocket.send(
-                orjson.dumps(("EOSE", subscription_id)).decode("utf-8")
-            )
-            return
-        response_object = ExtractedResponse(response_data, logger)
-        EOSE = ("EOSE", response_object.subscription_id)
-
-        if response.status == 200 and response_object.event_type == "EVENT":
+        if status in SUBSCRIPTION_CLOSED_REASONS:
+            return await close_subscription(subscription_id, status, writer)
+        # Any other reply has no events for these filters; the paged ones
+        # still run
+        if status == 200 and response_data and response_data["event"] == "EVENT":
+            response_object = ExtractedResponse(response_data, logger)
             with tracer.start_as_current_span("send event loop") as span:
                 current_span = trace.get_current_span()
                 current_span.set_attribute("operation.name", "send.event.loop")
 
                 await response_object.send_event_loop(
-                    response_object.results, websocket, logger
+                    response_object.results, writer, logger
                 )
-                await websocket.send(orjson.dumps(EOSE).decode("utf-8"))
         else:
-            await websocket.send(orjson.dumps(EOSE).decode("utf-8"))
-            logger.debug(f"Response data is {response_data} but it failed")
+            logger.debug(f"No events in response {response_data}")
 
+    for filters in paged:
+        with tracer.start_as_current_span("send paged query"):
+            status = await stream_paged_filter(
+                session, filters, subscription_id, writer, client
+            )
+        if status in SUBSCRIPTION_CLOSED_REASONS:
+            return await close_subscription(subscription_id, status, writer)
+    await writer.send(orjson.dumps(EOSE).decode("utf-8"))
+    return None
 
-async def redis_listener():
-    """Listens for Redis pub/sub messages and rebroadcasts to active WebSocket clients."""
+
+async def close_subscription(
+    subscription_id: str, status: int, writer: ConnectionWriter
+) -> str:
+    reason = SUBSCRIPTION_CLOSED_REASONS[status]
+    await writer.send(orjson.dumps(("CLOSED", subscription_id, reason)).decode("utf-8"))
+    return reason
+
+
+async def send_count_to_handler(
+    session: Optional[aiohttp.ClientSession],
+    filters: List,
+    subscription_id: str,
+    writer: ConnectionWriter,
+    client: str = "",
+) -> None:
+    """
+    Answers a NIP-45 COUNT with the event handler's count, marked
+    approximate when it came from a sketch or added up several filters.
+    A COUNT the event handler is too busy for, or finds too expensive, is
+    sent CLOSED with the same reasons as a REQ.
+    """
+    payload = {
+        "event_dict": filters,
+        "subscription_id": subscription_id,
+        "client": client,
+    }
     try:
-        async with redis_client.pubsub() as pubsub:
-            await pubsub.subscribe(REDIS_CHANNEL)
-            logger.info(f"Subscribed to Redis channel: {REDIS_CHANNEL}")
+        if embedded_handler is not None:
+            response_data, status = await embedded_handler.process_count(
+                embedded_handler.app, payload
+            )
+        else:
+            response_data, status = await post_to_event_handler(
+                session, "/count", orjson.dumps(payload)
+            )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        logger.error(f"Could not send COUNT to the event handler: {exc!r}")
+        status = 502
 
-            while True:
-                message = await pubsub.get_message(
-                    ignore_subscribe_messages=True, timeout=1.0
+    if status in SUBSCRIPTION_CLOSED_REASONS:
+        frame = ("CLOSED", subscription_id, SUBSCRIPTION_CLOSED_REASONS[status])
+    elif status != 200:
+        frame = ("CLOSED", subscription_id, "error: could not count events")
+    else:
+        result = {"count": response_data["count"]}
+        if response_data["approximate"]:
+            result["approximate"] = True
+        frame = ("COUNT", subscription_id, result)
+    await writer.send(orjson.dumps(frame).decode("utf-8"))
+
+
+async def fetch_negentropy_items(
+    session: Optional[aiohttp.ClientSession], filters: Dict[str, Any]
+) -> Tuple[bytes, int]:
+    """Gets the packed (created_at, id) items of a sync filter and the HTTP status."""
+    if embedded_handler is not None:
+        return await embedded_handler.process_negentropy_items(
+            embedded_handler.app, filters
+        )
+    try:
+        async with session.post(
+            f"{EVENT_HANDLER_URL}/negentropy_items", data=orjson.dumps(filters)
+        ) as response:
+            return await response.read(), response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        logger.error(f"Could not fetch negentropy items: {exc!r}")
+        return b"", 502
+
+
+async def handle_negentropy(
+    session: Optional[aiohttp.ClientSession],
+    state: ConnectionState,
+    ws_message: WebsocketMessages,
+) -> None:
+    """
+    Answers the NIP-77 NEG-OPEN, NEG-MSG and NEG-CLOSE messages.
+
+    NEG-OPEN loads the (created_at, id) items of the filter once into a
+    negentropy index kept on the connection; the following NEG-MSG rounds
+    are answered from that index without touching the database.
+    """
+    subscription_id = ws_message.subscription_id
+    writer = state.writer
+
+    async def refuse(reason: str) -> None:
+        state.negentropy.pop(subscription_id, None)
+        await writer.send(
+            orjson.dumps(("NEG-ERR", subscription_id, reason)).decode("utf-8")
+        )
+
+    if ws_message.event_type == "NEG-CLOSE":
+        state.negentropy.pop(subscription_id, None)
+        return
+
+    try:
+        if ws_message.event_type == "NEG-OPEN":
+            filters, message = ws_message.event_payload[:2]
+            state.negentropy.pop(subscription_id, None)
+            if len(state.negentropy) >= NEG_MAX_SESSIONS:
+                await refuse(
+                    f"blocked: too many open syncs on this connection (max {NEG_MAX_SESSIONS})"
                 )
-                if message:
-                    logger.debug(f"Received message from Redis: {message}")
-                    if message["type"] == "message":
-                        try:
-                            event_data = orjson.loads(message["data"])
-                            logger.debug(f"Decoded event data: {event_data}")
-                            asyncio.create_task(broadcast_event_to_clients(event_data))
-                        except orjson.JSONDecodeError as e:
-                            logger.error(f"Invalid JSON in Redis message: {e}")
-                await asyncio.sleep(0.1)
-    except Exception as e:
-        logger.error(f"Error in Redis listener: {e}", exc_info=True)
+                return
+            items, status = await fetch_negentropy_items(session, filters)
+            if status == 413:
+                await refuse("blocked: too many events match this filter")
+                return
+            if status == 503:
+                await refuse(BUSY_REASON)
+                return
+            if status != 200:
+                await refuse("error: could not read events for this filter")
+                return
+            # Building the index of a large set takes a while, keep it off the loop
+            index = await asyncio.to_thread(NegentropyIndex.from_packed, items)
+            negentropy = Negentropy(index, NEG_FRAME_SIZE_LIMIT)
+            state.negentropy[subscription_id] = negentropy
+        else:
+            negentropy = state.negentropy.get(subscription_id)
+            if negentropy is None:
+                await refuse("closed: no open sync with this subscription ID")
+                return
+            message = ws_message.event_payload[0]
+        reply = negentropy.reconcile(bytes.fromhex(message))
+    except (NegentropyError, ValueError, TypeError) as exc:
+        logger.debug(f"Invalid negentropy message on {subscription_id}: {exc}")
+        await refuse(f"error: invalid negentropy message: {exc}")
+        return
+
+    await writer.send(
+        orjson.dumps(("NEG-MSG", subscription_id, reply.hex())).decode("utf-8")
+    )
 
 
-async def broadcast_event_to_clients(event_data: Dict[str, Any]) -> None:
-    """Broadcasts an event to all active WebSocket clients."""
-    logger.debug(f"Active subscriptions: {active_subscriptions}")
+async def redis_listener():
+    """
+    Listens for Redis pub/sub messages and queues them for fan-out.
+
+    The listener blocks on the pub/sub socket until a message arrives, then
+    drains everything already buffered (up to ``REDIS_BATCH_SIZE`` messages)
+    and hands the batch to ``fanout_worker`` in one queue entry.
 
-    async def process_subscription(subscription_id, data):
-        websocket = data["websocket"]
+    When the subscription fails, e.g. because Redis restarted, the hot
+    timeline is emptied, since events published meanwhile are missed, and
+    the listener subscribes again after a backoff of up to
+    ``REDIS_RECONNECT_MAX_DELAY`` seconds. Each new subscription primes the
+    hot timeline again.
+    """
+    global fanout_pending, fanout_generation
+    delay = REDIS_RECONNECT_MIN_DELAY
+    while True:
         try:
-            matcher = SubscriptionMatcher(subscription_id, data["event"], logger)
-            if matcher.match_event(event_data):
-                await websocket.send(
-                    orjson.dumps((f"EVENT", subscription_id, event_data)).decode()
-                )
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(REDIS_CHANNEL)
+                logger.info(f"Subscribed to Redis channel: {REDIS_CHANNEL}")
+                fanout_generation += 1
+                fanout_subscribed.set()
+                if hot_timeline is not None:
+                    asyncio.create_task(prime_hot_timeline(fanout_generation))
+                delay = REDIS_RECONNECT_MIN_DELAY
+
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=None
+                    )
+                    batch = []
+                    while message is not None:
+                        if message["type"] == "message":
+                            batch.append(message["data"])
+                        if len(batch) >= REDIS_BATCH_SIZE:
+                            break
+                        message = await pubsub.get_message(
+                            ignore_subscribe_messages=True, timeout=0
+                        )
+                    if batch:
+                        logger.debug(
+                            f"Received batch of {len(batch)} messages from Redis"
+                        )
+                        fanout_pending += len(batch)
+                        fanout_queue.put_nowait(batch)
         except Exception as e:
-            logger.error(f"Error broadcasting to subscription {subscription_id}: {e}")
-            del active_subscriptions[subscription_id]
-
-    # Process all subscriptions concurrently
-    await asyncio.gather(
-        *(
-            process_subscription(subscription_id, data)
-            for subscription_id, data in active_subscriptions.copy().items()
-        )
-    )
+            logger.error(
+                f"Error in Redis listener, resubscribing in {delay:.0f}s: {e}",
+                exc_info=True,
+            )
+        fanout_subscribed.clear()
+        # Events published from now on are missed, so memory can no longer answer
+        if hot_timeline is not None:
+            hot_timeline.reset()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, REDIS_RECONNECT_MAX_DELAY)
 
 
-async def remove_inactive_websockets():
-    """Periodically checks and removes inactive WebSocket connections."""
+async def fanout_worker():
+    """Takes batches of Redis messages off the queue and broadcasts each event."""
+    global fanout_pending
     while True:
-        for subscription_id, data in list(active_subscriptions.items()):
-            websocket = data["websocket"]
+        batch = await fanout_queue.get()
+        for payload in batch:
+            fanout_pending -= 1
+            if payload == FANOUT_GAP:
+                reload_hot_timeline()
+                continue
             try:
-                if websocket.closed:
-                    logger.info(f"Removing inactive WebSocket: {subscription_id}")
-                    del active_subscriptions[subscription_id]
-            except Exception as e:
-                logger.error(f"Error checking WebSocket {subscription_id}: {e}")
-                del active_subscriptions[subscription_id]
-        await asyncio.sleep(10)
+                published_ms, raw_event = split_redis_payload(payload)
+                event_data = orjson.loads(raw_event)
+                logger.debug(f"Decoded event data: {event_data}")
+                event_json = raw_event.decode("utf-8")
+                broadcast_event_to_clients(event_data, event_json, published_ms)
+                if hot_timeline is not None:
+                    hot_timeline.add(event_data, event_json)
+            except (orjson.JSONDecodeError, ValueError) as e:
+                logger.error(f"Invalid JSON in Redis message: {e}")
+
+
+def reload_hot_timeline() -> None:
+    """
+    Empties the hot timeline and primes it again once the event handler
+    reports an event it stored but could not publish, which the timeline
+    is missing. Priming still in progress gives up for the new one.
+    """
+    global fanout_generation
+    if hot_timeline is None:
+        return
+    logger.warning("Event handler missed publishing an event, reloading hot timeline")
+    fanout_generation += 1
+    hot_timeline.reset()
+    if fanout_subscribed.is_set():
+        asyncio.create_task(prime_hot_timeline(fanout_generation))
+
+
+async def prime_hot_timeline(generation: int):
+    """
+    Loads the newest stored events of each hot timeline kind once the fan-out
+    subscription is live, so no event falls between the two. Kinds that fail
+    to load, e.g. while the event handler is starting, are retried. Gives up
+    once the subscription ``generation`` it was started for has dropped; the
+    next subscription primes the timeline again.
+    """
+    limit = min(HOT_TIMELINE_SIZE, QUERY_PAGE_SIZE)
+    pending = list(hot_timeline.kinds)
+    while pending:
+        for kind in list(pending):
+            if generation != fanout_generation or not fanout_subscribed.is_set():
+                return
+            payload = {
+                "event_dict": [{"kinds": [kind], "limit": limit}],
+                "subscription_id": "hot-timeline",
+                "cache": False,
+            }
+            try:
+                response_data, status = await fetch_subscription(
+                    handler_session, payload
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                logger.warning(f"Could not prime hot timeline kind {kind}: {exc!r}")
+                continue
+            if generation != fanout_generation or not fanout_subscribed.is_set():
+                return
+            if status == 200 and response_data["event"] == "EVENT":
+                hot_timeline.prime(kind, response_data["results_json"], limit)
+                pending.remove(kind)
+        if pending:
+            await asyncio.sleep(5)
+    logger.info(f"Hot timeline primed for kinds {list(hot_timeline.kinds)}")
+
+
+def broadcast_event_to_clients(
+    event_data: Dict[str, Any], event_json: str, published_ms: Optional[int] = None
+) -> None:
+    """
+    Broadcasts an event to all active WebSocket clients.
+
+    The event is matched against the decoded ``event_data`` but sent as the
+    ``event_json`` text received from Redis, spliced into a per-subscription
+    frame prefix, so it is never re-encoded per recipient. Frames are offered
+    to each connection's writer without waiting, so a stalled client cannot
+    hold up delivery to the others.
+    """
+    frame_suffix = event_json + "]"
+    for state, record in registry.matching(event_data):
+        state.writer.offer(record.frame_prefix + frame_suffix, published_ms)
+
+
+async def internal_sizes() -> Dict[str, Any]:
+    """
+    Collects the sizes of this worker's connections, subscriptions, queues
+    and, in embedded mode, the event handler state for the admin size dump.
+    """
+    total, mean, largest = registry.memory_usage()
+    queue_depths = sorted(
+        (state.writer.queue.qsize() for state in registry.connections.values()),
+        reverse=True,
+    )
+    sizes = {
+        "process": process_sizes(),
+        "worker_id": WS_WORKER_ID,
+        "connections": len(registry.connections),
+        "subscriptions": registry.subscription_count,
+        "subscription_memory_bytes": {"total": total, "mean": mean, "max": largest},
+        "send_queues": {
+            "total": sum(queue_depths),
+            "full": sum(1 for depth in queue_depths if depth >= WS_SEND_QUEUE_SIZE),
+            "deepest": queue_depths[:10],
+        },
+        "fanout_queue_batches": fanout_queue.qsize(),
+        "fanout_pending_events": fanout_pending,
+    }
+    if hot_timeline is not None:
+        sizes["hot_timeline"] = hot_timeline.stats()
+    if rate_limiter:
+        sizes["rate_limiter"] = rate_limiter.stats()
+    if handler_session is not None:
+        sizes["handler_pool_limit"] = handler_session.connector.limit
+    if embedded_handler is not None:
+        sizes["event_handler"] = await embedded_handler.internal_sizes(
+            embedded_handler.app
+        )
+    return sizes
+
+
+def admin_response(status: HTTPStatus, body: Any, content_type="application/json"):
+    if content_type == "application/json":
+        body = orjson.dumps(body, option=orjson.OPT_NON_STR_KEYS)
+    return status, [("Content-Type", content_type)], body
+
+
+async def process_admin_request(path: str, request_headers):
+    """
+    Serves the ``/admin/...`` HTTP endpoints from the websocket port, before
+    the WebSocket handshake. Every other path carries on to the handshake.
+
+    Endpoints need the ADMIN_TOKEN bearer token and answer for the worker
+    process that accepted the connection.
+    """
+    url = urlsplit(path)
+    if not url.path.startswith("/admin/"):
+        return None
+    if not admin_authorized(request_headers.get("Authorization"), ADMIN_TOKEN):
+        return admin_response(HTTPStatus.UNAUTHORIZED, {"detail": "unauthorized"})
+
+    params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    try:
+        if url.path == "/admin/profile":
+            report = await profile_for(
+                float(params.get("seconds", 5)),
+                int(params.get("top", 30)),
+                params.get("sort", "cumulative"),
+            )
+            return admin_response(HTTPStatus.OK, report.encode(), "text/plain")
+        if url.path == "/admin/tracemalloc":
+            diff = await tracemalloc_diff(
+                float(params.get("seconds", 10)),
+                int(params.get("top", 25)),
+                int(params.get("frames", 1)),
+            )
+            return admin_response(HTTPStatus.OK, diff)
+        if url.path == "/admin/sizes":
+            return admin_response(HTTPStatus.OK, await internal_sizes())
+        if url.path == "/admin/slow_queries" and embedded_handler is not None:
+            return admin_response(
+                HTTPStatus.OK, embedded_handler.slow_query_log.snapshot()
+            )
+    except ValueError as exc:
+        return admin_response(HTTPStatus.BAD_REQUEST, {"detail": str(exc)})
+    except CaptureBusy as exc:
+        return admin_response(HTTPStatus.CONFLICT, {"detail": str(exc)})
+    return admin_response(HTTPStatus.NOT_FOUND, {"detail": "not found"})
 
 
 async def main():
-    """Starts the WebSocket server and Redis listener."""
+    """
+    Starts the WebSocket server and Redis listener.
+
+    With ``RELAY_MODE=embedded`` the event handler's ingest and query logic,
+    database pools and cache client run inside this process instead of being
+    reached over HTTP.
+    """
+    global handler_session, embedded_handler
     websocket_port = int(os.getenv("WS_PORT", 8000))
+
+    if RELAY_MODE == "embedded":
+        import event_handler
+
+        embedded_handler = event_handler
+        logger.info("Running in embedded mode, event handler logic is in-process")
+        async with event_handler.lifespan(event_handler.app):
+            await serve(websocket_port)
+    else:
+        handler_session = create_handler_session()
+        try:
+            await serve(websocket_port)
+        finally:
+            await handler_session.close()
+
+
+async def serve(websocket_port: int):
+    """Runs the WebSocket server and the Redis fan-out until the process exits."""
     websocket_server = websockets.serve(
-        handle_websocket_connection, "0.0.0.0", websocket_port
+        handle_websocket_connection,
+        "0.0.0.0",
+        websocket_port,
+        reuse_port=WS_WORKERS > 1,
+        process_request=process_admin_request,
+    )
+    logger.info(
+        f"WebSocket server worker {WS_WORKER_ID} starting on port {websocket_port}"
     )
-    logger.info(f"WebSocket server starting on port {websocket_port}")
 
     # Create tasks for both the WebSocket server and Redis listener
     asyncio.create_task(redis_listener())
-    asyncio.create_task(remove_inactive_websockets())
+    asyncio.create_task(fanout_worker())
     await websocket_server
 
     # Prevent the program from exiting
     await asyncio.Future()
 
 
-if __name__ == "__main__":
+def run_worker():
+    """Runs one server process on uvloop when it is installed."""
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop is not installed, using the default asyncio event loop")
     try:
         asyncio.run(main())
     except Exception as e:
         logger.error(f"Error occurred while starting the server main loop: {e}")
+
+
+def run_workers(count: int):
+    """
+    Starts ``count`` worker processes that all accept on ``WS_PORT`` through
+    SO_REUSEPORT, and restarts any that exit.
+
+    Each worker has its own event loop, connections, subscription registry
+    and Redis subscription, and reports metrics under its own
+    ``service.instance.id``.
+    """
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+
+    def start(worker_id: int):
+        os.environ["WS_WORKER_ID"] = str(worker_id)
+        process = context.Process(target=run_worker, name=f"ws-worker-{worker_id}")
+        process.start()
+        workers[worker_id] = process
+
+    def stop(signum, frame):
+        for process in workers.values():
+            process.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(count):
+        start(worker_id)
+    logger.info(f"Started {count} websocket worker processes")
+
+    while True:
+        time.sleep(1)
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive():
+                logger.error(
+                    f"Websocket worker {worker_id} exited with {process.exitcode}, restarting"
+                )
+                start(worker_id)
+
+
+if __name__ == "__main__":
+    if RELAY_MODE == "embedded":
+        import event_handler
+
+        # Runs once here rather than in every worker
+        event_handler.prepare_storage()
+
+    if WS_WORKERS > 1:
+        run_workers(WS_WORKERS)
+    else:
+        run_worker()